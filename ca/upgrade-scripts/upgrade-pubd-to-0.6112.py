@@ -0,0 +1,40 @@
+# $Id$
+#
+# Copyright (C) 2015  Dragon Research Labs ("DRL")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND DRL DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL DRL BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+# pylint: disable=E0602
+
+"""
+Upgrade pubd SQL database to add the published object index.
+
+This code is evaluated in the context of rpki-sql-setup's
+do_apply_upgrades() function and has access to its variables.
+
+The index starts out empty.  pubd fills it in as clients publish, so
+the first publication of each existing object still rewrites it.
+"""
+
+db.cur.execute("""
+    CREATE TABLE IF NOT EXISTS published_object (
+            published_object_id     SERIAL NOT NULL,
+            uri                     TEXT NOT NULL,
+            hash                    CHAR(64) NOT NULL,
+            size                    BIGINT UNSIGNED NOT NULL,
+            client_id               BIGINT UNSIGNED NOT NULL,
+            PRIMARY KEY             (published_object_id),
+            CONSTRAINT              published_object_client_id
+            FOREIGN KEY             (client_id) REFERENCES client (client_id) ON DELETE CASCADE
+    ) ENGINE=InnoDB
+""")
@@ -20,9 +20,16 @@ Utilities for event-driven programming.
 
 import gc
 import sys
+import time
+import errno
+import heapq
+import select
 import signal
+import ctypes
+import ctypes.util
 import logging
 import asyncore
+import itertools
 import traceback
 import rpki.log
 import rpki.sundial
@@ -102,11 +109,96 @@ class iterator(object):
     else:
       self.item_callback(self, val)
 
+def _find_monotonic_clock():
+  """
+  Find a clock that doesn't jump when somebody sets the system time.
+  Python 2 doesn't give us one, so we call clock_gettime() via ctypes.
+  Falls back to time.time() if we don't know the right magic for this
+  platform.
+  """
+
+  if sys.platform.startswith("linux"):
+    clock_id = 1
+  elif sys.platform.startswith("freebsd"):
+    clock_id = 4
+  elif sys.platform == "darwin":
+    clock_id = 6
+  else:
+    return time.time
+
+  class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+  for name in ("c", "rt"):
+    try:
+      clock_gettime = ctypes.CDLL(ctypes.util.find_library(name), use_errno = True).clock_gettime
+      break
+    except (OSError, AttributeError):
+      continue
+  else:
+    return time.time
+
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+  ts = timespec()
+
+  def monotonic():
+    if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+      e = ctypes.get_errno()
+      raise OSError(e, "clock_gettime() failed")
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+  try:
+    monotonic()
+  except OSError:
+    return time.time
+  return monotonic
+
+## @var monotonic
+# Return current time in seconds from a monotonic clock.  Only
+# differences between values are meaningful.
+
+monotonic = _find_monotonic_clock()
+
 ## @var timer_queue
-# Timer queue.
+# Timer queue.  This is a heap of [deadline, sequence, timer] entries,
+# deadline being a monotonic() time.  Sequence numbers break ties, so
+# timers set for the same time run in the order in which they were set.
+#
+# Cancelling a timer just sets the timer slot of its entry to None
+# (lazy deletion), and we rebuild the heap when too many dead entries
+# pile up.  Moving a set timer to a later time (the usual case, eg, a
+# network stream's inactivity timeout) doesn't touch the heap at all:
+# the existing entry is requeued at the new deadline when it comes due.
 
 timer_queue = []
 
+_timer_sequence = itertools.count()
+_dead_timer_entries = 0
+
+def _discard_timer_entry(entry):
+  """
+  Mark a timer queue entry as dead, compacting the queue if dead
+  entries have come to outnumber live ones.
+  """
+  global _dead_timer_entries
+  entry[2] = None
+  _dead_timer_entries += 1
+  if _dead_timer_entries > 64 and _dead_timer_entries > len(timer_queue) / 2:
+    timer_queue[:] = [e for e in timer_queue if e[2] is not None]
+    heapq.heapify(timer_queue)
+    _dead_timer_entries = 0
+
+def _timer_queue_head():
+  """
+  Return the live entry at the head of the timer queue, or None if no
+  timers are set, discarding any dead entries we find along the way.
+  """
+  global _dead_timer_entries
+  while timer_queue and timer_queue[0][2] is None:
+    heapq.heappop(timer_queue)
+    _dead_timer_entries -= 1
+  return timer_queue[0] if timer_queue else None
+
 class timer(object):
   """
   Timer construct for event-driven code.
@@ -120,10 +212,18 @@ class timer(object):
   # Verbose chatter about timers being run.
   run_debug = False
 
+  ## @var deadline
+  # When this timer should fire, as a monotonic() time.
+  deadline = None
+
+  ## @var entry
+  # Our entry in timer_queue, if we're set.  Note that our deadline
+  # may be later than the entry's.
+  entry = None
+
   def __init__(self, handler = None, errback = None):
     self.set_handler(handler)
     self.set_errback(errback)
-    self.when = None
     if self.gc_debug:
       self.trace("Creating %r" % self)
 
@@ -143,13 +243,26 @@ class timer(object):
     if self.gc_debug:
       self.trace("Setting %r to %r" % (self, when))
     if isinstance(when, rpki.sundial.timedelta):
-      self.when = rpki.sundial.now() + when
+      deadline = monotonic() + when.total_seconds()
     else:
-      self.when = when
-    assert isinstance(self.when, rpki.sundial.datetime), "%r: Expecting a datetime, got %r" % (self, self.when)
-    if self not in timer_queue:
-      timer_queue.append(self)
-    timer_queue.sort(key = lambda x: x.when)
+      assert isinstance(when, rpki.sundial.datetime), "%r: Expecting a datetime, got %r" % (self, when)
+      deadline = monotonic() + (when - rpki.sundial.now()).total_seconds()
+    self.deadline = deadline
+    if self.entry is not None and self.entry[0] <= deadline:
+      return
+    if self.entry is not None:
+      _discard_timer_entry(self.entry)
+    self.entry = [deadline, next(_timer_sequence), self]
+    heapq.heappush(timer_queue, self.entry)
+
+  @property
+  def when(self):
+    """
+    Expiration time of this timer as a datetime, or None if not set.
+    """
+    if self.entry is None:
+      return None
+    return rpki.sundial.now() + rpki.sundial.timedelta(seconds = self.deadline - monotonic())
 
   def __cmp__(self, other):
     return cmp(id(self), id(other))
@@ -164,17 +277,15 @@ class timer(object):
     """
     if self.gc_debug:
       self.trace("Canceling %r" % self)
-    try:
-      while True:
-        timer_queue.remove(self)
-    except ValueError:
-      pass
+    if self.entry is not None:
+      _discard_timer_entry(self.entry)
+      self.entry = None
 
   def is_set(self):
     """
     Test whether this timer is currently set.
     """
-    return self in timer_queue
+    return self.entry is not None
 
   def set_handler(self, handler):
     """
@@ -202,9 +313,18 @@ class timer(object):
     called, so that even if new events keep getting scheduled, we'll
     return to the I/O loop reasonably quickly.
     """
-    now = rpki.sundial.now()
-    while timer_queue and now >= timer_queue[0].when:
-      t = timer_queue.pop(0)
+    now = monotonic()
+    while True:
+      entry = _timer_queue_head()
+      if entry is None or entry[0] > now:
+        break
+      heapq.heappop(timer_queue)
+      t = entry[2]
+      if t.deadline > entry[0]:
+        t.entry = [t.deadline, next(_timer_sequence), t]
+        heapq.heappush(timer_queue, t.entry)
+        continue
+      t.entry = None
       if cls.run_debug:
         logger.debug("Running %r", t)
       try:
@@ -227,22 +347,13 @@ class timer(object):
   def seconds_until_wakeup(cls):
     """
     Calculate delay until next timer expires, or None if no timers are
-    set and we should wait indefinitely.  Rounds up to avoid spinning
-    in select() or poll().  We could calculate fractional seconds in
-    the right units instead, but select() and poll() don't even take
-    the same units (argh!), and we're not doing anything that
-    hair-triggered, so rounding up is simplest.
+    set and we should wait indefinitely.  The result is a float, which
+    asyncore.poll() and asyncore.poll2() both accept.
     """
-    if not timer_queue:
+    entry = _timer_queue_head()
+    if entry is None:
       return None
-    now = rpki.sundial.now()
-    if now >= timer_queue[0].when:
-      return 0
-    delay = timer_queue[0].when - now
-    seconds = delay.convert_to_seconds()
-    if delay.microseconds:
-      seconds += 1
-    return seconds
+    return max(entry[0] - monotonic(), 0)
 
   @classmethod
   def clear(cls):
@@ -251,8 +362,11 @@ class timer(object):
     queue content, but this way we can notify subclasses that provide
     their own cancel() method.
     """
-    while timer_queue:
-      timer_queue.pop(0).cancel()
+    global _dead_timer_entries
+    for t in [e[2] for e in timer_queue if e[2] is not None]:
+      t.cancel()
+    del timer_queue[:]
+    _dead_timer_entries = 0
 
 def _raiseExitNow(signum, frame):
   """
@@ -278,11 +392,117 @@ def event_defer(handler, delay = rpki.sundial.timedelta(seconds = 0)):
 
 debug_event_timing = False
 
+## @var event_loop_backend
+# Which system call event_loop() uses to wait for I/O: "select" or
+# "poll" (asyncore's own code), or "epoll" (Linux only, falls back to
+# "poll" elsewhere).  select() is the default as it's the most
+# portable, but it can't handle file descriptors above FD_SETSIZE.
+
+event_loop_backend = "select"
+
+class epoll_poller(object):
+  """
+  Drop-in replacement for asyncore.poll() using epoll().
+
+  asyncore's model is that every dispatcher says whether it's readable
+  and writable each time around the loop, so we still have to ask each
+  one, but we only make system calls to update the epoll set when the
+  answer changes, and the kernel doesn't have to rescan every file
+  descriptor on every call the way it does with select() and poll().
+  """
+
+  def __init__(self):
+    self.epoll = select.epoll()
+    self.registered = {}                # fd -> (dispatcher, flags)
+
+  def close(self):
+    self.epoll.close()
+
+  def update(self, fd, obj, flags):
+    """
+    Bring epoll's idea of what we want for fd into line with ours.
+    If the dispatcher for this fd has changed, the old file descriptor
+    may have been closed and reused, so start over rather than trusting
+    epoll's state.
+    """
+    old_obj, old_flags = self.registered.get(fd, (None, 0))
+    if old_obj is obj and old_flags == flags:
+      return
+    if old_obj is not None and (old_obj is not obj or not flags):
+      try:
+        self.epoll.unregister(fd)
+      except (IOError, OSError, ValueError):
+        pass
+      del self.registered[fd]
+      old_obj = None
+    if not flags:
+      return
+    if old_obj is None:
+      try:
+        self.epoll.register(fd, flags)
+      except IOError, e:
+        if e.errno != errno.EEXIST:
+          raise
+        self.epoll.modify(fd, flags)
+    else:
+      self.epoll.modify(fd, flags)
+    self.registered[fd] = (obj, flags)
+
+  def __call__(self, timeout, socket_map):
+    for fd in [fd for fd in self.registered if fd not in socket_map]:
+      self.update(fd, None, 0)
+    for fd, obj in socket_map.items():
+      flags = 0
+      if obj.readable():
+        flags |= select.EPOLLIN | select.EPOLLPRI
+      if obj.writable() and not obj.accepting:
+        flags |= select.EPOLLOUT
+      self.update(fd, obj, flags)
+    if not self.registered:
+      if timeout:
+        time.sleep(timeout)
+      return
+    try:
+      events = self.epoll.poll(-1 if timeout is None else timeout)
+    except IOError, e:
+      if e.errno != errno.EINTR:
+        raise
+      return
+    for fd, flags in events:
+      obj = socket_map.get(fd)
+      if obj is not None:
+        # EPOLL* flag values are the same as POLL* values, which is what
+        # asyncore.readwrite() expects.
+        asyncore.readwrite(obj, flags)
+
+def _poll2(timeout, socket_map):
+  """
+  Wrapper around asyncore.poll2(), which doesn't sleep when there's
+  nothing in the socket map, so we'd spin waiting for timers.
+  """
+  if socket_map:
+    asyncore.poll2(timeout, socket_map)
+  elif timeout:
+    time.sleep(timeout)
+
+def _make_poller():
+  """
+  Return a poller function for event_loop() per event_loop_backend.
+  """
+  if event_loop_backend == "epoll" and hasattr(select, "epoll"):
+    return epoll_poller()
+  if event_loop_backend in ("epoll", "poll") and hasattr(select, "poll"):
+    return _poll2
+  if event_loop_backend != "select":
+    logger.warning("Event loop backend %r not available, using select()", event_loop_backend)
+  return asyncore.poll
+
 def event_loop(catch_signals = (signal.SIGINT, signal.SIGTERM)):
   """
   Replacement for asyncore.loop(), adding timer and signal support.
   """
   old_signal_handlers = {}
+  poller = _make_poller()
   while True:
     save_sigs = len(old_signal_handlers) == 0
     try:
@@ -290,11 +510,11 @@ def event_loop(catch_signals = (signal.SIGINT, signal.SIGTERM)):
         old = signal.signal(sig, _raiseExitNow)
         if save_sigs:
           old_signal_handlers[sig] = old
-      while asyncore.socket_map or timer_queue:
+      while asyncore.socket_map or _timer_queue_head() is not None:
         t = timer.seconds_until_wakeup()
         if debug_event_timing:
           logger.debug("Dismissing to asyncore.poll(), t = %s, q = %r", t, timer_queue)
-        asyncore.poll(t, asyncore.socket_map)
+        poller(t, asyncore.socket_map)
         timer.runq()
         if timer.gc_debug:
           gc.collect()
@@ -322,6 +542,8 @@ def event_loop(catch_signals = (signal.SIGINT, signal.SIGTERM)):
     finally:
       for sig in old_signal_handlers:
         signal.signal(sig, old_signal_handlers[sig])
+  if isinstance(poller, epoll_poller):
+    poller.close()
 
 class sync_wrapper(object):
   """
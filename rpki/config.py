@@ -199,6 +199,8 @@ class parser(object):
     import rpki.x509
     import rpki.sql
     import rpki.async
+    import rpki.workers
+    import rpki.xml_utils
     import rpki.log
     import rpki.daemonize
 
@@ -234,6 +236,11 @@ class parser(object):
     except ConfigParser.NoOptionError:
       pass
 
+    try:
+      rpki.http.max_client_streams = self.getint("max_client_streams")
+    except ConfigParser.NoOptionError:
+      pass
+
     try:
       rpki.x509.CMS_object.debug_cms_certs = self.getboolean("debug_cms_certs")
     except ConfigParser.NoOptionError:
@@ -244,6 +251,26 @@ class parser(object):
     except ConfigParser.NoOptionError:
       pass
 
+    try:
+      rpki.sql.session.batch_sweep = self.getboolean("sql_batch_sweep")
+    except ConfigParser.NoOptionError:
+      pass
+
+    try:
+      rpki.xml_utils.sax_handler.use_sax = self.getboolean("xml_use_sax")
+    except ConfigParser.NoOptionError:
+      pass
+
+    try:
+      rpki.async.event_loop_backend = self.get("event_loop_backend")
+    except ConfigParser.NoOptionError:
+      pass
+
+    try:
+      rpki.workers.worker_count = self.getint("crypto_workers")
+    except ConfigParser.NoOptionError:
+      pass
+
     try:
       rpki.async.timer.gc_debug = self.getboolean("gc_debug")
     except ConfigParser.NoOptionError:
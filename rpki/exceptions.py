@@ -365,3 +365,8 @@ class WrongEKU(RPKI_Exception):
   """
   Extended Key Usage extension does not match profile.
   """
+
+class CryptoWorkerFailed(RPKI_Exception):
+  """
+  Worker process failed to run a job.
+  """
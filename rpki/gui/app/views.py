@@ -52,6 +52,7 @@ import rpki.csv_utils
 
 from rpki.gui.cacheview.models import ROA
 from rpki.gui.routeview.models import RouteOrigin
+from rpki.gui.routeview.validator import get_validator
 from rpki.gui.decorators import tls_required
 
 logger = logging.getLogger(__name__)
@@ -588,7 +589,12 @@ def child_delete(request, pk):
 def roa_detail(request, pk):
     conf = get_conf(request.user, request.session['handle'])
     obj = get_object_or_404(conf.roas, pk=pk)
-    return render(request, 'app/roa_detail.html', {'object': obj})
+    # classify the covered routes in one pass rather than calling
+    # RouteOrigin.status (and so get_validator()) once per row
+    return render(request, 'app/roa_detail.html', {
+        'object': obj,
+        'routes': get_validator().classify(obj.routes),
+    })
 
 
 def get_covered_routes(rng, max_prefixlen, asn):
@@ -608,8 +614,9 @@ def get_covered_routes(rng, max_prefixlen, asn):
         prefix_max__lte=rng.max
     )
     routes = []
+    validator = get_validator()
     for route in qs:
-        status = route.status
+        status = validator.status(route)
         # tweak the validation status due to the presence of the
         # new ROA.  Don't need to check the prefix bounds here
         # because all the matches routes will be covered by this
@@ -737,8 +744,9 @@ def roa_create_multi(request):
 
                 query |= Q(prefix_min__gte=rng.min, prefix_max__lte=rng.max)
 
+            validator = get_validator()
             for rt in RouteOrigin.objects.filter(query):
-                status = rt.status  # cache the value
+                status = validator.status(rt)
                 newstatus = status
                 if status == 'unknown':
                     # possible change to valid or invalid
@@ -1039,7 +1047,9 @@ def route_view(request):
         routes = []
     ts = dict((attr['name'], attr['ts']) for attr in models.Timestamp.objects.values())
     return render(request, 'app/routes_view.html',
-                  {'routes': routes, 'timestamp': ts})
+                  {'routes': routes,
+                   'route_status': get_validator().classify(routes),
+                   'timestamp': ts})
 
 
 def route_detail(request, pk):
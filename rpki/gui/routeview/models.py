@@ -46,14 +46,14 @@ class RouteOrigin(rpki.gui.models.PrefixV4):
 
     @property
     def status(self):
-        "Returns the validation status of this route origin object."
-        roas = self.roas
-        # subselect exact match
-        if self.asn != 0 and roas.filter(asid=self.asn, prefixes__max_length__gte=self.prefixlen).exists():
-            return 'valid'
-        elif roas.exists():
-            return 'invalid'
-        return 'unknown'
+        """Returns the validation status of this route origin object.
+
+        See rpki.gui.routeview.validator for how this is computed.  When
+        looping over many routes, call get_validator() once and use its
+        status() method directly.
+
+        """
+        return rpki.gui.routeview.validator.get_validator().status(self)
 
     @permalink
     def get_absolute_url(self):
@@ -73,9 +73,15 @@ class RouteOriginV6(rpki.gui.models.PrefixV6):
         return u"AS%d's route origin for %s" % (self.asn,
                                                 self.get_prefix_display())
 
+    @property
+    def status(self):
+        "Returns the validation status of this route origin object."
+        return rpki.gui.routeview.validator.get_validator().status(self)
+
     class Meta:
         ordering = ('prefix_min', '-prefix_max')
 
 
 # this goes at the end of the file to avoid problems with circular imports
 import rpki.gui.cacheview.models
+import rpki.gui.routeview.validator
@@ -0,0 +1,160 @@
+# Copyright (C) 2014  SPARTA, Inc. a Parsons Company
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND SPARTA DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL SPARTA BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""In-memory route origin validation (RFC 6811) against the ROA prefixes
+in the cacheview database.
+
+Computing RouteOrigin.status with SQL costs two queries per route, which
+is fine for a single route but hopeless for a full BGP table.  Instead,
+we load every ROA prefix once and index it by (prefix length, network
+address), so finding the covering ROA prefixes for a route is one
+dictionary lookup for each distinct ROA prefix length no longer than the
+route.  ROA prefixes are always CIDR blocks, so a ROA prefix covers a
+route exactly when the route's address masked to the ROA's length is the
+ROA's network address.
+
+The index is rebuilt when the rcynic_import timestamp changes, and
+results are memoized until then, since a route's status depends only on
+its prefix, its origin AS and the set of ROAs.
+
+"""
+
+__version__ = '$Id$'
+__all__ = ('OriginValidator', 'get_validator')
+
+import logging
+
+import rpki.gui.models
+
+logger = logging.getLogger(__name__)
+
+
+def address_value(v):
+    """Convert an address from a PrefixV4/PrefixV6 column into a long.
+
+    Model instances hold rpki.POW.IPAddress objects, but values_list()
+    hands back the raw column: an integer for IPv4, a 16 byte binary
+    string for IPv6.
+
+    """
+    if isinstance(v, str):
+        return long(v.encode('hex'), 16)
+    return long(v)
+
+
+class PrefixIndex(object):
+    "ROA prefixes of one address family, indexed for covering lookups."
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.table = {}     # (prefixlen, prefix_min) -> [(asid, max_length)]
+        self.masks = ()     # (prefixlen, mask) for each length in the table
+        self.results = {}   # (prefix_min, prefix_max, asn) -> status
+
+    def prefixlen(self, prefix_min, prefix_max):
+        "Return the prefix length of the CIDR block [prefix_min, prefix_max]."
+        return self.bits - (prefix_max - prefix_min + 1).bit_length() + 1
+
+    def add(self, prefix_min, prefix_max, max_length, asid):
+        key = (self.prefixlen(prefix_min, prefix_max), prefix_min)
+        self.table.setdefault(key, []).append((asid, max_length))
+
+    def freeze(self):
+        "Precompute the masks for the prefix lengths present in the index."
+        allones = (1 << self.bits) - 1
+        self.masks = tuple(
+            (n, allones ^ ((1 << (self.bits - n)) - 1))
+            for n in sorted(set(n for n, prefix_min in self.table))
+        )
+
+    def status(self, prefix_min, prefix_max, asn):
+        "Return 'valid', 'invalid' or 'unknown' for the given route."
+        key = (prefix_min, prefix_max, asn)
+        result = self.results.get(key)
+        if result is None:
+            result = 'unknown'
+            prefixlen = self.prefixlen(prefix_min, prefix_max)
+            table = self.table
+            for n, mask in self.masks:
+                if n > prefixlen:
+                    break
+                entries = table.get((n, prefix_min & mask))
+                if entries is None:
+                    continue
+                result = 'invalid'
+                if asn != 0 and any(asid == asn and max_length >= prefixlen
+                                    for asid, max_length in entries):
+                    result = 'valid'
+                    break
+            self.results[key] = result
+        return result
+
+
+class OriginValidator(object):
+    """Origin validation engine built from the cacheview ROAPrefixV4 and
+    ROAPrefixV6 tables.
+
+    Use get_validator() rather than instantiating this directly, so that
+    the index is shared and only rebuilt after a new rcynic import.
+
+    """
+
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp
+        self.v4 = PrefixIndex(32)
+        self.v6 = PrefixIndex(128)
+        self.load(self.v4, rpki.gui.cacheview.models.ROAPrefixV4)
+        self.load(self.v6, rpki.gui.cacheview.models.ROAPrefixV6)
+        logger.debug('loaded %d IPv4 and %d IPv6 ROA prefixes',
+                     len(self.v4.table), len(self.v6.table))
+
+    @staticmethod
+    def load(index, model):
+        qs = model.objects.filter(roas__isnull=False).values_list(
+            'prefix_min', 'prefix_max', 'max_length', 'roas__asid')
+        for prefix_min, prefix_max, max_length, asid in qs.iterator():
+            index.add(address_value(prefix_min), address_value(prefix_max),
+                      max_length, asid)
+        index.freeze()
+
+    def status(self, route):
+        """Return the validation status of a RouteOrigin or RouteOriginV6
+        object."""
+        index = self.v6 if isinstance(route, rpki.gui.models.PrefixV6) else self.v4
+        return index.status(address_value(route.prefix_min),
+                            address_value(route.prefix_max), route.asn)
+
+    def classify(self, routes):
+        """Return a list of (route, status) tuples for an iterable of
+        routes."""
+        return [(route, self.status(route)) for route in routes]
+
+
+_validator = None
+
+
+def get_validator():
+    """Return the shared OriginValidator, rebuilding it if the ROA tables
+    have been reloaded since it was built."""
+    global _validator
+    from rpki.gui.app.models import Timestamp
+    q = Timestamp.objects.filter(name='rcynic_import').values_list('ts', flat=True)
+    timestamp = q[0] if q else None
+    if _validator is None or _validator.timestamp != timestamp:
+        _validator = OriginValidator(timestamp)
+    return _validator
+
+
+# this goes at the end of the file to avoid problems with circular imports
+import rpki.gui.cacheview.models
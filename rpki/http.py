@@ -34,10 +34,18 @@ import rpki.sundial
 import rpki.x509
 import rpki.exceptions
 import rpki.log
+import rpki.metrics
 import rpki.POW
 
 logger = logging.getLogger(__name__)
 
+client_seconds = rpki.metrics.histogram("rpki_http_client_seconds",
+                                        "HTTP client request round trip time, including time queued, by destination and outcome.",
+                                        ("destination", "outcome"))
+server_seconds = rpki.metrics.histogram("rpki_http_server_seconds",
+                                        "HTTP server time from receiving a request to sending the response, by handler and status.",
+                                        ("handler", "code"))
+
 ## @var default_content_type
 # HTTP content type used for RPKI messages.
 # Can be overriden on a per-client or per-server basis.
@@ -51,6 +59,17 @@ want_persistent_client = False
 # Whether we want persistent HTTP server streams, when client also supports them.
 want_persistent_server = False
 
+## @var max_client_streams
+# Maximum number of concurrent HTTP client streams to a single
+# destination.  Each stream carries one request at a time, so this is
+# also the maximum number of requests in flight per destination.
+#
+# Default is 1.  CMS replay protection (check_replay_sql and friends)
+# requires each peer's messages to arrive in signing order, which more
+# than one stream per destination can't guarantee, so only raise this
+# for destinations which don't check CMS replay timestamps.
+max_client_streams = 1
+
 ## @var default_client_timeout
 # Default HTTP client connection timeout.
 default_client_timeout = rpki.sundial.timedelta(minutes = 5)
@@ -229,6 +248,7 @@ class http_request(http_message):
     self.callback = callback
     self.errback = errback
     self.retried = False
+    self.started = rpki.metrics.now()
 
   def parse_first_line(self, cmd, path, version):
     """
@@ -489,6 +509,7 @@ class http_server(http_stream):
   def __init__(self, sock, handlers):
     self.handlers = handlers
     self.received_content_type = None
+    self.handler_path = None
     http_stream.__init__(self, sock = sock)
     self.expect_close = not want_persistent_server
     self.logger.debug("Starting")
@@ -503,12 +524,15 @@ class http_server(http_stream):
 
   def find_handler(self, path):
     """
-    Helper method to search self.handlers.
+    Helper method to search self.handlers.  Returns the matching path
+    prefix, the handler, and the allowed content types.  Allowed
+    content types of None mean a read-only handler, which takes GET
+    requests rather than POST, with no body.
     """
     for h in self.handlers:
       if path.startswith(h[0]):
-        return h[1], h[2] if len(h) > 2 else (default_content_type,)
-    return None, None
+        return h[0], h[1], h[2] if len(h) > 2 else (default_content_type,)
+    return None, None, None
 
   def handle_message(self):
     """
@@ -520,10 +544,13 @@ class http_server(http_stream):
     self.logger.debug("Received request %r", self.msg)
     if not self.msg.persistent:
       self.expect_close = True
-    handler, allowed_content_types = self.find_handler(self.msg.path)
-    self.received_content_type = self.msg.headers["Content-Type"]
+    self.handler_path, handler, allowed_content_types = self.find_handler(self.msg.path)
+    self.received_content_type = self.msg.headers.get("Content-Type")
     error = None
-    if self.msg.cmd != "POST":
+    if handler is not None and allowed_content_types is None:
+      if self.msg.cmd != "GET":
+        error = 501, "No handler for method %s" % self.msg.cmd
+    elif self.msg.cmd != "POST":
       error = 501, "No handler for method %s" % self.msg.cmd
     elif self.received_content_type not in allowed_content_types:
       error = 415, "No handler for Content-Type %s" % self.received_content_type
@@ -546,13 +573,14 @@ class http_server(http_stream):
     """
     self.send_message(code = code, reason = reason)
 
-  def send_reply(self, code, body = None, reason = "OK"):
+  def send_reply(self, code, body = None, reason = "OK", content_type = None):
     """
-    Send a reply to this request.
+    Send a reply to this request.  The reply has the same Content-Type
+    as the request unless the handler says otherwise.
     """
-    self.send_message(code = code, body = body, reason = reason)
+    self.send_message(code = code, body = body, reason = reason, content_type = content_type)
 
-  def send_message(self, code, reason = "OK", body = None):
+  def send_message(self, code, reason = "OK", body = None, content_type = None):
     """
     Queue up reply message.  If both parties agree that connection is
     persistant, and if no error occurred, restart this stream to
@@ -560,10 +588,11 @@ class http_server(http_stream):
     this stream so it will shut down once the reply has been sent.
     """
     self.logger.debug("Sending response %s %s", code, reason)
+    server_seconds.since(self.msg.started, (self.handler_path or "", code))
     if code >= 400:
       self.expect_close = True
     msg = http_response(code = code, reason = reason, body = body,
-                        Content_Type = self.received_content_type,
+                        Content_Type = content_type or self.received_content_type or default_content_type,
                         Connection = "Close" if self.expect_close else "Keep-Alive")
     self.push(msg.format())
     if self.expect_close:
@@ -652,6 +681,10 @@ class http_client(http_stream):
   # Application layer connection state.
   state = None
 
+  ## @var request
+  # Request currently in flight on this stream, if any.
+  request = None
+
   def __init__(self, queue, hostport):
     http_stream.__init__(self)
     self.logger.debug("Creating new connection to %s", addr_to_string(hostport))
@@ -706,8 +739,8 @@ class http_client(http_stream):
     """
     self.logger.debug("Socket connected")
     self.set_state("idle")
-    assert self.queue.client is self
-    self.queue.send_request()
+    assert id(self) in self.queue.clients
+    self.queue.send_request(self)
 
   def set_state(self, state):
     """
@@ -732,6 +765,7 @@ class http_client(http_stream):
     self.logger.debug("Sending request %r", msg)
     assert self.state == "idle", "%r: state should be idle, is %s" % (self, self.state)
     self.set_state("request-sent")
+    self.request = msg
     msg.headers["Connection"] = "Close" if self.expect_close else "Keep-Alive"
     self.push(msg.format())
     self.restart()
@@ -827,6 +861,11 @@ class http_queue(object):
   Queue of pending HTTP requests for a single destination.  This class
   is very tightly coupled to http_client; http_client handles the HTTP
   stream itself, this class provides a slightly higher-level API.
+
+  The queue keeps a pool of up to max_client_streams client streams,
+  each of which carries one request at a time.  Pending requests are
+  handed out in the order they were queued, to idle streams first, then
+  to new streams if we're not yet at the limit.
   """
 
   def __repr__(self):
@@ -835,7 +874,10 @@ class http_queue(object):
   def __init__(self, hostport):
     self.logger = logging.LoggerAdapter(self.logger, dict(context = self))
     self.hostport = hostport
-    self.client = None
+    # Keyed by id(), because http_client is an old-style class that
+    # delegates attribute lookups to its socket, which makes comparing
+    # http_client objects (eg, "client in list") painfully slow.
+    self.clients = {}
     self.logger.debug("Created")
     self.queue = []
 
@@ -848,34 +890,40 @@ class http_queue(object):
 
   def restart(self):
     """
-    Send next request for this queue, if we can.  This may involve
-    starting a new http_client stream, reusing an existing idle
-    stream, or just ignoring this request if there's an active client
-    stream already; in the last case, handling of the response (or
-    exception, or timeout) for the query currently in progress will
-    call this method when it's time to kick out the next query.
-    """
-    try:
-      if self.client is None:
-        self.client = http_client(self, self.hostport)
-        self.logger.debug("Attached client %r", self.client)
-        self.client.start()
-      elif self.client.state == "idle":
-        self.logger.debug("Sending request to existing client %r", self.client)
-        self.send_request()
-      else:
-        self.logger.debug("Client %r exists in state %r", self.client, self.client.state)
-    except (rpki.async.ExitNow, SystemExit):
-      raise
-    except Exception, e:
-      self.return_result(self.client, e, detach = True)
+    Send as many queued requests as we can.  This may involve reusing
+    existing idle streams or starting new http_client streams.
+    Requests we can't send yet stay queued; handling of the response
+    (or exception, or timeout) for a query in progress will call this
+    method when it's time to kick out the next query.
+    """
+    for client in [c for c in self.clients.itervalues() if c.state == "idle"]: # pylint: disable=W0621
+      if not self.queue:
+        break
+      self.logger.debug("Sending request to existing client %r", client)
+      self.send_request(client)
+    opening = sum(1 for c in self.clients.itervalues() if c.state == "opening")
+    while len(self.queue) > opening and len(self.clients) < max_client_streams:
+      client = None
+      try:
+        client = http_client(self, self.hostport)
+        self.clients[id(client)] = client
+        self.logger.debug("Attached client %r", client)
+        opening += 1
+        client.start()
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        self.return_result(client, e, detach = True)
+    if self.queue:
+      self.logger.debug("Clients busy, %d request(s) waiting: %r", len(self.queue), self.clients.values())
 
-  def send_request(self):
+  def send_request(self, client):       # pylint: disable=W0621
     """
-    Kick out the next query in this queue, if any.
+    Kick out the next query in this queue, if any, on the specified
+    client stream.
     """
     if self.queue:
-      self.client.send_request(self.queue[0])
+      client.send_request(self.queue.pop(0))
 
   def detach(self, client_):
     """
@@ -884,9 +932,9 @@ class http_queue(object):
     handling of what otherwise would be a nasty set of race
     conditions.
     """
-    if client_ is self.client:
+    if id(client_) in self.clients:
       self.logger.debug("Detaching client %r", client_)
-      self.client = None
+      del self.clients[id(client_)]
 
   def return_result(self, client, result, detach = False): # pylint: disable=W0621
     """
@@ -894,24 +942,36 @@ class http_queue(object):
     to the original caller.  Result may be either an HTTP response
     message or an exception.  In either case, once we're done
     processing this result, kick off next message in the queue, if any.
+
+    An exception from a stream with no request in flight (eg, failure
+    to connect) is charged to the oldest queued request, so that we
+    don't loop forever trying to reach a dead server.
     """
 
-    if client is not self.client:
+    if client is not None and id(client) not in self.clients:
       self.logger.warning("Wrong client trying to return result.  THIS SHOULD NOT HAPPEN.  Dropping result %r", result)
       return
 
     if detach:
       self.detach(client)
 
-    try:
-      req = self.queue.pop(0)
-      self.logger.debug("Dequeuing request %r", req)
-    except IndexError:
-      self.logger.warning("No caller.  THIS SHOULD NOT HAPPEN.  Dropping result %r", result)
-      return
+    req = getattr(client, "request", None)
+    if req is not None:
+      client.request = None
+      self.logger.debug("Returning result for request %r", req)
+    else:
+      try:
+        req = self.queue.pop(0)
+        self.logger.debug("Dequeuing request %r", req)
+      except IndexError:
+        self.logger.warning("No caller.  THIS SHOULD NOT HAPPEN.  Dropping result %r", result)
+        return
 
     assert isinstance(result, http_response) or isinstance(result, Exception)
 
+    client_seconds.since(req.started, (addr_to_string(self.hostport),
+                                       "ok" if isinstance(result, http_response) else "error"))
+
     if isinstance(result, http_response):
       try:
         self.logger.debug("Returning result %r to caller", result)
@@ -1035,24 +1095,34 @@ class caller(object):
       """
       Handle CMS-wrapped XML response message.
       """
+
+      def unwrapped(r_msg):
+        try:
+          self.cms_timestamp = r_cms.check_replay(self.cms_timestamp, self.url)
+          if self.debug:
+            print "<!-- Reply -->"
+            print r_cms.pretty_print_content()
+        except (rpki.async.ExitNow, SystemExit):
+          raise
+        except Exception, e:
+          eb(e)
+        else:
+          cb(r_msg)
+
       try:
         r_cms = self.proto.cms_msg(DER = r_der)
-        r_msg = r_cms.unwrap((self.server_ta, self.server_cert))
-        self.cms_timestamp = r_cms.check_replay(self.cms_timestamp, self.url)
-        if self.debug:
-          print "<!-- Reply -->"
-          print r_cms.pretty_print_content()
-        cb(r_msg)
+        r_cms.unwrap_async((self.server_ta, self.server_cert), unwrapped, eb, order = self.url)
       except (rpki.async.ExitNow, SystemExit):
         raise
       except Exception, e:
         eb(e)
 
+    def wrapped(q_der):
+      if self.debug:
+        print "<!-- Query -->"
+        print q_cms.pretty_print_content()
+      client(url = self.url, msg = q_der, callback = done, errback = eb)
+
     q_msg = self.proto.msg.query(*pdus)
     q_cms = self.proto.cms_msg()
-    q_der = q_cms.wrap(q_msg, self.client_key, self.client_cert)
-    if self.debug:
-      print "<!-- Query -->"
-      print q_cms.pretty_print_content()
-
-    client(url = self.url, msg = q_der, callback = done, errback = eb)
+    q_cms.wrap_async(q_msg, self.client_key, self.client_cert, None, wrapped, eb, order = self.url)
@@ -185,7 +185,7 @@ class self_elt(data_elt):
     """
     Fetch all parent objects that link to this self object.
     """
-    return parent_elt.sql_fetch_where(self.gctx, "self_id = %s", (self.self_id,))
+    return parent_elt.sql_fetch_indexed(self.gctx, "self_id", self.self_id)
 
   @property
   def children(self):
@@ -199,7 +199,7 @@ class self_elt(data_elt):
     """
     Fetch all ROA objects that link to this self object.
     """
-    return rpki.rpkid.roa_obj.sql_fetch_where(self.gctx, "self_id = %s", (self.self_id,))
+    return rpki.rpkid.roa_obj.sql_fetch_indexed(self.gctx, "self_id", self.self_id)
 
   @property
   def ghostbusters(self):
@@ -215,6 +215,27 @@ class self_elt(data_elt):
     """
     return rpki.rpkid.ee_cert_obj.sql_fetch_where(self.gctx, "self_id = %s", (self.self_id,))
 
+  def preload(self):
+    """
+    Bulk load this self's parents, CAs, ca_details, ROAs, and the
+    objects hanging off the ca_details, in a handful of queries rather
+    than one per property access.  Returns the rpki.sql.preload
+    object, which the caller must release() when done with it.
+    """
+    p = rpki.sql.preload(self.gctx)
+    try:
+      parents = p.load(parent_elt, "self_id", (self.self_id,))
+      cas = p.load(rpki.rpkid.ca_obj, "parent_id", (parent.parent_id for parent in parents))
+      ca_details = p.load(rpki.rpkid.ca_detail_obj, "ca_id", (ca.ca_id for ca in cas))
+      p.load(rpki.rpkid.roa_obj, "self_id", (self.self_id,))
+      ca_detail_ids = [ca_detail.ca_detail_id for ca_detail in ca_details]
+      for cls in (rpki.rpkid.child_cert_obj, rpki.rpkid.revoked_cert_obj, rpki.rpkid.roa_obj,
+                  rpki.rpkid.ghostbuster_obj, rpki.rpkid.ee_cert_obj):
+        p.load(cls, "ca_detail_id", ca_detail_ids)
+    except:                             # pylint: disable=W0702
+      p.release()
+      raise
+    return p
 
   def serve_post_save_hook(self, q_pdu, r_pdu, cb, eb):
     """
@@ -305,24 +326,47 @@ class self_elt(data_elt):
     do this via brute force.  Think of it as a trial version to see
     whether we've identified everything that needs to be republished
     for this operation.
+
+    We do at least ask pubd what it already has, and only send it
+    objects that are missing or different.  pubd leaves objects whose
+    files have gone missing from its publication tree out of that
+    list, so we still restore those.  If pubd can't tell us, we send
+    everything.
     """
 
     def loop(iterator, parent):
-      q_msg = rpki.publication.msg.query()
-      for ca in parent.cas:
-        ca_detail = ca.active_ca_detail
-        if ca_detail is not None:
-          q_msg.append(rpki.publication.crl_elt.make_publish(
-            ca_detail.crl_uri, ca_detail.latest_crl))
-          q_msg.append(rpki.publication.manifest_elt.make_publish(
-            ca_detail.manifest_uri, ca_detail.latest_manifest))
-          q_msg.extend(rpki.publication.certificate_elt.make_publish(
-            c.uri, c.cert) for c in ca_detail.child_certs)
-          q_msg.extend(rpki.publication.roa_elt.make_publish(
-            r.uri, r.roa) for r in ca_detail.roas if r.roa is not None)
-          q_msg.extend(rpki.publication.ghostbuster_elt.make_publish(
-            g.uri, g.ghostbuster) for g in ca_detail.ghostbusters)
-      parent.repository.call_pubd(iterator, eb, q_msg)
+
+      listing = [True]
+
+      def listed(published):
+        listing[0] = False
+        q_msg = rpki.publication.msg.query()
+        def publish(pdu_type, uri, obj):
+          if published.get(uri) != rpki.x509.sha256(obj.get_DER()).encode("hex"):
+            q_msg.append(pdu_type.make_publish(uri, obj))
+        for ca in parent.cas:
+          ca_detail = ca.active_ca_detail
+          if ca_detail is not None:
+            publish(rpki.publication.crl_elt, ca_detail.crl_uri, ca_detail.latest_crl)
+            publish(rpki.publication.manifest_elt, ca_detail.manifest_uri, ca_detail.latest_manifest)
+            for c in ca_detail.child_certs:
+              publish(rpki.publication.certificate_elt, c.uri, c.cert)
+            for r in ca_detail.roas:
+              if r.roa is not None:
+                publish(rpki.publication.roa_elt, r.uri, r.roa)
+            for g in ca_detail.ghostbusters:
+              publish(rpki.publication.ghostbuster_elt, g.uri, g.ghostbuster)
+        logger.debug("Republishing %d objects for parent %s", len(q_msg), parent.parent_handle)
+        parent.repository.call_pubd(iterator, eb, q_msg)
+
+      def list_failed(e):
+        if not listing[0]:
+          return eb(e)
+        logger.warning("Couldn't list objects published for parent %s, republishing everything: %s",
+                       parent.parent_handle, e)
+        listed({})
+
+      parent.repository.list_published(listed, list_failed)
 
     rpki.async.iterator(self.parents, loop, cb)
 
@@ -520,6 +564,24 @@ class repository_elt(data_elt):
     """
     pdu.raise_if_error()
 
+  def list_published(self, callback, errback):
+    """
+    Ask pubd what we have published there, and call callback with a
+    dict mapping each URI to the SHA-256 hash (in hex) of the object
+    published at that URI.
+    """
+
+    published = {}
+
+    def handler(r_pdu):
+      if isinstance(r_pdu, rpki.publication.list_elt):
+        published[r_pdu.uri] = str(r_pdu.hash).lower()
+      else:
+        r_pdu.raise_if_error()
+
+    q_msg = rpki.publication.msg.query(rpki.publication.list_elt.make_list(tag = "list"))
+    self.call_pubd(lambda: callback(published), errback, q_msg, handlers = { "list" : handler })
+
   def call_pubd(self, callback, errback, q_msg, handlers = None):
     """
     Send a message to publication daemon and return the response.
@@ -544,24 +606,36 @@ class repository_elt(data_elt):
         handlers = {}
 
       for q_pdu in q_msg:
-        logger.info("Sending %s %s to pubd", q_pdu.action, q_pdu.uri)
+        if isinstance(q_pdu, rpki.publication.list_elt):
+          logger.info("Sending %s to pubd", q_pdu.action)
+        else:
+          logger.info("Sending %s %s to pubd", q_pdu.action, q_pdu.uri)
 
       bsc = self.bsc
-      q_der = rpki.publication.cms_msg().wrap(q_msg, bsc.private_key_id, bsc.signing_cert, bsc.signing_cert_crl)
       bpki_ta_path = (self.gctx.bpki_ta, self.self.bpki_cert, self.self.bpki_glue, self.bpki_cert, self.bpki_glue)
 
       def done(r_der):
         try:
           logger.debug("Received response from pubd")
           r_cms = rpki.publication.cms_msg(DER = r_der)
-          r_msg = r_cms.unwrap(bpki_ta_path)
+          r_cms.unwrap_async(bpki_ta_path, lambda r_msg: unwrapped(r_cms, r_msg), errback,
+                             order = self.peer_contact_uri)
+        except (rpki.async.ExitNow, SystemExit):
+          raise
+        except Exception, e:
+          errback(e)
+
+      def unwrapped(r_cms, r_msg):
+        try:
           r_cms.check_replay_sql(self, self.peer_contact_uri)
           for r_pdu in r_msg:
             handler = handlers.get(r_pdu.tag, self.default_pubd_handler)
             if handler:
               logger.debug("Calling pubd handler %r", handler)
               handler(r_pdu)
-          if len(q_msg) != len(r_msg):
+          # <list/> queries get one reply per published object.
+          if (sum(not isinstance(q_pdu, rpki.publication.list_elt) for q_pdu in q_msg) !=
+              sum(not isinstance(r_pdu, rpki.publication.list_elt) for r_pdu in r_msg)):
             raise rpki.exceptions.BadPublicationReply("Wrong number of response PDUs from pubd: sent %r, got %r" % (q_msg, r_msg))
           callback()
         except (rpki.async.ExitNow, SystemExit):
@@ -569,12 +643,17 @@ class repository_elt(data_elt):
         except Exception, e:
           errback(e)
 
-      logger.debug("Sending request to pubd")
-      rpki.http.client(
-        url          = self.peer_contact_uri,
-        msg          = q_der,
-        callback     = done,
-        errback      = errback)
+      def wrapped(q_der):
+        logger.debug("Sending request to pubd")
+        rpki.http.client(
+          url          = self.peer_contact_uri,
+          msg          = q_der,
+          callback     = done,
+          errback      = errback)
+
+      rpki.publication.cms_msg().wrap_async(q_msg, bsc.private_key_id, bsc.signing_cert,
+                                            bsc.signing_cert_crl, wrapped, errback,
+                                            order = self.peer_contact_uri)
 
     except (rpki.async.ExitNow, SystemExit):
       raise
@@ -631,7 +710,7 @@ class parent_elt(data_elt):
     """
     Fetch all CA objects that link to this parent object.
     """
-    return rpki.rpkid.ca_obj.sql_fetch_where(self.gctx, "parent_id = %s", (self.parent_id,))
+    return rpki.rpkid.ca_obj.sql_fetch_indexed(self.gctx, "parent_id", self.parent_id)
 
   def serve_post_save_hook(self, q_pdu, r_pdu, cb, eb):
     """
@@ -799,18 +878,23 @@ class parent_elt(data_elt):
       sender = self.sender_name,
       recipient = self.recipient_name)
 
-    q_der = rpki.up_down.cms_msg().wrap(q_msg, bsc.private_key_id,
-                                        bsc.signing_cert,
-                                        bsc.signing_cert_crl)
-
     def unwrap(r_der):
       try:
         r_cms = rpki.up_down.cms_msg(DER = r_der)
-        r_msg = r_cms.unwrap((self.gctx.bpki_ta,
-                              self.self.bpki_cert,
-                              self.self.bpki_glue,
-                              self.bpki_cms_cert,
-                              self.bpki_cms_glue))
+        r_cms.unwrap_async((self.gctx.bpki_ta,
+                            self.self.bpki_cert,
+                            self.self.bpki_glue,
+                            self.bpki_cms_cert,
+                            self.bpki_cms_glue),
+                           lambda r_msg: unwrapped(r_cms, r_msg), eb,
+                           order = self.peer_contact_uri)
+      except (SystemExit, rpki.async.ExitNow):
+        raise
+      except Exception, e:
+        eb(e)
+
+    def unwrapped(r_cms, r_msg):
+      try:
         r_cms.check_replay_sql(self, self.peer_contact_uri)
         r_msg.payload.check_response()
       except (SystemExit, rpki.async.ExitNow):
@@ -820,12 +904,19 @@ class parent_elt(data_elt):
       else:
         cb(r_msg)
 
-    rpki.http.client(
-      msg          = q_der,
-      url          = self.peer_contact_uri,
-      callback     = unwrap,
-      errback      = eb,
-      content_type = rpki.up_down.content_type)
+    def wrapped(q_der):
+      rpki.http.client(
+        msg          = q_der,
+        url          = self.peer_contact_uri,
+        callback     = unwrap,
+        errback      = eb,
+        content_type = rpki.up_down.content_type)
+
+    rpki.up_down.cms_msg().wrap_async(q_msg, bsc.private_key_id,
+                                      bsc.signing_cert,
+                                      bsc.signing_cert_crl,
+                                      wrapped, eb,
+                                      order = self.peer_contact_uri)
 
 class child_elt(data_elt):
   """
@@ -933,7 +1024,7 @@ class child_elt(data_elt):
                         generate_crl_and_manifest = True)
     publisher.call_pubd(cb, eb)
 
-  def serve_up_down(self, query, callback):
+  def serve_up_down(self, query, callback, errback):
     """
     Outer layer of server handling for one up-down PDU from this child.
     """
@@ -941,17 +1032,29 @@ class child_elt(data_elt):
     bsc = self.bsc
     if bsc is None:
       raise rpki.exceptions.BSCNotFound("Could not find BSC %s" % self.bsc_id)
-    q_cms = rpki.up_down.cms_msg(DER = query)
-    q_msg = q_cms.unwrap((self.gctx.bpki_ta,
-                          self.self.bpki_cert,
-                          self.self.bpki_glue,
-                          self.bpki_cert,
-                          self.bpki_glue))
-    q_cms.check_replay_sql(self, "child", self.child_handle)
-    q_msg.payload.gctx = self.gctx
-    if enforce_strict_up_down_xml_sender and q_msg.sender != self.child_handle:
-      raise rpki.exceptions.BadSender("Unexpected XML sender %s" % q_msg.sender)
-    self.gctx.sql.sweep()
+
+    def unwrapped(q_msg):
+      try:
+        q_cms.check_replay_sql(self, "child", self.child_handle)
+        q_msg.payload.gctx = self.gctx
+        if enforce_strict_up_down_xml_sender and q_msg.sender != self.child_handle:
+          raise rpki.exceptions.BadSender("Unexpected XML sender %s" % q_msg.sender)
+        self.gctx.sql.sweep()
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        errback(e)
+        return
+
+      try:
+        q_msg.serve_top_level(self, done)
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except rpki.exceptions.NoActiveCA, data:
+        done(q_msg.serve_error(data))
+      except Exception, e:
+        logger.exception("Unhandled exception serving up-down request from %r", self)
+        done(q_msg.serve_error(e))
 
     def done(r_msg):
       #
@@ -959,19 +1062,19 @@ class child_elt(data_elt):
       # sane way of reporting errors in the error reporting mechanism.
       # May require refactoring, ignore the issue for now.
       #
-      reply = rpki.up_down.cms_msg().wrap(r_msg, bsc.private_key_id,
-                                          bsc.signing_cert, bsc.signing_cert_crl)
-      callback(reply)
+      rpki.up_down.cms_msg().wrap_async(r_msg, bsc.private_key_id,
+                                        bsc.signing_cert, bsc.signing_cert_crl,
+                                        callback, errback,
+                                        order = ("child", self.child_id))
 
-    try:
-      q_msg.serve_top_level(self, done)
-    except (rpki.async.ExitNow, SystemExit):
-      raise
-    except rpki.exceptions.NoActiveCA, data:
-      done(q_msg.serve_error(data))
-    except Exception, e:
-      logger.exception("Unhandled exception serving up-down request from %r", self)
-      done(q_msg.serve_error(e))
+    q_cms = rpki.up_down.cms_msg(DER = query)
+    q_cms.unwrap_async((self.gctx.bpki_ta,
+                        self.self.bpki_cert,
+                        self.self.bpki_glue,
+                        self.bpki_cert,
+                        self.bpki_glue),
+                       unwrapped, errback,
+                       order = ("child", self.child_id))
 
 class list_resources_elt(rpki.xml_utils.base_elt, left_right_namespace):
   """
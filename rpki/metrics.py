@@ -0,0 +1,247 @@
+# $Id$
+#
+# Copyright (C) 2015  Dragon Research Labs ("DRL")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND DRL DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL DRL BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+In-process metrics: counters, gauges and latency histograms, rendered
+in the Prometheus text exposition format.
+
+Metrics are created at import time by the modules that update them,
+and register themselves in a single module-level registry, so that
+whatever serves the metrics doesn't need to know where they came from.
+Updating a metric is a dictionary lookup and some arithmetic, cheap
+enough to leave on all the time.
+
+Worker processes (rpki.workers) set forward to a list, which turns
+updates into records that the worker ships back to the main process
+along with each job result, for replay() there.
+"""
+
+import logging
+import rpki.async
+
+logger = logging.getLogger(__name__)
+
+## @var registry
+# All metrics, by name.
+
+registry = {}
+
+## @var forward
+# If not None, a list to which updates are appended instead of being
+# applied locally.  Set in worker processes.
+
+forward = None
+
+## @var latency_buckets
+# Default histogram buckets, in seconds.
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+## @var size_buckets
+# Histogram buckets for counts of things (queue sizes and the like).
+
+size_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+## @var now
+# Clock for measuring durations: the monotonic clock from rpki.async,
+# so that wall clock adjustments don't corrupt our measurements.
+
+now = rpki.async.monotonic
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra = ()):
+  pairs = zip(names, values) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join("%s=\"%s\"" % (n, _escape(v)) for n, v in pairs) + "}"
+
+def _format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+    return str(int(value))
+  return repr(value)
+
+class metric(object):
+  """
+  Abstract base class for metrics.  Each metric has a name, a help
+  string, and a tuple of label names; values are kept per tuple of
+  label values, which callers pass as the labels argument.
+  """
+
+  kind = None
+
+  def __init__(self, name, help, labels = ()):    # pylint: disable=W0622
+    if name in registry:
+      raise ValueError("Duplicate metric name %s" % name)
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    registry[name] = self
+
+  def _check(self, labels):
+    labels = tuple(labels)
+    if len(labels) != len(self.labels):
+      raise ValueError("Metric %s takes labels %r, got %r" % (self.name, self.labels, labels))
+    return labels
+
+  def apply(self, labels, value):
+    raise NotImplementedError
+
+  def update(self, labels, value):
+    """
+    Record an update, or queue it for forwarding if we're in a worker
+    process.
+    """
+    labels = self._check(labels)
+    if forward is None:
+      self.apply(labels, value)
+    else:
+      forward.append((self.name, labels, value))
+
+  def samples(self):
+    """
+    Generate (suffix, label text, value) tuples for rendering.
+    """
+    for labels in sorted(self.values):
+      yield "", _format_labels(self.labels, labels), self.values[labels]
+
+  def render(self):
+    lines = ["# HELP %s %s" % (self.name, self.help.replace("\\", "\\\\").replace("\n", "\\n")),
+             "# TYPE %s %s" % (self.name, self.kind)]
+    for suffix, labels, value in self.samples():
+      lines.append("%s%s%s %s" % (self.name, suffix, labels, _format_value(value)))
+    return lines
+
+class counter(metric):
+  """
+  Monotonically increasing count.
+  """
+
+  kind = "counter"
+
+  def inc(self, labels = (), amount = 1):
+    self.update(labels, amount)
+
+  def apply(self, labels, value):
+    self.values[labels] = self.values.get(labels, 0) + value
+
+class gauge(metric):
+  """
+  Value which can go up and down.  If func is given, it's called at
+  render time and should return either a number (if the gauge has no
+  labels) or a dictionary mapping label value tuples to numbers.
+  """
+
+  kind = "gauge"
+
+  def __init__(self, name, help, labels = (), func = None):    # pylint: disable=W0622
+    metric.__init__(self, name, help, labels)
+    self.func = func
+
+  def set(self, value, labels = ()):
+    self.update(labels, value)
+
+  def apply(self, labels, value):
+    self.values[labels] = value
+
+  def samples(self):
+    if self.func is not None:
+      try:
+        value = self.func()
+      except Exception:
+        logger.exception("Couldn't compute value of gauge %s", self.name)
+        return
+      if isinstance(value, dict):
+        self.values = dict((self._check(k), v) for k, v in value.iteritems())
+      else:
+        self.values = { () : value }
+    for sample in metric.samples(self):
+      yield sample
+
+class histogram(metric):
+  """
+  Distribution of observed values, usually latencies in seconds.
+  Bucket counts are kept non-cumulative and added up at render time.
+  """
+
+  kind = "histogram"
+
+  def __init__(self, name, help, labels = (), buckets = latency_buckets):    # pylint: disable=W0622
+    metric.__init__(self, name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, labels = ()):
+    self.update(labels, value)
+
+  def since(self, started, labels = ()):
+    """
+    Observe the time elapsed since started, a value from now().
+    """
+    self.update(labels, now() - started)
+
+  def apply(self, labels, value):
+    data = self.values.get(labels)
+    if data is None:
+      data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+    counts = data[0]
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        counts[i] += 1
+        break
+    else:
+      counts[-1] += 1
+    data[1] += value
+    data[2] += 1
+
+  def samples(self):
+    for labels in sorted(self.values):
+      counts, total, count = self.values[labels]
+      running = 0
+      for bound, n in zip(self.buckets + (float("inf"),), counts):
+        running += n
+        yield "_bucket", _format_labels(self.labels, labels, (("le", _format_value(float(bound))),)), running
+      yield "_sum", _format_labels(self.labels, labels), total
+      yield "_count", _format_labels(self.labels, labels), count
+
+def replay(updates):
+  """
+  Apply updates forwarded from a worker process.
+  """
+  for name, labels, value in updates:
+    m = registry.get(name)
+    if m is None:
+      logger.warning("Dropping forwarded update for unknown metric %s", name)
+    else:
+      m.apply(labels, value)
+
+def render():
+  """
+  Return all metrics in the Prometheus text exposition format.
+  """
+  lines = []
+  for name in sorted(registry):
+    lines.extend(registry[name].render())
+  lines.append("")
+  return "\n".join(lines)
+
+## @var content_type
+# Content-Type for the output of render().
+
+content_type = "text/plain; version=0.0.4"
@@ -36,6 +36,7 @@ import rpki.exceptions
 import rpki.relaxng
 import rpki.log
 import rpki.publication
+import rpki.rrdp
 import rpki.daemonize
 
 logger = logging.getLogger(__name__)
@@ -104,6 +105,28 @@ class main(object):
 
     self.publication_multimodule = self.cfg.getboolean("publication-multimodule", False)
 
+    self.publication_staging = self.cfg.get("publication-staging-directory",
+                                            self.publication_base.rstrip("/") + ".staging")
+    self.publication_fsync = self.cfg.getboolean("publication-fsync", True)
+    self.publication_fsync_objects = self.cfg.getboolean("publication-fsync-objects", False)
+    rpki.publication.commit_engine.cleanup(self.publication_staging)
+
+    self.published = rpki.publication.published_object.load_index(self)
+    logger.debug("Loaded index of %d published objects", len(self.published))
+
+    self.rrdp = None
+    rrdp_base = self.cfg.get("rrdp-publication-base", "")
+    if rrdp_base:
+      self.rrdp = rpki.rrdp.repository(
+        publication_base = self.publication_base,
+        rsync_base_uri   = self.cfg.get("rrdp-rsync-base-uri"),
+        rrdp_base        = rrdp_base,
+        rrdp_base_uri    = self.cfg.get("rrdp-base-uri"),
+        state_file       = self.cfg.get("rrdp-state-file", rrdp_base.rstrip("/") + ".state"),
+        update_interval  = self.cfg.getint("rrdp-update-interval", 60),
+        max_deltas       = self.cfg.getint("rrdp-max-deltas", 50),
+        fsync            = self.publication_fsync)
+
     rpki.http.server(
       host     = self.http_server_host,
       port     = self.http_server_port,
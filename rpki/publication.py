@@ -34,7 +34,10 @@ RPKI "publication" protocol.
 
 import os
 import errno
+import shutil
 import logging
+import tempfile
+import collections
 import rpki.resource_set
 import rpki.x509
 import rpki.sql
@@ -188,6 +191,67 @@ class client_elt(control_elt):
     if not uri.startswith(self.base_uri):
       raise rpki.exceptions.ForbiddenURI
 
+  def sql_delete_hook(self):
+    """
+    Forget this client's published objects.  SQL deletes their rows
+    for us, but we have to drop them from the in-memory index.
+    """
+    for uri, obj in self.gctx.published.items():
+      if obj.client_id == self.client_id:
+        del self.gctx.published[uri]
+        obj.sql_mark_clean()
+
+def uri_to_filename(gctx, uri):
+  """
+  Convert a URI to a local filename in gctx's publication tree.
+  """
+  if not uri.startswith("rsync://"):
+    raise rpki.exceptions.BadURISyntax(uri)
+  path = uri.split("/")[3:]
+  if not gctx.publication_multimodule:
+    del path[0]
+  path.insert(0, gctx.publication_base.rstrip("/"))
+  filename = "/".join(path)
+  if "/../" in filename or filename.endswith("/.."):
+    raise rpki.exceptions.BadURISyntax(filename)
+  return filename
+
+class published_object(rpki.sql.sql_persistent):
+  """
+  Index entry for one published object: its URI, the SHA-256 hash and
+  size of its DER, and the client that published it.  pubd loads all
+  of these at startup into gctx.published, keyed by URI, and keeps
+  them up to date as it commits changes to the publication tree.
+  """
+
+  sql_template = rpki.sql.template(
+    "published_object",
+    "published_object_id",
+    "uri",
+    "hash",
+    "size",
+    "client_id")
+
+  def __init__(self, gctx = None, uri = None, hash = None, size = None, client_id = None): # pylint: disable=W0622
+    rpki.sql.sql_persistent.__init__(self)
+    self.gctx = gctx
+    self.uri = uri
+    self.hash = hash
+    self.size = size
+    self.client_id = client_id
+    if uri or hash or size or client_id:
+      self.sql_mark_dirty()
+
+  def __repr__(self):
+    return rpki.log.log_repr(self, self.uri, self.hash)
+
+  @classmethod
+  def load_index(cls, gctx):
+    """
+    Load the index of published objects.
+    """
+    return dict((obj.uri, obj) for obj in cls.sql_fetch_all(gctx))
+
 class publication_object_elt(rpki.xml_utils.base_elt, publication_namespace):
   """
   Virtual class for publishable objects.  These have very similar
@@ -248,56 +312,26 @@ class publication_object_elt(rpki.xml_utils.base_elt, publication_namespace):
 
   def serve_publish(self):
     """
-    Publish an object.
+    Publish an object.  This just stages the object, our
+    commit_engine installs it once we've processed the whole message.
     """
     logger.info("Publishing %s", self.payload.tracking_data(self.uri))
-    filename = self.uri_to_filename()
-    filename_tmp = filename + ".tmp"
-    dirname = os.path.dirname(filename)
-    if not os.path.isdir(dirname):
-      os.makedirs(dirname)
-    f = open(filename_tmp, "wb")
-    f.write(self.payload.get_DER())
-    f.close()
-    os.rename(filename_tmp, filename)
+    self.commit.publish(self.uri, self.uri_to_filename(), self.payload.get_DER())
 
   def serve_withdraw(self):
     """
-    Withdraw an object, then recursively delete empty directories.
+    Withdraw an object.  As with publication, the actual removal (and
+    cleanup of empty directories) happens when we commit the message.
     """
     logger.info("Withdrawing %s", self.uri)
-    filename = self.uri_to_filename()
-    try:
-      os.remove(filename)
-    except OSError, e:
-      if e.errno == errno.ENOENT:
-        raise rpki.exceptions.NoObjectAtURI("No object published at %s" % self.uri)
-      else:
-        raise
-    min_path_len = len(self.gctx.publication_base.rstrip("/"))
-    dirname = os.path.dirname(filename)
-    while len(dirname) > min_path_len:
-      try:
-        os.rmdir(dirname)
-      except OSError:
-        break
-      else:
-        dirname = os.path.dirname(dirname)
+    if not self.commit.withdraw(self.uri, self.uri_to_filename()):
+      raise rpki.exceptions.NoObjectAtURI("No object published at %s" % self.uri)
 
   def uri_to_filename(self):
     """
     Convert a URI to a local filename.
     """
-    if not self.uri.startswith("rsync://"):
-      raise rpki.exceptions.BadURISyntax(self.uri)
-    path = self.uri.split("/")[3:]
-    if not self.gctx.publication_multimodule:
-      del path[0]
-    path.insert(0, self.gctx.publication_base.rstrip("/"))
-    filename = "/".join(path)
-    if "/../" in filename or filename.endswith("/.."):
-      raise rpki.exceptions.BadURISyntax(filename)
-    return filename
+    return uri_to_filename(self.gctx, self.uri)
 
   @classmethod
   def make_publish(cls, uri, obj, tag = None):
@@ -365,6 +399,59 @@ publication_object_elt.obj2elt = dict(
   (e.payload_type, e) for e in
   (certificate_elt, crl_elt, manifest_elt, roa_elt, ghostbuster_elt))
 
+class list_elt(rpki.xml_utils.base_elt, publication_namespace):
+  """
+  <list/> element.  The reply is one <list/> element per object the
+  client has published, with its URI and the SHA-256 hash of its DER,
+  so the client can work out what it needs to publish or withdraw
+  rather than republishing everything.
+  """
+
+  element_name = "list"
+  attributes = ("tag", "uri", "hash")
+
+  ## @var action
+  # Not part of the protocol, which doesn't need one for this element,
+  # but lets <list/> PDUs be logged like all the others.
+  action = "list"
+
+  uri = None
+  hash = None
+
+  def serve_dispatch(self, r_msg, cb, eb):
+    """
+    Action dispatch handler.  We list what's in the index, so this
+    doesn't reflect changes made earlier in the same message.
+
+    Index entries whose file has vanished from the publication tree
+    are left out, so that the client republishes them rather than
+    trusting an index that no longer matches what rsync serves.
+    """
+    try:
+      if self.client is None:
+        raise rpki.exceptions.BadQuery("Client query received on control channel")
+      for uri in sorted(uri for uri, obj in self.gctx.published.iteritems()
+                        if obj.client_id == self.client.client_id):
+        if not os.path.exists(uri_to_filename(self.gctx, uri)):
+          logger.warning("%s is in the index but missing from the publication tree", uri)
+          continue
+        r_msg.append(self.make_pdu(tag = self.tag, uri = uri, hash = self.gctx.published[uri].hash))
+      cb()
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except Exception, e:
+      eb(e)
+
+  @classmethod
+  def make_list(cls, tag = None):
+    """
+    Construct a list query PDU.
+    """
+    return cls.make_pdu(tag = tag)
+
+  def raise_if_error(self):
+    pass
+
 class report_error_elt(rpki.xml_utils.text_elt, publication_namespace):
   """
   <report_error/> element.
@@ -406,6 +493,225 @@ class report_error_elt(rpki.xml_utils.text_elt, publication_namespace):
     else:
       raise rpki.exceptions.BadPublicationReply("Unexpected response from pubd: %s" % self)
 
+class commit_engine(object):
+  """
+  Apply the publish and withdraw operations in one publication
+  message to the filesystem as a batch.
+
+  Published objects are written to a staging directory as we process
+  the message, and only renamed into place once we've processed all
+  of it, then directories we changed are fsync()ed once each.  So an
+  rsync client sees all of a message's changes within the few
+  milliseconds it takes to do the renames, rather than spread over the
+  whole time it takes us to process the message.
+
+  Staged objects themselves are only fsync()ed if
+  publication-fsync-objects is set: that costs a disk flush per object,
+  which dominates publication time for large messages, and most
+  filesystems already order a rename() that replaces a file after the
+  data written to it.
+
+  The staging directory has to be on the same filesystem as the
+  publication tree, for rename() to work.  If it isn't, we fall back
+  to writing a temporary file next to each object, as we always used
+  to do.
+
+  We keep gctx.published, the index of published objects, in step
+  with what we commit, and skip publishing objects identical to what's
+  already there.  If RRDP is enabled, we also tell gctx.rrdp about
+  each change once it's on disk.
+  """
+
+  def __init__(self, gctx, client):
+    self.gctx = gctx
+    self.client = client
+    self.base = gctx.publication_base.rstrip("/")
+    self.staging_root = gctx.publication_staging
+    self.fsync = gctx.publication_fsync
+    self.fsync_objects = gctx.publication_fsync_objects
+    self.rrdp = gctx.rrdp
+    self.staging = None
+    self.staged_count = 0
+    self.pending = collections.OrderedDict()    # filename -> staged filename, or None to withdraw
+    self.dirs = set()                           # directories known to exist
+    self.changes = {}                           # filename -> (uri, SHA-256 hex digest or None, size)
+
+  @staticmethod
+  def cleanup(staging_root):
+    """
+    Remove anything left in the staging directory by a previous run.
+    """
+    if os.path.isdir(staging_root):
+      for name in os.listdir(staging_root):
+        logger.warning("Removing stale publication staging directory %s", name)
+        shutil.rmtree(os.path.join(staging_root, name), ignore_errors = True)
+
+  def _write(self, filename, data):
+    f = open(filename, "wb")
+    try:
+      f.write(data)
+      if self.fsync_objects:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+      f.close()
+
+  def _unstage(self, filename):
+    staged = self.pending.pop(filename, None)
+    if staged is not None:
+      os.remove(staged)
+
+  def publish(self, uri, filename, data):
+    """
+    Stage an object for publication, unless it's identical to the
+    object already published there.  Returns False if it is.
+    """
+    digest = rpki.x509.sha256(data).encode("hex")
+    obj = self.gctx.published.get(uri)
+    if (filename not in self.pending and obj is not None and obj.hash == digest and
+        obj.client_id == self.client.client_id and os.path.exists(filename)):
+      logger.debug("%s unchanged, not rewriting it", uri)
+      return False
+    if self.staging is None:
+      if not os.path.isdir(self.staging_root):
+        os.makedirs(self.staging_root)
+      self.staging = tempfile.mkdtemp(dir = self.staging_root)
+    self._unstage(filename)
+    self.staged_count += 1
+    staged = os.path.join(self.staging, str(self.staged_count))
+    self._write(staged, data)
+    self.pending[filename] = staged
+    self.changes[filename] = (uri, digest, len(data))
+    return True
+
+  def withdraw(self, uri, filename):
+    """
+    Stage withdrawal of an object.  Returns False if there's no such
+    object, either on disk or staged by this message.
+    """
+    staged = self.pending.get(filename, False)
+    if staged is None:
+      return False
+    on_disk = os.path.exists(filename)
+    if staged is False and not on_disk:
+      return False
+    self._unstage(filename)
+    if on_disk:
+      self.pending[filename] = None
+    self.changes[filename] = (uri, None, 0)
+    return True
+
+  def _makedirs(self, dirname, touched):
+    if dirname in self.dirs:
+      return
+    if not os.path.isdir(dirname):
+      parent = os.path.dirname(dirname)
+      if len(parent) > len(self.base):
+        self._makedirs(parent, touched)
+      os.mkdir(dirname)
+      touched.add(os.path.dirname(dirname))
+    self.dirs.add(dirname)
+
+  def _install(self, staged, filename):
+    try:
+      os.rename(staged, filename)
+    except OSError, e:
+      if e.errno != errno.EXDEV:
+        raise
+      f = open(staged, "rb")
+      data = f.read()
+      f.close()
+      os.remove(staged)
+      self._write(filename + ".tmp", data)
+      os.rename(filename + ".tmp", filename)
+
+  def commit(self):
+    """
+    Install everything we've staged, remove everything we've been
+    asked to withdraw, clean up directories we've emptied, and make it
+    all durable.
+    """
+    if not self.pending:
+      self.abort()
+      return
+    touched = set()
+    emptied = set()
+    try:
+      for filename, staged in self.pending.iteritems():
+        dirname = os.path.dirname(filename)
+        if staged is not None:
+          self._makedirs(dirname, touched)
+          self._install(staged, filename)
+        else:
+          try:
+            os.remove(filename)
+          except OSError, e:
+            if e.errno != errno.ENOENT:
+              raise
+          emptied.add(dirname)
+        touched.add(dirname)
+        self._index(filename)
+      for dirname in sorted(emptied, key = len, reverse = True):
+        while len(dirname) > len(self.base):
+          try:
+            os.rmdir(dirname)
+          except OSError:
+            break
+          touched.discard(dirname)
+          self.dirs.discard(dirname)
+          dirname = os.path.dirname(dirname)
+          touched.add(dirname)
+      if self.fsync:
+        for dirname in touched:
+          try:
+            fd = os.open(dirname, os.O_RDONLY)
+          except OSError:
+            continue
+          try:
+            os.fsync(fd)
+          finally:
+            os.close(fd)
+    finally:
+      self.pending.clear()
+      self.abort()
+
+  def _index(self, filename):
+    """
+    Update the index, and RRDP if enabled, for a change we've just
+    committed to disk.
+    """
+    uri, digest, size = self.changes[filename]
+    obj = self.gctx.published.get(uri)
+    if digest is None:
+      if obj is not None:
+        del self.gctx.published[uri]
+        obj.sql_mark_deleted()
+    elif obj is None:
+      self.gctx.published[uri] = published_object(self.gctx, uri, digest, size, self.client.client_id)
+    else:
+      obj.hash = digest
+      obj.size = size
+      obj.client_id = self.client.client_id
+      obj.sql_mark_dirty()
+    if self.rrdp is not None:
+      self.rrdp.record(uri, filename, digest)
+
+  def abort(self):
+    """
+    Discard anything still staged.
+    """
+    for staged in self.pending.itervalues():
+      if staged is not None:
+        try:
+          os.remove(staged)
+        except OSError:
+          pass
+    self.pending.clear()
+    self.changes.clear()
+    if self.staging is not None:
+      shutil.rmtree(self.staging, ignore_errors = True)
+      self.staging = None
+
 class msg(rpki.xml_utils.msg, publication_namespace):
   """
   Publication PDU.
@@ -418,7 +724,8 @@ class msg(rpki.xml_utils.msg, publication_namespace):
   ## @var pdus
   # Dispatch table of PDUs for this protocol.
   pdus = dict((x.element_name, x) for x in
-              (config_elt, client_elt, certificate_elt, crl_elt, manifest_elt, roa_elt, ghostbuster_elt, report_error_elt))
+              (config_elt, client_elt, certificate_elt, crl_elt, manifest_elt, roa_elt, ghostbuster_elt,
+               list_elt, report_error_elt))
 
   def serve_top_level(self, gctx, client, cb):
     """
@@ -427,6 +734,18 @@ class msg(rpki.xml_utils.msg, publication_namespace):
     if not self.is_query():
       raise rpki.exceptions.BadQuery("Message type is not query")
     r_msg = self.__class__.reply()
+    commit = commit_engine(gctx, client)
+
+    def finish():
+      try:
+        commit.commit()
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        logger.exception("Couldn't commit publication changes to disk")
+        del r_msg[:]
+        r_msg.append(report_error_elt.from_exception(e))
+      cb(r_msg)
 
     def loop(iterator, q_pdu):
 
@@ -434,11 +753,12 @@ class msg(rpki.xml_utils.msg, publication_namespace):
         if not isinstance(e, rpki.exceptions.NotFound):
           logger.exception("Exception processing PDU %r", q_pdu)
         r_msg.append(report_error_elt.from_exception(e, q_pdu.tag))
-        cb(r_msg)
+        finish()
 
       try:
         q_pdu.gctx = gctx
         q_pdu.client = client
+        q_pdu.commit = commit
         q_pdu.serve_dispatch(r_msg, iterator, fail)
       except (rpki.async.ExitNow, SystemExit):
         raise
@@ -446,7 +766,7 @@ class msg(rpki.xml_utils.msg, publication_namespace):
         fail(e)
 
     def done():
-      cb(r_msg)
+      finish()
 
     rpki.async.iterator(self, loop, done)
 
@@ -1548,6 +1548,7 @@ publication = RelaxNGParser(r'''<?xml version="1.0" encoding="UTF-8"?>
       <ref name="manifest_query"/>
       <ref name="roa_query"/>
       <ref name="ghostbuster_query"/>
+      <ref name="list_query"/>
     </choice>
   </define>
   <!-- PDUs allowed in a reply -->
@@ -1560,6 +1561,7 @@ publication = RelaxNGParser(r'''<?xml version="1.0" encoding="UTF-8"?>
       <ref name="manifest_reply"/>
       <ref name="roa_reply"/>
       <ref name="ghostbuster_reply"/>
+      <ref name="list_reply"/>
       <ref name="report_error_reply"/>
     </choice>
   </define>
@@ -2031,6 +2033,30 @@ publication = RelaxNGParser(r'''<?xml version="1.0" encoding="UTF-8"?>
       <ref name="uri"/>
     </element>
   </define>
+  <!-- <list/> element -->
+  <define name="hash">
+    <attribute name="hash">
+      <data type="string">
+        <param name="pattern">[0-9a-fA-F]+</param>
+      </data>
+    </attribute>
+  </define>
+  <define name="list_query">
+    <element name="list">
+      <optional>
+        <ref name="tag"/>
+      </optional>
+    </element>
+  </define>
+  <define name="list_reply">
+    <element name="list">
+      <optional>
+        <ref name="tag"/>
+      </optional>
+      <ref name="uri"/>
+      <ref name="hash"/>
+    </element>
+  </define>
   <!-- <report_error/> element -->
   <define name="error">
     <data type="token">
@@ -24,10 +24,13 @@ RPKI CA engine.
 import os
 import re
 import time
+import heapq
 import random
 import base64
 import logging
 import argparse
+import itertools
+import collections
 import rpki.resource_set
 import rpki.up_down
 import rpki.left_right
@@ -39,11 +42,23 @@ import rpki.exceptions
 import rpki.relaxng
 import rpki.log
 import rpki.async
+import rpki.workers
+import rpki.metrics
 import rpki.daemonize
 import rpki.rpkid_tasks
 
 logger = logging.getLogger(__name__)
 
+task_seconds      = rpki.metrics.histogram("rpkid_task_seconds",
+                                           "Time from a task starting to its finishing, including time postponed, by task.",
+                                           ("task",))
+task_wait_seconds = rpki.metrics.histogram("rpkid_task_wait_seconds",
+                                           "Time a task spent queued waiting to run, by task.",
+                                           ("task",))
+publication_pdus  = rpki.metrics.histogram("rpkid_publication_queue_pdus",
+                                           "Number of publication PDUs sent to pubd per publication_queue flush.",
+                                           buckets = rpki.metrics.size_buckets)
+
 class main(object):
   """
   Main program for rpkid.
@@ -56,8 +71,13 @@ class main(object):
 
     self.irdbd_cms_timestamp = None
     self.irbe_cms_timestamp = None
-    self.task_current = None
     self.task_queue = []
+    self.task_queues = {}
+    self.task_queued = set()
+    self.task_running = {}
+    self.task_sequence = itertools.count()
+    self.manifest_hashes = {}
+    self.crl_entries = {}
 
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument("-c", "--config",
@@ -139,14 +159,32 @@ class main(object):
       self.cron_keepalive = self.cron_period * 4
     self.cron_timeout = None
 
+    self.task_concurrency = self.cfg.getint("task-concurrency", 1)
+
+    self.keypairs = keypair_pool(high_water = self.cfg.getint("keypair-pool-size", 50),
+                                 low_water  = self.cfg.getint("keypair-pool-low-water", 10))
+    self.keypairs.refill()
+
+    rpki.metrics.gauge("rpkid_task_queue_length", "Number of tasks waiting to run.",
+                       func = lambda: len(self.task_queued))
+    rpki.metrics.gauge("rpkid_tasks_running", "Number of tasks running or postponed mid-run.",
+                       func = lambda: len(self.task_running))
+    rpki.metrics.gauge("rpkid_keypair_pool_size", "Number of pre-generated keypairs available.",
+                       func = lambda: len(self.keypairs.keypairs))
+
     self.start_cron()
 
+    handlers = [("/left-right", self.left_right_handler),
+                ("/up-down/",   self.up_down_handler, rpki.up_down.allowed_content_types),
+                ("/cronjob",    self.cronjob_handler)]
+
+    if self.cfg.getboolean("enable-metrics", False):
+      handlers.append(("/metrics", self.metrics_handler, None))
+
     rpki.http.server(
       host     = self.http_server_host,
       port     = self.http_server_port,
-      handlers = (("/left-right", self.left_right_handler),
-                  ("/up-down/",   self.up_down_handler, rpki.up_down.allowed_content_types),
-                  ("/cronjob",    self.cronjob_handler)))
+      handlers = handlers)
 
   def start_cron(self):
     """
@@ -174,12 +212,17 @@ class main(object):
 
       q_msg = rpki.left_right.msg.query()
       q_msg.extend(q_pdus)
-      q_der = rpki.left_right.cms_msg().wrap(q_msg, self.rpkid_key, self.rpkid_cert)
 
       def unwrap(r_der):
         try:
           r_cms = rpki.left_right.cms_msg(DER = r_der)
-          r_msg = r_cms.unwrap((self.bpki_ta, self.irdb_cert))
+          r_cms.unwrap_async((self.bpki_ta, self.irdb_cert), lambda r_msg: check(r_cms, r_msg), errback,
+                             order = self.irdb_url)
+        except Exception, e:
+          errback(e)
+
+      def check(r_cms, r_msg):
+        try:
           self.irdbd_cms_timestamp = r_cms.check_replay(self.irdbd_cms_timestamp, self.irdb_url)
           if not r_msg.is_reply() or not all(type(r_pdu) in q_types for r_pdu in r_msg):
             raise rpki.exceptions.BadIRDBReply(
@@ -194,11 +237,15 @@ class main(object):
         except Exception, e:
           errback(e)
 
-      rpki.http.client(
-        url          = self.irdb_url,
-        msg          = q_der,
-        callback     = unwrap,
-        errback      = errback)
+      def wrapped(q_der):
+        rpki.http.client(
+          url          = self.irdb_url,
+          msg          = q_der,
+          callback     = unwrap,
+          errback      = errback)
+
+      rpki.left_right.cms_msg().wrap_async(q_msg, self.rpkid_key, self.rpkid_cert, None, wrapped, errback,
+                                           order = self.irdb_url)
 
     except Exception, e:
       errback(e)
@@ -262,18 +309,32 @@ class main(object):
     Process one left-right PDU.
     """
 
+    def unwrapped(q_msg):
+      try:
+        self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, path)
+        if not q_msg.is_query():
+          raise rpki.exceptions.BadQuery("Message type is not query")
+        q_msg.serve_top_level(self, done)
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        logger.exception("Unhandled exception serving left-right request")
+        cb(500, reason = "Unhandled exception %s: %s" % (e.__class__.__name__, e))
+
     def done(r_msg):
-      reply = rpki.left_right.cms_msg().wrap(r_msg, self.rpkid_key, self.rpkid_cert)
+      rpki.left_right.cms_msg().wrap_async(r_msg, self.rpkid_key, self.rpkid_cert, None, wrapped, fail)
+
+    def wrapped(reply):
       self.sql.sweep()
       cb(200, body = reply)
 
+    def fail(e):
+      logger.warning("Could not serve left-right request: %s", e)
+      cb(500, reason = "Unhandled exception %s: %s" % (e.__class__.__name__, e))
+
     try:
       q_cms = rpki.left_right.cms_msg(DER = query)
-      q_msg = q_cms.unwrap((self.bpki_ta, self.irbe_cert))
-      self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, path)
-      if not q_msg.is_query():
-        raise rpki.exceptions.BadQuery("Message type is not query")
-      q_msg.serve_top_level(self, done)
+      q_cms.unwrap_async((self.bpki_ta, self.irbe_cert), unwrapped, fail, order = "left-right")
     except (rpki.async.ExitNow, SystemExit):
       raise
     except Exception, e:
@@ -291,6 +352,10 @@ class main(object):
       self.sql.sweep()
       cb(200, body = reply)
 
+    def fail(e):
+      logger.warning("Could not process up-down request: %s", e)
+      cb(400, reason = "Could not process PDU: %s" % e)
+
     try:
       match = self.up_down_url_regexp.search(path)
       if match is None:
@@ -302,7 +367,7 @@ class main(object):
                                                          "self")
       if child is None:
         raise rpki.exceptions.ChildNotFound("Could not find child %s of self %s in up_down_handler()" % (child_handle, self_handle))
-      child.serve_up_down(query, done)
+      child.serve_up_down(query, done, fail)
     except (rpki.async.ExitNow, SystemExit):
       raise
     except (rpki.exceptions.ChildNotFound, rpki.exceptions.BadContactURL), e:
@@ -323,34 +388,76 @@ class main(object):
   def task_add(self, task):
     """
     Add a task to the scheduler task queue, unless it's already queued.
+
+    Each self has its own first come first served queue of tasks, in
+    self.task_queues.  self.task_queue is a heap of the selves which
+    have tasks queued and none running, ordered by the priority of
+    the task at the head of each self's queue, then by the order in
+    which those tasks were added, so priority decides which self gets
+    to run next but never reorders tasks within one self.
     """
-    if task not in self.task_queue:
+    if task not in self.task_queued:
       logger.debug("Adding %r to task queue", task)
-      self.task_queue.append(task)
+      self.task_queued.add(task)
+      task.queued = rpki.metrics.now()
+      queue = self.task_queues.get(task.self_id)
+      if queue is None:
+        queue = self.task_queues[task.self_id] = collections.deque()
+      queue.append((self.task_sequence.next(), task))
+      if len(queue) == 1 and task.self_id not in self.task_running:
+        self.task_ready(task.self_id)
       return True
     else:
       logger.debug("Task %r was already in the task queue", task)
       return False
 
-  def task_next(self):
+  def task_next(self, task = None):
     """
-    Pull next task from the task queue and put it the deferred event
-    queue (we don't want to run it directly, as that could eventually
-    blow out our call stack).
+    Note that task (if any) has stopped running, either because it has
+    finished or because it has postponed itself, then start more tasks
+    if we're below the concurrency limit.
     """
-    try:
-      self.task_current = self.task_queue.pop(0)
-    except IndexError:
-      self.task_current = None
-    else:
-      rpki.async.event_defer(self.task_current)
+    if task is not None and self.task_running.get(task.self_id) is task:
+      del self.task_running[task.self_id]
+      if task.self_id in self.task_queues:
+        self.task_ready(task.self_id)
+    self.task_run()
+
+  def task_ready(self, self_id):
+    """
+    Put a self whose queue has just become runnable on the heap.
+    """
+    sequence, task = self.task_queues[self_id][0]
+    heapq.heappush(self.task_queue, (task.priority, sequence, self_id))
 
   def task_run(self):
     """
-    Run first task on the task queue, unless one is running already.
+    Start tasks from the task queue, up to task_concurrency of them at
+    once.  Selves with a task running aren't on the heap, so tasks for
+    the same self never run concurrently.
+
+    Tasks go on the deferred event queue rather than being run
+    directly, as that could eventually blow out our call stack.
     """
-    if self.task_current is None:
-      self.task_next()
+    while self.task_queue and len(self.task_running) < max(self.task_concurrency, 1):
+      priority, sequence, self_id = heapq.heappop(self.task_queue)
+      queue = self.task_queues[self_id]
+      sequence, task = queue.popleft()
+      if not queue:
+        del self.task_queues[self_id]
+      self.task_queued.discard(task)
+      self.task_running[self_id] = task
+      task.record_wait()
+      rpki.async.event_defer(task)
+
+  def task_record(self, task, runtime, waited):
+    """
+    Record timing for a task which has just finished.
+    """
+    labels = (task.__class__.__name__,)
+    task_seconds.observe(runtime, labels)
+    task_wait_seconds.observe(waited, labels)
+    logger.debug("%r finished, %.3f seconds since start, %.3f seconds waiting in queue", task, runtime, waited)
 
   def cron(self, cb = None):
     """
@@ -399,6 +506,13 @@ class main(object):
     if nothing_queued:
       done()
 
+  def metrics_handler(self, query, path, cb):
+    """
+    Return our metrics in Prometheus text format.
+    """
+
+    cb(200, body = rpki.metrics.render(), content_type = rpki.metrics.content_type)
+
   def cronjob_handler(self, query, path, cb):
     """
     External trigger for periodic tasks.  This is somewhat obsolete
@@ -452,42 +566,47 @@ class ca_obj(rpki.sql.sql_persistent):
     """
     Fetch all ca_detail objects that link to this CA object.
     """
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id)
 
   @property
   def pending_ca_details(self):
     """
     Fetch the pending ca_details for this CA, if any.
     """
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND state = 'pending'", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id, "state = 'pending'",
+                                           test = lambda c: c.state == "pending")
 
   @property
   def active_ca_detail(self):
     """
     Fetch the active ca_detail for this CA, if any.
     """
-    return ca_detail_obj.sql_fetch_where1(self.gctx, "ca_id = %s AND state = 'active'", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed1(self.gctx, "ca_id", self.ca_id, "state = 'active'",
+                                            test = lambda c: c.state == "active")
 
   @property
   def deprecated_ca_details(self):
     """
     Fetch deprecated ca_details for this CA, if any.
     """
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND state = 'deprecated'", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id, "state = 'deprecated'",
+                                           test = lambda c: c.state == "deprecated")
 
   @property
   def active_or_deprecated_ca_details(self):
     """
     Fetch active and deprecated ca_details for this CA, if any.
     """
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND (state = 'active' OR state = 'deprecated')", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id, "(state = 'active' OR state = 'deprecated')",
+                                           test = lambda c: c.state in ("active", "deprecated"))
 
   @property
   def revoked_ca_details(self):
     """
     Fetch revoked ca_details for this CA, if any.
     """
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND state = 'revoked'", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id, "state = 'revoked'",
+                                           test = lambda c: c.state == "revoked")
 
   @property
   def issue_response_candidate_ca_details(self):
@@ -496,7 +615,8 @@ class ca_obj(rpki.sql.sql_persistent):
     processing an up-down issue_response PDU.
     """
     #return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND latest_ca_cert IS NOT NULL AND state != 'revoked'", (self.ca_id,))
-    return ca_detail_obj.sql_fetch_where(self.gctx, "ca_id = %s AND state != 'revoked'", (self.ca_id,))
+    return ca_detail_obj.sql_fetch_indexed(self.gctx, "ca_id", self.ca_id, "state != 'revoked'",
+                                           test = lambda c: c.state != "revoked")
 
   def construct_sia_uri(self, parent, rc):
     """
@@ -805,7 +925,7 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     """
     Fetch all child_cert objects that link to this ca_detail.
     """
-    return self.fetch_child_certs()
+    return child_cert_obj.sql_fetch_indexed(self.gctx, "ca_detail_id", self.ca_detail_id)
 
   def unpublished_child_certs(self, when):
     """
@@ -819,14 +939,14 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     """
     Fetch all revoked_cert objects that link to this ca_detail.
     """
-    return revoked_cert_obj.sql_fetch_where(self.gctx, "ca_detail_id = %s", (self.ca_detail_id,))
+    return revoked_cert_obj.sql_fetch_indexed(self.gctx, "ca_detail_id", self.ca_detail_id)
 
   @property
   def roas(self):
     """
     Fetch all ROA objects that link to this ca_detail.
     """
-    return rpki.rpkid.roa_obj.sql_fetch_where(self.gctx, "ca_detail_id = %s", (self.ca_detail_id,))
+    return rpki.rpkid.roa_obj.sql_fetch_indexed(self.gctx, "ca_detail_id", self.ca_detail_id)
 
   def unpublished_roas(self, when):
     """
@@ -840,14 +960,14 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     """
     Fetch all Ghostbuster objects that link to this ca_detail.
     """
-    return rpki.rpkid.ghostbuster_obj.sql_fetch_where(self.gctx, "ca_detail_id = %s", (self.ca_detail_id,))
+    return rpki.rpkid.ghostbuster_obj.sql_fetch_indexed(self.gctx, "ca_detail_id", self.ca_detail_id)
 
   @property
   def ee_certificates(self):
     """
     Fetch all EE certificate objects that link to this ca_detail.
     """
-    return rpki.rpkid.ee_cert_obj.sql_fetch_where(self.gctx, "ca_detail_id = %s", (self.ca_detail_id,))
+    return rpki.rpkid.ee_cert_obj.sql_fetch_indexed(self.gctx, "ca_detail_id", self.ca_detail_id)
 
   def unpublished_ghostbusters(self, when):
     """
@@ -967,6 +1087,8 @@ class ca_detail_obj(rpki.sql.sql_persistent):
       logger.debug("Deleting %r", cert)
       cert.sql_delete()
     logger.debug("Deleting %r", self)
+    self.gctx.manifest_hashes.pop(self.ca_detail_id, None)
+    self.gctx.crl_entries.pop(self.ca_detail_id, None)
     self.sql_delete()
 
   def revoke(self, cb, eb):
@@ -1104,10 +1226,10 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     self.ca_id = ca.ca_id
     self.state = "pending"
 
-    self.private_key_id = rpki.x509.RSA.generate()
+    self.private_key_id = self.gctx.keypairs.get()
     self.public_key = self.private_key_id.get_public()
 
-    self.manifest_private_key_id = rpki.x509.RSA.generate()
+    self.manifest_private_key_id = self.gctx.keypairs.get()
     self.manifest_public_key = self.manifest_private_key_id.get_public()
 
     self.sql_store()
@@ -1195,13 +1317,53 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     self.generate_manifest(publisher = publisher)
     return child_cert
 
+  def crl_revoked_certs(self):
+    """
+    Return a dictionary mapping revoked_cert_id to (serial, revoked,
+    expires) for all the revoked_cert tombstones of this ca_detail.
+
+    We keep this table in memory between CRLs.  Tombstones are only
+    ever added (with increasing IDs) or deleted, so one query for the
+    count and highest ID tells us whether we can just fetch the new
+    ones, or whether something we didn't see was deleted and we need
+    to reload the lot.
+    """
+
+    self.gctx.sql.execute("SELECT COUNT(*), MAX(revoked_cert_id) FROM revoked_cert WHERE ca_detail_id = %s",
+                          (self.ca_detail_id,))
+    count, max_id = self.gctx.sql.fetchall()[0]
+    count = int(count)
+    cached = self.gctx.crl_entries.get(self.ca_detail_id)
+    if cached is not None and cached[0] <= (max_id or 0):
+      last_id, entries = cached
+      if (max_id or 0) > last_id:
+        for r in revoked_cert_obj.sql_fetch_where(self.gctx, "ca_detail_id = %s AND revoked_cert_id > %s",
+                                                   (self.ca_detail_id, last_id)):
+          entries[r.revoked_cert_id] = (r.serial, r.revoked, r.expires)
+      if len(entries) == count:
+        cached[0] = max_id or 0
+        return entries
+      logger.debug("Revoked certificates for %r changed behind our back, reloading", self)
+    entries = dict((r.revoked_cert_id, (r.serial, r.revoked, r.expires)) for r in self.revoked_certs)
+    self.gctx.crl_entries[self.ca_detail_id] = [max(entries) if entries else 0, entries]
+    return entries
+
   def generate_crl(self, publisher, nextUpdate = None):
     """
     Generate a new CRL for this ca_detail.  At the moment this is
     unconditional, that is, it is up to the caller to decide whether a
     new CRL is needed.
+
+    If the publisher is coalescing and no explicit nextUpdate was
+    given, we just note that this ca_detail needs a new CRL, and the
+    publisher calls us again just before it sends its queue to pubd.
+    Either way, signing goes through publisher.sign(), and we install
+    the result in .crl_generated().
     """
 
+    if nextUpdate is None and publisher.defer(self, "crl"):
+      return
+
     self.check_failed_publication(publisher)
 
     ca = self.ca
@@ -1212,29 +1374,34 @@ class ca_detail_obj(rpki.sql.sql_persistent):
     if nextUpdate is None:
       nextUpdate = now + crl_interval
 
+    entries = self.crl_revoked_certs()
     certlist = []
-    for revoked_cert in self.revoked_certs:
-      if now > revoked_cert.expires + crl_interval:
-        revoked_cert.sql_delete()
+    for revoked_cert_id, (serial, revoked, expires) in entries.items():
+      if now > expires + crl_interval:
+        revoked_cert = revoked_cert_obj.sql_fetch(self.gctx, revoked_cert_id)
+        if revoked_cert is not None:
+          revoked_cert.sql_delete()
+        del entries[revoked_cert_id]
       else:
-        certlist.append((revoked_cert.serial, revoked_cert.revoked))
+        certlist.append((serial, revoked))
     certlist.sort()
 
-    self.latest_crl = rpki.x509.CRL.generate(
-      keypair             = self.private_key_id,
-      issuer              = self.latest_ca_cert,
-      serial              = ca.next_crl_number(),
-      thisUpdate          = now,
-      nextUpdate          = nextUpdate,
-      revokedCertificates = certlist)
+    publisher.sign(_generate_crl,
+                   (self.private_key_id, self.latest_ca_cert, ca.next_crl_number(), now, nextUpdate, certlist),
+                   lambda crl: self.crl_generated(publisher, crl))
 
+  def crl_generated(self, publisher, crl):
+    """
+    Install and publish a CRL that .generate_crl() had signed.
+    """
+    self.latest_crl = crl
     self.crl_published = rpki.sundial.now()
     self.sql_mark_dirty()
     publisher.publish(
       cls        = rpki.publication.crl_elt,
       uri        = self.crl_uri,
       obj        = self.latest_crl,
-      repository = parent.repository,
+      repository = self.ca.parent.repository,
       handler    = self.crl_published_callback)
 
   def crl_published_callback(self, pdu):
@@ -1247,9 +1414,21 @@ class ca_detail_obj(rpki.sql.sql_persistent):
 
   def generate_manifest(self, publisher, nextUpdate = None):
     """
-    Generate a new manifest for this ca_detail.
+    Generate a new manifest for this ca_detail.  Coalesces and signs
+    like .generate_crl() does.
+
+    We keep the hash of each manifest entry in memory, so we only hash
+    objects which have changed since our last manifest.  To spot
+    changes cheaply, each hash is stored with the SQL row ID of the
+    object and the last 32 bytes of its DER, which for every signed
+    object we publish are the tail of its signature, so any change to
+    the object changes them too.  We don't keep the DER itself, as that
+    would mean a second copy of the whole repository in memory.
     """
 
+    if nextUpdate is None and publisher.defer(self, "manifest"):
+      return
+
     self.check_failed_publication(publisher)
 
     ca = self.ca
@@ -1270,29 +1449,45 @@ class ca_detail_obj(rpki.sql.sql_persistent):
                    self.latest_ca_cert.getNotAfter(), uri, self.latest_manifest_cert.getNotAfter())
 
     logger.debug("Constructing manifest object list for %s", uri)
-    objs = [(self.crl_uri_tail, self.latest_crl)]
-    objs.extend((c.uri_tail, c.cert) for c in self.child_certs)
-    objs.extend((r.uri_tail, r.roa) for r in self.roas if r.roa is not None)
-    objs.extend((g.uri_tail, g.ghostbuster) for g in self.ghostbusters)
-    objs.extend((e.uri_tail, e.cert) for e in self.ee_certificates)
-
-    logger.debug("Building manifest object %s", uri)
-    self.latest_manifest = rpki.x509.SignedManifest.build(
-      serial         = ca.next_manifest_number(),
-      thisUpdate     = now,
-      nextUpdate     = nextUpdate,
-      names_and_objs = objs,
-      keypair        = self.manifest_private_key_id,
-      certs          = self.latest_manifest_cert)
-
-    logger.debug("Manifest generation took %s", rpki.sundial.now() - now)
-
+    objs = [(self.crl_uri_tail, None, self.latest_crl)]
+    objs.extend((c.uri_tail, c.child_cert_id, c.cert) for c in self.child_certs)
+    objs.extend((r.uri_tail, r.roa_id, r.roa) for r in self.roas if r.roa is not None)
+    objs.extend((g.uri_tail, g.ghostbuster_id, g.ghostbuster) for g in self.ghostbusters)
+    objs.extend((e.uri_tail, e.ee_cert_id, e.cert) for e in self.ee_certificates)
+
+    old_hashes = self.gctx.manifest_hashes.get(self.ca_detail_id, {})
+    new_hashes = {}
+    rehashed = 0
+    for name, row_id, obj in objs:
+      der = obj.get_DER()
+      key = (row_id, der[-32:])
+      entry = old_hashes.get(name)
+      if entry is None or entry[0] != key:
+        entry = (key, rpki.x509.sha256(der))
+        rehashed += 1
+      new_hashes[name] = entry
+    self.gctx.manifest_hashes[self.ca_detail_id] = new_hashes
+
+    logger.debug("Building manifest object %s, %d of %d entries changed", uri, rehashed, len(objs))
+    publisher.sign(_build_manifest,
+                   (ca.next_manifest_number(), now, nextUpdate,
+                    [(name, entry[1]) for name, entry in new_hashes.iteritems()],
+                    self.manifest_private_key_id, self.latest_manifest_cert),
+                   lambda manifest: self.manifest_generated(publisher, manifest, now))
+
+  def manifest_generated(self, publisher, manifest, started):
+    """
+    Install and publish a manifest that .generate_manifest() had
+    signed.
+    """
+    logger.debug("Manifest generation took %s", rpki.sundial.now() - started)
+    self.latest_manifest = manifest
     self.manifest_published = rpki.sundial.now()
     self.sql_mark_dirty()
     publisher.publish(cls = rpki.publication.manifest_elt,
-                      uri = uri,
+                      uri = self.manifest_uri,
                       obj = self.latest_manifest,
-                      repository = parent.repository,
+                      repository = self.ca.parent.repository,
                       handler = self.manifest_published_callback)
 
   def manifest_published_callback(self, pdu):
@@ -1392,6 +1587,8 @@ class ca_detail_obj(rpki.sql.sql_persistent):
         handler = child_cert.published_callback)
 
     for roa in self.unpublished_roas(stale):
+      if roa.roa is None:
+        continue                        # Still waiting for publication_queue.sign()
       logger.debug("Retrying publication for %s", roa)
       publisher.publish(
         cls = rpki.publication.roa_elt,
@@ -1841,6 +2038,10 @@ class roa_obj(rpki.sql.sql_persistent):
 
     If fast is set, we leave generating the new manifest for our
     caller to handle, presumably at the end of a bulk operation.
+
+    If the publisher is coalescing, the ROA is signed in a worker
+    process when the publisher flushes, so until then we have a new EE
+    certificate but no ROA, and nothing is written to SQL.
     """
 
     if self.ipv4 is None and self.ipv6 is None:
@@ -1879,7 +2080,7 @@ class roa_obj(rpki.sql.sql_persistent):
 
     ca = ca_detail.ca
     resources = rpki.resource_set.resource_bag(v4 = v4, v6 = v6)
-    keypair = rpki.x509.RSA.generate()
+    keypair = self.gctx.keypairs.get()
 
     del self.ca_detail
     self.ca_detail_id = ca_detail.ca_detail_id
@@ -1888,7 +2089,21 @@ class roa_obj(rpki.sql.sql_persistent):
       resources   = resources,
       subject_key = keypair.get_public(),
       sia         = (None, None, self.uri_from_key(keypair)))
-    self.roa = rpki.x509.ROA.build(self.asn, self.ipv4, self.ipv6, keypair, (self.cert,))
+    self.roa = None
+    publisher.sign(_build_roa,
+                   (self.asn,
+                    str(self.ipv4) if self.ipv4 else None,
+                    str(self.ipv6) if self.ipv6 else None,
+                    keypair, (self.cert,)),
+                   lambda roa: self.roa_generated(publisher, roa))
+    if not fast:
+      ca_detail.generate_manifest(publisher = publisher)
+
+  def roa_generated(self, publisher, roa):
+    """
+    Store and publish a ROA that .generate() had signed.
+    """
+    self.roa = roa
     self.published = rpki.sundial.now()
     self.sql_store()
 
@@ -1897,10 +2112,8 @@ class roa_obj(rpki.sql.sql_persistent):
       cls = rpki.publication.roa_elt,
       uri = self.uri,
       obj = self.roa,
-      repository = ca.parent.repository,
+      repository = self.ca_detail.ca.parent.repository,
       handler = self.published_callback)
-    if not fast:
-      ca_detail.generate_manifest(publisher = publisher)
 
 
   def published_callback(self, pdu):
@@ -2084,7 +2297,7 @@ class ghostbuster_obj(rpki.sql.sql_persistent):
     ca = ca_detail.ca
 
     resources = rpki.resource_set.resource_bag.from_inheritance()
-    keypair = rpki.x509.RSA.generate()
+    keypair = self.gctx.keypairs.get()
 
     self.cert = ca_detail.issue_ee(
       ca          = ca,
@@ -2436,17 +2649,27 @@ class publication_queue(object):
   own completion callback.  Eventually we want to publish everything
   we've accumulated, at which point we need to iterate over the
   collection and do repository.call_pubd() for each repository.
+
+  A coalescing queue also holds back signing of ROAs, CRLs and
+  manifests (see .sign()) until then, so that it can hand all of
+  them to rpki.workers at once rather than signing them one at a time
+  in the daemon process.
   """
 
   replace = True
 
-  def __init__(self):
+  def __init__(self, coalesce = False):
+    self.coalesce = coalesce
+    self.flushing = False
     self.clear()
 
   def clear(self):
     self.repositories = {}
     self.msgs = {}
     self.handlers = {}
+    self.deferred = []
+    self.deferred_ids = {}
+    self.signing = []
     if self.replace:
       self.uris = {}
 
@@ -2473,7 +2696,126 @@ class publication_queue(object):
   def withdraw(self, cls, uri, obj, repository, handler = None):
     return self._add(     uri, obj, repository, handler, cls.make_withdraw)
 
+  def defer(self, ca_detail, product):
+    """
+    If we're coalescing, note that ca_detail needs a new product
+    ("crl" or "manifest") and return True, so that the caller can skip
+    generating it now.  Each ca_detail gets at most one of each when
+    we call .generate_deferred(), however many times it was asked for.
+    """
+    if not self.coalesce:
+      return False
+    products = self.deferred_ids.get(id(ca_detail))
+    if products is None:
+      products = self.deferred_ids[id(ca_detail)] = set()
+      self.deferred.append((ca_detail, products))
+    products.add(product)
+    return True
+
+  def sign(self, func, args, done):
+    """
+    Run a signing job, func(*args), then pass its result to done().
+    If we're coalescing, the job waits for .call_pubd(), which runs it
+    in an rpki.workers process alongside every other job we're
+    holding; otherwise we run it now.
+
+    Jobs held this way have to be module-level functions with
+    picklable arguments, and nothing can depend on their results until
+    done() runs.  That's why only coalescing queues hold them: those
+    also hold back CRLs and manifests, which list the other objects.
+    """
+    if self.coalesce or self.flushing:
+      self.signing.append((func, args, done))
+    else:
+      done(func(*args))
+
+  def run_signing(self, cb, eb):
+    """
+    Start every signing job we're holding, then call cb() once all of
+    them have finished, or eb() with the first failure once all of them
+    have finished if any failed.
+    """
+    jobs = self.signing
+    self.signing = []
+    if not jobs:
+      return cb()
+    state = [len(jobs), None]
+    def finished(e = None):
+      state[0] -= 1
+      if e is not None and state[1] is None:
+        state[1] = e
+      if state[0] == 0:
+        if state[1] is None:
+          cb()
+        else:
+          eb(state[1])
+    def make_callback(done):
+      def callback(result):
+        try:
+          done(result)
+        except (rpki.async.ExitNow, SystemExit):
+          raise
+        except Exception, e:
+          finished(e)
+        else:
+          finished()
+      return callback
+    for func, args, done in jobs:
+      rpki.workers.call(func, args, make_callback(done), finished)
+
+  def generate_deferred(self, cb, eb):
+    """
+    Generate deferred CRLs, then deferred manifests, so that each
+    manifest lists the CRL we just generated.  Held signing jobs for
+    ROAs and CRLs run before we build the manifests, which list them,
+    and the manifests' own signing jobs run after.
+    """
+    deferred = self.deferred
+    self.deferred = []
+    self.deferred_ids = {}
+
+    def generate(product):
+      # Turn off .defer() while we generate, but keep .sign() holding.
+      self.coalesce, coalesce = False, self.coalesce
+      self.flushing = True
+      try:
+        for ca_detail, products in deferred:
+          if product in products:
+            getattr(ca_detail, "generate_" + product)(publisher = self)
+      finally:
+        self.coalesce = coalesce
+        self.flushing = False
+
+    def manifests():
+      try:
+        generate("manifest")
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        eb(e)
+      else:
+        self.run_signing(swept, eb)
+
+    def swept():
+      if deferred:
+        deferred[0][0].gctx.sql.sweep()
+      cb()
+
+    try:
+      generate("crl")
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except Exception, e:
+      eb(e)
+    else:
+      self.run_signing(manifests, eb)
+
   def call_pubd(self, cb, eb):
+    self.generate_deferred(lambda: self.send_pubd(cb, eb), eb)
+
+  def send_pubd(self, cb, eb):
+    if self.repositories:
+      publication_pdus.observe(self.size)
     def loop(iterator, rid):
       logger.debug("Calling pubd[%r]", self.repositories[rid])
       self.repositories[rid].call_pubd(iterator, eb, self.msgs[rid], self.handlers)
@@ -2488,4 +2830,112 @@ class publication_queue(object):
 
   def empty(self):
     assert (not self.msgs) == (self.size == 0)
-    return not self.msgs
+    return not self.msgs and not self.signing
+
+def _generate_keypair():
+  """
+  Generate one keypair for keypair_pool.  This is a module-level
+  function so that rpki.workers can run it in a worker process.
+  """
+  return rpki.x509.RSA.generate(quiet = True)
+
+def _generate_crl(keypair, issuer, serial, thisUpdate, nextUpdate, revokedCertificates):
+  """
+  Sign a CRL for ca_detail_obj.generate_crl(), via publication_queue.sign().
+  """
+  return rpki.x509.CRL.generate(
+    keypair             = keypair,
+    issuer              = issuer,
+    serial              = serial,
+    thisUpdate          = thisUpdate,
+    nextUpdate          = nextUpdate,
+    revokedCertificates = revokedCertificates)
+
+def _build_manifest(serial, thisUpdate, nextUpdate, names_and_hashes, keypair, certs):
+  """
+  Sign a manifest for ca_detail_obj.generate_manifest(), via
+  publication_queue.sign().
+  """
+  return rpki.x509.SignedManifest.build(
+    serial           = serial,
+    thisUpdate       = thisUpdate,
+    nextUpdate       = nextUpdate,
+    names_and_objs   = (),
+    names_and_hashes = names_and_hashes,
+    keypair          = keypair,
+    certs            = certs)
+
+def _build_roa(asn, ipv4, ipv6, keypair, certs):
+  """
+  Sign a ROA for roa_obj.generate(), via publication_queue.sign().
+  Prefixes arrive as text, which pickles more simply than prefix sets.
+  """
+  ipv4 = rpki.resource_set.roa_prefix_set_ipv4(ipv4) if ipv4 else None
+  ipv6 = rpki.resource_set.roa_prefix_set_ipv6(ipv6) if ipv6 else None
+  return rpki.x509.ROA.build(asn, ipv4, ipv6, keypair, certs)
+
+class keypair_pool(object):
+  """
+  Pool of pre-generated RSA keypairs.
+
+  Generating a 2048-bit RSA key is the most expensive single thing we
+  do when issuing ROAs, ghostbusters and new ca_details, so we
+  generate keys ahead of time, in rpki.workers processes, and hand
+  them out as needed.  When the pool drops below the low water mark,
+  we refill it to the high water mark.  If the pool runs dry, we just
+  generate a key on the spot, as we always used to do.
+
+  Without worker processes, pre-generating would just move the same
+  work onto the event loop at a time of our choosing, stalling HTTP
+  I/O and tasks in between, so in that case the pool stays empty and
+  every key is generated on the spot.
+
+  Keys are only kept in memory: anything left in the pool when rpkid
+  exits has never been used for anything, so there's nothing to save.
+  """
+
+  def __init__(self, high_water, low_water):
+    self.keypairs = []
+    self.high_water = high_water
+    self.low_water = min(low_water, high_water)
+    self.refilling = False
+
+  def get(self):
+    """
+    Return a keypair, from the pool if possible.
+    """
+    if self.keypairs:
+      keypair = self.keypairs.pop()
+    else:
+      keypair = rpki.x509.RSA.generate()
+    if len(self.keypairs) < self.low_water:
+      self.refill()
+    return keypair
+
+  def refill(self):
+    """
+    Start refilling the pool, unless we're already doing so or have
+    no worker processes to do it for us.
+    """
+    if rpki.workers.worker_count <= 0:
+      return
+    if not self.refilling and len(self.keypairs) < self.high_water:
+      logger.debug("Refilling keypair pool, %d of %d keypairs available",
+                   len(self.keypairs), self.high_water)
+      self.refilling = True
+      rpki.async.event_defer(self.generate)
+
+  def generate(self):
+    rpki.workers.call(_generate_keypair, (), self.generated, self.failed)
+
+  def generated(self, keypair):
+    self.keypairs.append(keypair)
+    if len(self.keypairs) < self.high_water:
+      rpki.async.event_defer(self.generate)
+    else:
+      logger.debug("Keypair pool full, %d keypairs available", len(self.keypairs))
+      self.refilling = False
+
+  def failed(self, e):
+    logger.warning("Could not generate keypair for keypair pool: %s", e)
+    self.refilling = False
@@ -27,6 +27,7 @@ import rpki.rpkid
 import rpki.async
 import rpki.up_down
 import rpki.sundial
+import rpki.metrics
 import rpki.publication
 import rpki.exceptions
 
@@ -100,12 +101,31 @@ class AbstractTask(object):
 
   timeslice = rpki.sundial.timedelta(seconds = 15)
 
+  ## @var preload
+  # Whether to bulk load this self's CA object graph when the task
+  # starts, keeping it in memory until the task exits.  Worth it for
+  # tasks which walk most of the graph.
+
+  preload = False
+
+  ## @var priority
+  # Scheduling priority, lower numbers run first.  This only decides
+  # which self runs next, by the priority of the task at the head of
+  # each self's queue; tasks for one self always run in the order they
+  # were queued, as do tasks with equal priority.
+
+  priority = 50
+
   def __init__(self, s, description = None):
     self.self = s
     self.description = description
     self.completions = []
     self.continuation = None
     self.due_date = None
+    self.preloaded = None
+    self.queued = None
+    self.started = None
+    self.waited = 0.0
     self.clear()
 
   def __repr__(self):
@@ -115,25 +135,53 @@ class AbstractTask(object):
     self.completions.append(completion)
 
   def exit(self):
-    self.self.gctx.sql.sweep()
+    try:
+      self.self.gctx.sql.sweep()
+    finally:
+      if self.preloaded is not None:
+        self.preloaded.release()
+        self.preloaded = None
     while self.completions:
       self.completions.pop(0)(self)
     self.clear()
     self.due_date = None
-    self.self.gctx.task_next()
+    if self.started is not None:
+      self.self.gctx.task_record(self, rpki.metrics.now() - self.started, self.waited)
+    self.started = None
+    self.waited = 0.0
+    self.self.gctx.task_next(self)
 
   def postpone(self, continuation):
     self.self.gctx.sql.sweep()
     self.continuation = continuation
     self.due_date = None
     self.self.gctx.task_add(self)
-    self.self.gctx.task_next()
+    self.self.gctx.task_next(self)
+
+  def record_wait(self):
+    """
+    Called by the scheduler when it takes this task off the queue, to
+    keep track of how long the task spent waiting to run.
+    """
+    now = rpki.metrics.now()
+    if self.queued is not None:
+      self.waited += now - self.queued
+      self.queued = None
+    if self.started is None:
+      self.started = now
 
   def __call__(self):
     self.due_date = rpki.sundial.now() + self.timeslice
     if self.continuation is None:
       logger.debug("Running task %r", self)
       self.clear()
+      if self.preload and self.preloaded is None:
+        try:
+          self.preloaded = self.self.preload()
+        except (SystemExit, rpki.async.ExitNow):
+          raise
+        except Exception:
+          logger.exception("Couldn't preload SQL objects for %r, continuing without", self)
       self.start()
     else:
       logger.debug("Restarting task %r at %r", self, self.continuation)
@@ -162,6 +210,8 @@ class PollParentTask(AbstractTask):
   parents, in turn.
   """
 
+  priority = 10
+
   def clear(self):
     self.parent_iterator = None
     self.parent = None
@@ -239,7 +289,7 @@ class UpdateChildrenTask(AbstractTask):
     logger.debug("Self %s[%d] updating children", self.self_handle, self.self_id)
     self.now = rpki.sundial.now()
     self.rsn = self.now + rpki.sundial.timedelta(seconds = self.regen_margin)
-    self.publisher = rpki.rpkid.publication_queue()
+    self.publisher = rpki.rpkid.publication_queue(coalesce = True)
     rpki.async.iterator(self.children, self.loop, self.done)
 
   def loop(self, iterator, child):
@@ -344,6 +394,8 @@ class UpdateROAsTask(AbstractTask):
   Generate or update ROAs for this self.
   """
 
+  preload = True
+
   def clear(self):
     self.orphans = None
     self.updates = None
@@ -371,7 +423,7 @@ class UpdateROAsTask(AbstractTask):
     seen = set()
     self.orphans = []
     self.updates = []
-    self.publisher = rpki.rpkid.publication_queue()
+    self.publisher = rpki.rpkid.publication_queue(coalesce = True)
     self.ca_details = set()
 
     for roa in self.roas:
@@ -475,6 +527,8 @@ class UpdateGhostbustersTask(AbstractTask):
   exceptionally silly.
   """
 
+  priority = 90
+
   def start(self):
     self.gctx.checkpoint()
     logger.debug("Self %s[%d] updating Ghostbuster records",
@@ -495,7 +549,7 @@ class UpdateGhostbustersTask(AbstractTask):
 
       ghostbusters = {}
       orphans = []
-      publisher = rpki.rpkid.publication_queue()
+      publisher = rpki.rpkid.publication_queue(coalesce = True)
       ca_details = set()
       seen = set()
 
@@ -584,7 +638,7 @@ class UpdateEECertificatesTask(AbstractTask):
         logger.warning("Unexpected dirty SQL cache, flushing")
         self.gctx.sql.sweep()
 
-      publisher = rpki.rpkid.publication_queue()
+      publisher = rpki.rpkid.publication_queue(coalesce = True)
 
       existing = dict()
       for ee in self.ee_certificates:
@@ -675,6 +729,10 @@ class RegenerateCRLsAndManifestsTask(AbstractTask):
   database anyway.
   """
 
+  preload = True
+
+  priority = 10
+
   def start(self):
     self.gctx.checkpoint()
     logger.debug("Self %s[%d] regenerating CRLs and manifests",
@@ -717,6 +775,8 @@ class CheckFailedPublication(AbstractTask):
   to pubd being down or unreachable).
   """
 
+  preload = True
+
   def start(self):
     publisher = rpki.rpkid.publication_queue()
     for parent in self.parents:
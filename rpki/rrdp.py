@@ -0,0 +1,340 @@
+# $Id$
+#
+# Copyright (C) 2015  Dragon Research Labs ("DRL")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND DRL DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL DRL BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+RPKI Repository Delta Protocol (RFC 8182) support for pubd.
+
+pubd tells us about every object it publishes or withdraws, once the
+change has been committed to the rsync tree.  We collect these changes
+into a pending delta, and every update_interval we turn the pending
+delta into a new serial: a delta file, a snapshot file, and a new
+notification file pointing at both, all static files for an ordinary
+HTTP server to serve from rrdp_base.
+
+RRDP requires the notification file to point at a snapshot for its
+current serial, so each new serial needs a new snapshot.  Batching
+changes up over update_interval keeps this affordable, and also
+coalesces repeated changes to the same URI into a single delta entry.
+
+We keep the URI and hash of every published object (and the name of
+the file holding it) in a JSON state file, along with our session ID,
+serial, and list of deltas, so we can carry on where we left off after
+a restart, after checking the rsync tree for changes made since we
+last saved it.  If the state file is missing or unusable, we start a new
+session by scanning the rsync tree, which is why we need to know the
+rsync URI corresponding to the root of the tree.
+"""
+
+import os
+import json
+import uuid
+import errno
+import base64
+import shutil
+import logging
+import collections
+import lxml.etree
+import rpki.x509
+import rpki.async
+import rpki.sundial
+
+logger = logging.getLogger(__name__)
+
+## @var xmlns
+# RRDP XML namespace.
+
+xmlns = "http://www.ripe.net/rpki/rrdp"
+
+## @var nsmap
+# Namespace map for lxml.
+
+nsmap = { None : xmlns }
+
+## @var version
+# RRDP protocol version.
+
+version = "1"
+
+def _hash(data):
+  return rpki.x509.sha256(data).encode("hex")
+
+class repository(object):
+  """
+  RRDP session, serial, and file generation for one publication tree.
+  """
+
+  def __init__(self, publication_base, rsync_base_uri, rrdp_base, rrdp_base_uri, state_file,
+               update_interval, max_deltas, fsync = True):
+    self.publication_base = publication_base.rstrip("/")
+    self.rsync_base_uri = rsync_base_uri.rstrip("/") + "/"
+    self.rrdp_base = rrdp_base.rstrip("/")
+    self.rrdp_base_uri = rrdp_base_uri.rstrip("/") + "/"
+    self.state_file = state_file
+    self.update_interval = update_interval
+    self.max_deltas = max_deltas
+    self.fsync = fsync
+    self.pending = collections.OrderedDict()    # uri -> [hash before, hash after], None if absent
+    self.timer = rpki.async.timer(self.update)
+    if self.load():
+      self.reconcile()
+    else:
+      self.new_session()
+
+  def load(self):
+    """
+    Load saved state.  Returns False if there's no usable state, in
+    which case we need a new session.
+    """
+    try:
+      f = open(self.state_file, "r")
+      try:
+        state = json.load(f)
+      finally:
+        f.close()
+      self.session_id = str(state["session_id"])
+      self.serial = int(state["serial"])
+      self.objects = dict((str(uri), (str(h), str(fn))) for uri, (h, fn) in state["objects"].iteritems())
+      self.deltas = [(int(s), str(h), int(n)) for s, h, n in state["deltas"]]
+      self.snapshot_hash = str(state["snapshot_hash"])
+      self.snapshot_size = int(state["snapshot_size"])
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        logger.warning("Couldn't read RRDP state file %s: %s", self.state_file, e)
+      return False
+    except (ValueError, KeyError, TypeError), e:
+      logger.warning("Couldn't parse RRDP state file %s: %s", self.state_file, e)
+      return False
+    if not os.path.exists(self.notification_filename):
+      logger.warning("RRDP notification file %s missing, starting new session", self.notification_filename)
+      return False
+    logger.debug("Loaded RRDP state, session %s serial %d, %d objects",
+                 self.session_id, self.serial, len(self.objects))
+    return True
+
+  def save(self):
+    state = dict(session_id    = self.session_id,
+                 serial        = self.serial,
+                 objects       = self.objects,
+                 deltas        = self.deltas,
+                 snapshot_hash = self.snapshot_hash,
+                 snapshot_size = self.snapshot_size)
+    self._write(self.state_file, json.dumps(state))
+
+  def new_session(self):
+    """
+    Start a new RRDP session at serial 1, with a snapshot of whatever
+    is in the rsync tree right now.  Any pending changes are already
+    in the tree, so they're covered by the snapshot.
+    """
+    old_session = getattr(self, "session_id", None)
+    self.session_id = str(uuid.uuid4())
+    self.serial = 1
+    self.objects = self.scan()
+    self.deltas = []
+    self.pending.clear()
+    logger.info("Starting RRDP session %s with %d objects", self.session_id, len(self.objects))
+    self.write_snapshot()
+    self.write_notification()
+    self.save()
+    if old_session is not None:
+      shutil.rmtree(os.path.join(self.rrdp_base, old_session), ignore_errors = True)
+
+  def scan(self):
+    """
+    Hash everything in the rsync tree.
+    """
+    objects = {}
+    for dirpath, dirnames, filenames in os.walk(self.publication_base):
+      for name in filenames:
+        filename = os.path.join(dirpath, name)
+        uri = self.rsync_base_uri + os.path.relpath(filename, self.publication_base)
+        objects[uri] = (_hash(self._read(filename)), filename)
+    return objects
+
+  def reconcile(self):
+    """
+    Record any differences between the rsync tree and our saved state,
+    left by changes which pubd committed but didn't get around to
+    putting in a delta before it stopped.
+    """
+    objects = self.scan()
+    for uri in set(self.objects) - set(objects):
+      self.record(uri, self.objects[uri][1], None)
+    for uri, (digest, filename) in objects.iteritems():
+      if uri not in self.objects or self.objects[uri][0] != digest:
+        self.record(uri, filename, digest)
+    if self.pending:
+      logger.info("Found %d changes not yet in an RRDP delta", len(self.pending))
+
+  @staticmethod
+  def _read(filename):
+    f = open(filename, "rb")
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  @property
+  def notification_filename(self):
+    return os.path.join(self.rrdp_base, "notification.xml")
+
+  def _relname(self, serial, kind):
+    return "%s/%d/%s.xml" % (self.session_id, serial, kind)
+
+  def _write(self, filename, data):
+    """
+    Write a file atomically, creating its directory if necessary.
+    """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    f = open(filename + ".tmp", "wb")
+    try:
+      f.write(data)
+      if self.fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+      f.close()
+    os.rename(filename + ".tmp", filename)
+
+  def _write_xml(self, relname, elt):
+    data = lxml.etree.tostring(elt, pretty_print = True, encoding = "us-ascii", xml_declaration = True)
+    self._write(os.path.join(self.rrdp_base, relname), data)
+    return _hash(data), len(data)
+
+  def _make_elt(self, tag, **attrs):
+    return lxml.etree.Element("{%s}%s" % (xmlns, tag), nsmap = nsmap, version = version,
+                              session_id = self.session_id, serial = str(self.serial), **attrs)
+
+  @staticmethod
+  def _sub(parent, tag, **attrs):
+    return lxml.etree.SubElement(parent, "{%s}%s" % (xmlns, tag), **attrs)
+
+  def record(self, uri, filename, digest):
+    """
+    Record a change committed to the rsync tree: publication at uri of
+    an object whose SHA-256 hex digest is digest, or withdrawal of uri
+    if digest is None.  We read the object back from filename when we
+    generate the delta, so we don't hold DER in memory meanwhile.
+    """
+    old = self.objects.get(uri)
+    if uri not in self.pending:
+      self.pending[uri] = [old[0] if old is not None else None, None]
+    self.pending[uri][1] = digest
+    if digest is None:
+      self.objects.pop(uri, None)
+    else:
+      self.objects[uri] = (digest, filename)
+    if not self.timer.is_set():
+      self.timer.set(rpki.sundial.timedelta(seconds = self.update_interval))
+
+  def update(self):
+    """
+    Turn pending changes into a new serial.
+    """
+    try:
+      self._update()
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except Exception:
+      logger.exception("Couldn't generate RRDP files for serial %d, starting new session", self.serial + 1)
+      self.new_session()
+
+  def _update(self):
+    pending = self.pending
+    self.pending = collections.OrderedDict()
+    delta = []
+    for uri, (before, after) in pending.iteritems():
+      if after is None and before is not None:
+        delta.append(("withdraw", uri, before, None))
+      elif after is not None and after != before:
+        delta.append(("publish", uri, before, self._read(self.objects[uri][1])))
+    if not delta:
+      return
+
+    self.serial += 1
+    elt = self._make_elt("delta")
+    for action, uri, before, data in delta:
+      if action == "withdraw":
+        self._sub(elt, "withdraw", uri = uri, hash = before)
+      elif before is None:
+        self._sub(elt, "publish", uri = uri).text = base64.b64encode(data)
+      else:
+        self._sub(elt, "publish", uri = uri, hash = before).text = base64.b64encode(data)
+    delta_hash, delta_size = self._write_xml(self._relname(self.serial, "delta"), elt)
+    self.deltas.insert(0, (self.serial, delta_hash, delta_size))
+
+    self.write_snapshot()
+    self.prune()
+    self.write_notification()
+    self.save()
+
+    logger.info("RRDP serial %d: %d changes, %d objects", self.serial, len(delta), len(self.objects))
+
+  def write_snapshot(self):
+    """
+    Write a snapshot for the current serial, from the rsync tree.
+    """
+    elt = self._make_elt("snapshot")
+    for uri in sorted(self.objects):
+      h, filename = self.objects[uri]
+      try:
+        data = self._read(filename)
+      except IOError, e:
+        logger.warning("Couldn't read %s for RRDP snapshot, skipping: %s", filename, e)
+        continue
+      self._sub(elt, "publish", uri = uri).text = base64.b64encode(data)
+    self.snapshot_hash, self.snapshot_size = self._write_xml(self._relname(self.serial, "snapshot"), elt)
+
+  def prune(self):
+    """
+    Drop deltas once there are more than max_deltas of them or their
+    total size exceeds the snapshot's, as RFC 8182 suggests, and
+    snapshots other than the current and previous ones.  Relying
+    parties may still be fetching the previous snapshot.
+    """
+    total = 0
+    for i, (serial, h, size) in enumerate(self.deltas):
+      total += size
+      if i >= self.max_deltas or total > self.snapshot_size:
+        del self.deltas[i:]
+        break
+    keep = set(serial for serial, h, size in self.deltas)
+    session_dir = os.path.join(self.rrdp_base, self.session_id)
+    for name in os.listdir(session_dir):
+      try:
+        serial = int(name)
+      except ValueError:
+        continue
+      if serial >= self.serial - 1:
+        continue
+      if serial in keep:
+        try:
+          os.remove(os.path.join(session_dir, name, "snapshot.xml"))
+        except OSError:
+          pass
+      else:
+        shutil.rmtree(os.path.join(session_dir, name), ignore_errors = True)
+
+  def write_notification(self):
+    elt = self._make_elt("notification")
+    self._sub(elt, "snapshot", uri = self.rrdp_base_uri + self._relname(self.serial, "snapshot"),
+              hash = self.snapshot_hash)
+    for serial, h, size in self.deltas:
+      self._sub(elt, "delta", serial = str(serial), uri = self.rrdp_base_uri + self._relname(serial, "delta"),
+                hash = h)
+    self._write_xml("notification.xml", elt)
@@ -58,6 +58,9 @@ class ReadBuffer(object):
 
   def __init__(self):
     self.buffer = ""
+    self.offset = 0
+    self.need = 0
+    self.callback = None
     self.version = None
 
   def update(self, need, callback):
@@ -81,7 +84,7 @@ class ReadBuffer(object):
     How much data do we have available in this buffer?
     """
 
-    return len(self.buffer)
+    return len(self.buffer) - self.offset
 
   def needed(self):
     """
@@ -100,10 +103,14 @@ class ReadBuffer(object):
   def get(self, n):
     """
     Hand some data to the caller.
+
+    We just advance an offset into the buffer here rather than copying
+    whatever remains after every read, which would make decoding a
+    buffer full of small PDUs quadratic.  put() discards consumed data.
     """
 
-    b = self.buffer[:n]
-    self.buffer = self.buffer[n:]
+    b = self.buffer[self.offset:self.offset + n]
+    self.offset += len(b)
     return b
 
   def put(self, b):
@@ -111,7 +118,23 @@ class ReadBuffer(object):
     Accumulate some data.
     """
 
-    self.buffer += b
+    if self.offset:
+      self.buffer = self.buffer[self.offset:] + b
+      self.offset = 0
+    else:
+      self.buffer += b
+
+  def pdus(self, root_pdu_class):
+    """
+    Generator yielding every complete PDU currently in the buffer,
+    leaving the buffer waiting for the start of the next one.
+    """
+
+    p = root_pdu_class.read_pdu(self) if self.callback is None else self.retry()
+    while p is not None:
+      self.callback = None
+      yield p
+      p = root_pdu_class.read_pdu(self)
 
   def check_version(self, version):
     """
@@ -142,6 +165,7 @@ class PDUChannel(asynchat.async_chat, object):
     self.reader = ReadBuffer()
     assert issubclass(root_pdu_class, rpki.rtr.pdus.PDU)
     self.root_pdu_class = root_pdu_class
+    self.set_terminator(None)
 
   @property
   def version(self):
@@ -156,37 +180,30 @@ class PDUChannel(asynchat.async_chat, object):
     Start read of a new PDU.
     """
 
+    self.deliver_pdus()
+
+  def deliver_pdus(self):
+    """
+    Deliver every complete PDU we have buffered.  We run asynchat
+    without a terminator, so a single recv() full of PDUs gets decoded
+    in one pass here rather than one found_terminator() call per PDU.
+    """
+
     try:
-      p = self.root_pdu_class.read_pdu(self.reader)
-      while p is not None:
+      for p in self.reader.pdus(self.root_pdu_class):
         self.deliver_pdu(p)
-        p = self.root_pdu_class.read_pdu(self.reader)
     except rpki.rtr.pdus.PDUException, e:
       self.push_pdu(e.make_error_report(version = self.version))
       self.close_when_done()
-    else:
-      assert not self.reader.ready()
-      self.set_terminator(self.reader.needed())
 
   def collect_incoming_data(self, data):
     """
-    Collect data into the read buffer.
+    Collect data into the read buffer, then see if we now have PDUs.
     """
 
     self.reader.put(data)
-
-  def found_terminator(self):
-    """
-    Got requested data, see if we now have a PDU.  If so, pass it
-    along, then restart cycle for a new PDU.
-    """
-
-    p = self.reader.retry()
-    if p is None:
-      self.set_terminator(self.reader.needed())
-    else:
-      self.deliver_pdu(p)
-      self.start_new_pdu()
+    if self.reader.ready():
+      self.deliver_pdus()
 
   def push_pdu(self, pdu):
     """
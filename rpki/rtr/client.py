@@ -27,6 +27,7 @@ import socket
 import signal
 import logging
 import asyncore
+import itertools
 import subprocess
 import rpki.rtr.pdus
 import rpki.rtr.channels
@@ -180,8 +181,21 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
   retry    = rpki.rtr.pdus.default_retry
   expire   = rpki.rtr.pdus.default_expire
   updated  = Timestamp(0)
+  polled   = Timestamp(0)
+  wakeup   = None
+
+  prefix_sql = {
+    1 : "INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) VALUES (?, ?, ?, ?, ?)",
+    0 : "DELETE FROM prefix "
+        "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?" }
+
+  routerkey_sql = {
+    1 : "INSERT INTO routerkey (cache_id, asn, ski, key) VALUES (?, ?, ?, ?)",
+    0 : "DELETE FROM routerkey WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)" }
 
   def __init__(self, sock, proc, killsig, args, host = None, port = None):
+    self.pending_prefixes = []
+    self.pending_routerkeys = []
     self.killsig = killsig
     self.proc = proc
     self.args = args
@@ -195,31 +209,35 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
       self.setup_sql()
 
   @classmethod
-  def ssh(cls, args):
+  def ssh(cls, args, host = None, port = None):
     """
     Set up ssh connection and start listening for first PDU.
     """
 
-    if args.port is None:
-      argv = ("ssh", "-s", args.host, "rpki-rtr")
+    host = args.host if host is None else host
+    port = args.port if port is None else port
+    if port is None:
+      argv = ("ssh", "-s", host, "rpki-rtr")
     else:
-      argv = ("ssh", "-p", args.port, "-s", args.host, "rpki-rtr")
+      argv = ("ssh", "-p", port, "-s", host, "rpki-rtr")
     logging.debug("[Running ssh: %s]", " ".join(argv))
     s = socket.socketpair()
     return cls(sock = s[1],
                proc = subprocess.Popen(argv, executable = "/usr/bin/ssh",
                                        stdin = s[0], stdout = s[0], close_fds = True),
-               killsig = signal.SIGKILL, args = args)
+               killsig = signal.SIGKILL, args = args, host = host, port = port)
 
   @classmethod
-  def tcp(cls, args):
+  def tcp(cls, args, host = None, port = None):
     """
     Set up TCP connection and start listening for first PDU.
     """
 
-    logging.debug("[Starting raw TCP connection to %s:%s]", args.host, args.port)
+    host = args.host if host is None else host
+    port = args.port if port is None else port
+    logging.debug("[Starting raw TCP connection to %s:%s]", host, port)
     try:
-      addrinfo = socket.getaddrinfo(args.host, args.port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+      addrinfo = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
     except socket.error, e:
       logging.debug("[socket.getaddrinfo() failed: %s]", e)
     else:
@@ -237,11 +255,11 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
           logging.exception("[socket.connect() failed: %s]", e)
           s.close()
           continue
-        return cls(sock = s, proc = None, killsig = None, args = args)
+        return cls(sock = s, proc = None, killsig = None, args = args, host = host, port = port)
     sys.exit(1)
 
   @classmethod
-  def loopback(cls, args):
+  def loopback(cls, args, host = None, port = None):
     """
     Set up loopback connection and start listening for first PDU.
     """
@@ -252,10 +270,10 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     return cls(sock = s[1],
                proc = subprocess.Popen(argv, stdin = s[0], stdout = s[0], close_fds = True),
                killsig = signal.SIGINT, args = args,
-               host = args.host or "none", port = args.port or "none")
+               host = host or args.host or "none", port = port or args.port or "none")
 
   @classmethod
-  def tls(cls, args):
+  def tls(cls, args, host = None, port = None):
     """
     Set up TLS connection and start listening for first PDU.
 
@@ -267,12 +285,14 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     for such purposes this week).
     """
 
-    argv = ("openssl", "s_client", "-tls1", "-quiet", "-connect", "%s:%s" % (args.host, args.port))
+    host = args.host if host is None else host
+    port = args.port if port is None else port
+    argv = ("openssl", "s_client", "-tls1", "-quiet", "-connect", "%s:%s" % (host, port))
     logging.debug("[Running: %s]", " ".join(argv))
     s = socket.socketpair()
     return cls(sock = s[1],
                proc = subprocess.Popen(argv, stdin = s[0], stdout = s[0], close_fds = True),
-               killsig = signal.SIGKILL, args = args)
+               killsig = signal.SIGKILL, args = args, host = host, port = port)
 
   def setup_sql(self):
     """
@@ -324,6 +344,20 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
                 UNIQUE          (cache_id, asn, key))''')
     elif self.args.reset_session:
       cur.execute("DELETE FROM cache WHERE host = ? and port = ?", (self.host, self.port))
+    if self.args.sql_staging:
+      cur.execute("PRAGMA temp_store = MEMORY")
+      cur.execute('''
+        CREATE TEMP TABLE prefix_staging (
+                seq             INTEGER PRIMARY KEY,
+                announce        INTEGER NOT NULL,
+                cache_id        INTEGER NOT NULL,
+                asn             INTEGER NOT NULL,
+                prefix          TEXT NOT NULL,
+                prefixlen       INTEGER NOT NULL,
+                max_prefixlen   INTEGER NOT NULL)''')
+      cur.execute('''
+        CREATE INDEX prefix_staging_key
+                ON prefix_staging (cache_id, asn, prefix, prefixlen, max_prefixlen, seq)''')
     cur.execute("SELECT cache_id, version, nonce, serial, refresh, retry, expire, updated "
                 "FROM cache WHERE host = ? AND port = ?",
                 (self.host, self.port))
@@ -356,6 +390,8 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     """
 
     self.serial = None
+    del self.pending_prefixes[:]
+    del self.pending_routerkeys[:]
     if self.sql:
       cur = self.sql.cursor()
       cur.execute("DELETE FROM prefix WHERE cache_id = ?", (self.cache_id,))
@@ -376,6 +412,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     self.expire  = expire
     self.updated = Timestamp.now()
     if self.sql:
+      self.flush_pending()
       self.sql.execute("UPDATE cache SET"
                        " version = ?, serial = ?, nonce  = ?,"
                        " refresh = ?, retry  = ?, expire = ?,"
@@ -386,37 +423,68 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
 
   def consume_prefix(self, prefix):
     """
-    Handle one prefix PDU.
+    Handle one prefix PDU.  We just buffer the change here,
+    flush_pending() applies it when we get the EndOfDataPDU.
     """
 
     if self.sql:
       values = (self.cache_id, prefix.asn, str(prefix.prefix), prefix.prefixlen, prefix.max_prefixlen)
-      if prefix.announce:
-        self.sql.execute("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
-                         "VALUES (?, ?, ?, ?, ?)",
-                         values)
-      else:
-        self.sql.execute("DELETE FROM prefix "
-                         "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
-                         values)
+      self.pending_prefixes.append((prefix.announce, values))
 
   def consume_routerkey(self, routerkey):
     """
-    Handle one Router Key PDU.
+    Handle one Router Key PDU.  We just buffer the change here,
+    flush_pending() applies it when we get the EndOfDataPDU.
     """
 
     if self.sql:
       values = (self.cache_id, routerkey.asn,
                 base64.urlsafe_b64encode(routerkey.ski).rstrip("="),
                 base64.b64encode(routerkey.key))
-      if routerkey.announce:
-        self.sql.execute("INSERT INTO routerkey (cache_id, asn, ski, key) "
-                         "VALUES (?, ?, ?, ?)",
-                         values)
-      else:
-        self.sql.execute("DELETE FROM routerkey "
-                         "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
-                         values)
+      self.pending_routerkeys.append((routerkey.announce, values))
+
+  @staticmethod
+  def _executemany_runs(cur, statements, pending):
+    """
+    Apply buffered changes in order, batching each run of consecutive
+    announcements or withdrawals into a single executemany() call.
+    """
+
+    for announce, run in itertools.groupby(pending, lambda change: change[0]):
+      cur.executemany(statements[announce], (values for a, values in run))
+
+  def flush_pending(self):
+    """
+    Apply the prefix and router key changes buffered since the
+    CacheResponsePDU.  Everything happens in the current transaction,
+    caller is responsible for committing.
+
+    With --sql-staging, prefix changes go into an in-memory temporary
+    table first and are applied to the real table with a few set-based
+    statements, using the last change received for each prefix.
+    """
+
+    cur = self.sql.cursor()
+    if self.args.sql_staging and self.pending_prefixes:
+      cur.executemany("INSERT INTO prefix_staging (announce, cache_id, asn, prefix, prefixlen, max_prefixlen) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      ((announce,) + values for announce, values in self.pending_prefixes))
+      cur.execute("DELETE FROM prefix WHERE rowid IN ("
+                  " SELECT p.rowid FROM prefix_staging s JOIN prefix p"
+                  " ON p.cache_id = s.cache_id AND p.asn = s.asn AND p.prefix = s.prefix"
+                  " AND p.prefixlen = s.prefixlen AND p.max_prefixlen = s.max_prefixlen)")
+      cur.execute("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
+                  "SELECT cache_id, asn, prefix, prefixlen, max_prefixlen FROM prefix_staging s "
+                  "WHERE announce = 1 AND seq = ("
+                  " SELECT MAX(seq) FROM prefix_staging t"
+                  " WHERE t.cache_id = s.cache_id AND t.asn = s.asn AND t.prefix = s.prefix"
+                  " AND t.prefixlen = s.prefixlen AND t.max_prefixlen = s.max_prefixlen)")
+      cur.execute("DELETE FROM prefix_staging")
+    else:
+      self._executemany_runs(cur, self.prefix_sql, self.pending_prefixes)
+    self._executemany_runs(cur, self.routerkey_sql, self.pending_routerkeys)
+    del self.pending_prefixes[:]
+    del self.pending_routerkeys[:]
 
   def deliver_pdu(self, pdu):
     """
@@ -433,6 +501,41 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     logging.debug(pdu)
     super(ClientChannel, self).push_pdu(pdu)
 
+  def poll(self):
+    """
+    Expire stale data, then send whichever query our state calls for.
+    """
+
+    now = Timestamp.now()
+
+    if self.serial is not None and now > self.updated + self.expire:
+      logging.info("[Expiring client data: serial %s, last updated %s, expire %s]",
+                   self.serial, self.updated, self.expire)
+      self.cache_reset()
+
+    if self.serial is None or self.nonce is None:
+      self.polled = now
+      self.push_pdu(ResetQueryPDU(version = self.version))
+
+    elif now >= self.updated + self.refresh:
+      self.polled = now
+      self.push_pdu(SerialQueryPDU(version = self.version,
+                                   serial  = self.serial,
+                                   nonce   = self.nonce))
+
+  def next_wakeup(self):
+    """
+    Compute and return the time at which this client next needs to poll.
+    """
+
+    now = Timestamp.now()
+    timer = self.retry if (now >= self.updated + self.refresh) else self.refresh
+    wokeup = self.wakeup
+    self.wakeup = max(now, Timestamp(max(self.polled, self.updated) + timer))
+    if self.wakeup != wokeup:
+      logging.info("[Cache %s:%s last client poll %s, next %s]", self.host, self.port, self.polled, self.wakeup)
+    return self.wakeup
+
   def cleanup(self):
     """
     Force clean up this client's child process.  If everything goes
@@ -469,49 +572,29 @@ def client_main(args):
   assert issubclass(ClientChannelClass, ClientChannel)
   constructor = getattr(ClientChannelClass, args.protocol)
 
-  client = None
+  clients = []
   try:
-    client = constructor(args)
+    clients.append(constructor(args))
+    for host, port in args.additional_cache or ():
+      clients.append(constructor(args, host = host, port = port))
 
-    polled = client.updated
-    wakeup = None
+    for client in clients:
+      client.polled = client.updated
+      client.poll()
 
     while True:
-
       now = Timestamp.now()
-
-      if client.serial is not None and now > client.updated + client.expire:
-        logging.info("[Expiring client data: serial %s, last updated %s, expire %s]",
-                     client.serial, client.updated, client.expire)
-        client.cache_reset()
-
-      if client.serial is None or client.nonce is None:
-        polled = now
-        client.push_pdu(ResetQueryPDU(version = client.version))
-
-      elif now >= client.updated + client.refresh:
-        polled = now
-        client.push_pdu(SerialQueryPDU(version = client.version,
-                                       serial  = client.serial,
-                                       nonce   = client.nonce))
-
-      remaining = 1
-
-      while remaining > 0:
-        now = Timestamp.now()
-        timer = client.retry if (now >= client.updated + client.refresh) else client.refresh
-        wokeup = wakeup
-        wakeup = max(now, Timestamp(max(polled, client.updated) + timer))
-        remaining = wakeup - now
-        if wakeup != wokeup:
-          logging.info("[Last client poll %s, next %s]", polled, wakeup)
-        asyncore.loop(timeout = remaining, count = 1)
+      for client in clients:
+        if client.next_wakeup() <= now:
+          client.poll()
+      remaining = min(client.next_wakeup() for client in clients) - Timestamp.now()
+      asyncore.loop(timeout = max(remaining, 0), count = 1)
 
   except KeyboardInterrupt:
     sys.exit(0)
 
   finally:
-    if client is not None:
+    for client in clients:
       client.cleanup()
 
 
@@ -526,6 +609,9 @@ def argparse_setup(subparsers):
   subparser.add_argument("--sql-database", help = "filename for sqlite3 database of client state")
   subparser.add_argument("--force-version", type = int, choices = PDU.version_map, help = "force specific protocol version")
   subparser.add_argument("--reset-session", action = "store_true", help = "reset any existing session found in sqlite3 database")
+  subparser.add_argument("--sql-staging", action = "store_true", help = "stage prefix changes in an in-memory sqlite3 table")
+  subparser.add_argument("--additional-cache", nargs = 2, action = "append", metavar = ("HOST", "PORT"),
+                         help = "also monitor this cache, using the same protocol")
   subparser.add_argument("protocol", choices = ("loopback", "tcp", "ssh", "tls"), help = "connection protocol")
   subparser.add_argument("host", nargs = "?", help = "server host")
   subparser.add_argument("port", nargs = "?", help = "server port")
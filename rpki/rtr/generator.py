@@ -23,11 +23,16 @@ Database generator for RPKI-RTR server (RFC 6810 et sequalia).
 import os
 import sys
 import glob
+import array
+import struct
+import heapq
 import socket
 import base64
 import random
+import cPickle
 import logging
 import subprocess
+import multiprocessing
 import rpki.POW
 import rpki.oids
 import rpki.rtr.pdus
@@ -169,6 +174,269 @@ class X509(rpki.POW.X509):              # pylint: disable=W0232
           yield asn
 
 
+def parse_roa(fn):
+  """
+  Extract the ASN and prefixes from a ROA, in a form that can be
+  pickled and used later to construct PrefixPDUs.
+  """
+
+  roa = ROA.derReadFile(fn)
+  return roa.getASID(), tuple((address.toBytes(), length, maxlength)
+                              for address, length, maxlength in roa.prefixes)
+
+def parse_routercert(fn):
+  """
+  Extract (asn, ski, key) tuples from a certificate if it is a BGPSEC
+  router certificate, or an empty tuple if it is not.
+  """
+
+  x = X509.derReadFile(fn)
+  eku = x.getEKU()
+  if eku is None or rpki.oids.id_kp_bgpsec_router not in eku:
+    return ()
+  ski = x.getSKI()
+  key = x.getPublicKey().derWritePublic()
+  return tuple((asn, ski, key) for asn in x.asns)
+
+def roa_pdus(version, data):
+  """
+  Construct PrefixPDUs from data returned by parse_roa().
+  """
+
+  asn, prefixes = data
+  return [PrefixPDU.from_roa(version = version, asn = asn,
+                             prefix_tuple = (rpki.POW.IPAddress.fromBytes(address), length, maxlength))
+          for address, length, maxlength in prefixes]
+
+def routercert_pdus(version, data):
+  """
+  Construct RouterKeyPDUs from data returned by parse_routercert().
+  """
+
+  return [RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key)
+          for asn, ski, key in data]
+
+def file_stamp(fn):
+  """
+  Return the (mtime, size) tuple we use to detect changed files.
+  """
+
+  st = os.stat(fn)
+  return st.st_mtime, st.st_size
+
+def parse_rcynic_shard(args):
+  """
+  Worker process side of a parallel parse_rcynic_wire(): parse one
+  shard of rcynic's output, returning the parsed data (so that the
+  parent can update its ParseCache) and the sorted wire format of
+  the resulting PDUs.  Takes a single argument tuple, for the benefit
+  of multiprocessing.Pool.map().
+  """
+
+  version, todo = args
+  results = {}
+  pdus = []
+  for fn, parser, builder in todo:
+    stamp = file_stamp(fn)
+    data = parser(fn)
+    results[fn] = (stamp, data)
+    pdus.extend(p.to_pdu() for p in builder(version, data))
+  pdus.sort()
+  return results, pdus
+
+
+def dedup_wire(merged):
+  """
+  Discard adjacent duplicates from a sorted iterable of wire format PDUs.
+  """
+
+  last = None
+  for b in merged:
+    if b != last:
+      yield b
+    last = b
+
+def parse_parallel(version, todo, cache, workers, local):
+  """
+  Parallel back end for parse_rcynic_wire().  Files with usable cached
+  data are handled locally, appending their wire format PDUs to local,
+  the rest are dealt round-robin to worker processes.  Returns the
+  sorted lists of wire format PDUs the workers sent back.
+  """
+
+  shards = [[] for i in xrange(workers)]
+  n = 0
+  for fn, parser, builder in todo:
+    data = None if cache is None else cache.get(fn)
+    if data is not None:
+      local.extend(p.to_pdu() for p in builder(version, data))
+    else:
+      shards[n % workers].append((fn, parser, builder))
+      n += 1
+
+  logging.debug("# Parsing %d files with %d workers, %d files cached", n, workers, len(todo) - n)
+
+  pool = multiprocessing.Pool(workers)
+  try:
+    results = pool.map(parse_rcynic_shard, [(version, shard) for shard in shards if shard])
+  finally:
+    pool.close()
+    pool.join()
+
+  runs = []
+  for parsed, pdus in results:
+    if cache is not None:
+      for fn, (stamp, data) in parsed.iteritems():
+        cache.put(fn, stamp, data)
+    runs.append(pdus)
+  return runs
+
+def parse_rcynic_wire(rcynic_dir, version, scan_roas = None, scan_routercerts = None,
+                      cache = None, workers = 1):
+  """
+  Parse ROAS and router certificates fetched (and validated!) by
+  rcynic, returning the wire format of the resulting PDUs as a sorted
+  iterable of strings with duplicates removed.  Each PDU object only
+  lives long enough to be encoded, so the peak cost of a full table is
+  one short string per PDU rather than one PDU object.
+
+  In normal operation, we use os.walk() and the rpki.POW library to
+  parse these data directly, but we can, if so instructed, use
+  external programs instead, for testing, simulation, or to provide
+  a way to inject local data.
+
+  If a ParseCache is supplied, we only parse files which have changed
+  since they were last recorded in the cache.  If workers is greater
+  than one, we shard the files that need parsing across a pool of
+  worker processes and merge their sorted results.
+  """
+
+  include_routercerts = RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]
+
+  local = []
+  runs = []
+
+  if scan_roas is None or (scan_routercerts is None and include_routercerts):
+    todo = []
+    for root, dirs, files in os.walk(rcynic_dir):       # pylint: disable=W0612
+      for fn in files:
+        if scan_roas is None and fn.endswith(".roa"):
+          todo.append((os.path.join(root, fn), parse_roa, roa_pdus))
+        if include_routercerts and scan_routercerts is None and fn.endswith(".cer"):
+          todo.append((os.path.join(root, fn), parse_routercert, routercert_pdus))
+    if workers > 1:
+      runs = parse_parallel(version, todo, cache, workers, local)
+    else:
+      for fn, parser, builder in todo:
+        data = parser(fn) if cache is None else cache.lookup(fn, parser)
+        local.extend(p.to_pdu() for p in builder(version, data))
+
+  if scan_roas is not None:
+    try:
+      p = subprocess.Popen((scan_roas, rcynic_dir), stdout = subprocess.PIPE)
+      for line in p.stdout:
+        line = line.split()
+        asn = line[1]
+        local.extend(PrefixPDU.from_text(version = version, asn = asn, addr = addr).to_pdu()
+                     for addr in line[2:])
+    except OSError, e:
+      sys.exit("Could not run %s: %s" % (scan_roas, e))
+
+  if include_routercerts and scan_routercerts is not None:
+    try:
+      p = subprocess.Popen((scan_routercerts, rcynic_dir), stdout = subprocess.PIPE)
+      for line in p.stdout:
+        line = line.split()
+        gski = line[0]
+        key  = line[-1]
+        local.extend(RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key).to_pdu()
+                     for asn in line[1:-1])
+    except OSError, e:
+      sys.exit("Could not run %s: %s" % (scan_routercerts, e))
+
+  local.sort()
+  if not runs:
+    return dedup_wire(local)
+  runs.append(local)
+  return dedup_wire(heapq.merge(*runs))
+
+
+class ParseCache(object):
+  """
+  Persistent index of the data we extracted from each ROA and router
+  certificate in rcynic's output, keyed by filename and validated
+  against the file's modification time and size, so that a cronjob
+  run only needs to parse the objects which have changed since the
+  previous run.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    self.seen = set()
+    self.hits = 0
+    self.misses = 0
+    try:
+      with open(filename, "rb") as f:
+        self.entries = cPickle.load(f)
+    except IOError:
+      pass
+    except Exception, e:
+      logging.warning("# Ignoring unreadable parse cache %s: %s", filename, e)
+    if not isinstance(self.entries, dict):
+      self.entries = {}
+
+  def get(self, fn):
+    """
+    Return cached data for the current incarnation of fn, or None if
+    we have no such data.
+    """
+
+    self.seen.add(fn)
+    entry = self.entries.get(fn)
+    if entry is not None and entry[0] == file_stamp(fn):
+      self.hits += 1
+      return entry[1]
+    self.misses += 1
+    return None
+
+  def put(self, fn, stamp, data):
+    """
+    Record newly parsed data for fn.
+    """
+
+    self.seen.add(fn)
+    self.entries[fn] = (stamp, data)
+
+  def lookup(self, fn, parser):
+    """
+    Return parsed data for fn, calling parser only if we have no
+    cached data for the current incarnation of the file.
+    """
+
+    data = self.get(fn)
+    if data is None:
+      stamp = file_stamp(fn)
+      data = parser(fn)
+      self.put(fn, stamp, data)
+    return data
+
+  def save(self):
+    """
+    Discard entries for files we didn't see on this run (presumably
+    because rcynic deleted them), then write the cache back to disk.
+    """
+
+    for fn in set(self.entries) - self.seen:
+      del self.entries[fn]
+    logging.debug("# Parse cache %s: %d hits, %d misses, %d entries",
+                  self.filename, self.hits, self.misses, len(self.entries))
+    tmpfn = self.filename + ".%d.tmp" % os.getpid()
+    with open(tmpfn, "wb") as f:
+      cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfn, self.filename)
+
+
 class PDUSet(list):
   """
   Object representing a set of PDUs, that is, one versioned and
@@ -191,15 +459,25 @@ class PDUSet(list):
     f = open(filename, "rb")
     r = rpki.rtr.channels.ReadBuffer()
     while True:
+      for p in r.pdus(rpki.rtr.pdus.PDU):
+        assert p.version == self.version
+        self.append(p)
+      b = f.read(65536)
+      if b == "":
+        assert r.available() == 0
+        return self
+      r.put(b)
+
+  def extend_from_wire(self, pdus):
+    """
+    Append PDUs decoded from an iterable of wire format strings.
+    """
+
+    r = rpki.rtr.channels.ReadBuffer()
+    for b in pdus:
+      r.put(b)
       p = rpki.rtr.pdus.PDU.read_pdu(r)
-      while p is None:
-        b = f.read(r.needed())
-        if b == "":
-          assert r.available() == 0
-          return self
-        r.put(b)
-        p = r.retry()
-      assert p.version == self.version
+      assert p is not None and p.version == self.version and r.available() == 0
       self.append(p)
 
   @staticmethod
@@ -207,81 +485,12 @@ class PDUSet(list):
     return ((a - b) % (1 << 32)) < (1 << 31)
 
 
-class AXFRSet(PDUSet):
+class AXFRSetBase(object):
   """
-  Object representing a complete set of PDUs, that is, one versioned
-  and (theoretically) consistant set of prefixes and router
-  certificates extracted from rcynic's output, all with the announce
-  field set.
+  Methods shared by the list-based AXFRSet and the PackedAXFRSet,
+  mostly dealing with serial numbers, nonces, and file names.
   """
 
-  @classmethod
-  def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None):
-    """
-    Parse ROAS and router certificates fetched (and validated!) by
-    rcynic to create a new AXFRSet.
-
-    In normal operation, we use os.walk() and the rpki.POW library to
-    parse these data directly, but we can, if so instructed, use
-    external programs instead, for testing, simulation, or to provide
-    a way to inject local data.
-
-    At some point the ability to parse these data from external
-    programs may move to a separate constructor function, so that we
-    can make this one a bit simpler and faster.
-    """
-
-    self = cls(version = version)
-    self.serial = rpki.rtr.channels.Timestamp.now()
-
-    include_routercerts = RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]
-
-    if scan_roas is None or (scan_routercerts is None and include_routercerts):
-      for root, dirs, files in os.walk(rcynic_dir):     # pylint: disable=W0612
-        for fn in files:
-          if scan_roas is None and fn.endswith(".roa"):
-            roa = ROA.derReadFile(os.path.join(root, fn))
-            asn = roa.getASID()
-            self.extend(PrefixPDU.from_roa(version = version, asn = asn, prefix_tuple = prefix_tuple)
-                        for prefix_tuple in roa.prefixes)
-          if include_routercerts and scan_routercerts is None and fn.endswith(".cer"):
-            x = X509.derReadFile(os.path.join(root, fn))
-            eku = x.getEKU()
-            if eku is not None and rpki.oids.id_kp_bgpsec_router in eku:
-              ski = x.getSKI()
-              key = x.getPublicKey().derWritePublic()
-              self.extend(RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key)
-                          for asn in x.asns)
-
-    if scan_roas is not None:
-      try:
-        p = subprocess.Popen((scan_roas, rcynic_dir), stdout = subprocess.PIPE)
-        for line in p.stdout:
-          line = line.split()
-          asn = line[1]
-          self.extend(PrefixPDU.from_text(version = version, asn = asn, addr = addr)
-                      for addr in line[2:])
-      except OSError, e:
-        sys.exit("Could not run %s: %s" % (scan_roas, e))
-
-    if include_routercerts and scan_routercerts is not None:
-      try:
-        p = subprocess.Popen((scan_routercerts, rcynic_dir), stdout = subprocess.PIPE)
-        for line in p.stdout:
-          line = line.split()
-          gski = line[0]
-          key  = line[-1]
-          self.extend(RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
-                      for asn in line[1:-1])
-      except OSError, e:
-        sys.exit("Could not run %s: %s" % (scan_routercerts, e))
-
-    self.sort()
-    for i in xrange(len(self) - 2, -1, -1):
-      if self[i] == self[i + 1]:
-        del self[i + 1]
-    return self
-
   @classmethod
   def load(cls, filename):
     """
@@ -316,16 +525,6 @@ class AXFRSet(PDUSet):
     except IOError:
       return None
 
-  def save_axfr(self):
-    """
-    Write AXFRSet to file with magic filename.
-    """
-
-    f = open(self.filename(), "wb")
-    for p in self:
-      f.write(p.to_pdu())
-    f.close()
-
   def destroy_old_data(self):
     """
     Destroy old data files, presumably because our nonce changed and
@@ -366,6 +565,40 @@ class AXFRSet(PDUSet):
       self.destroy_old_data()
     rpki.rtr.server.write_current(self.serial, nonce, self.version)
 
+
+class AXFRSet(PDUSet, AXFRSetBase):
+  """
+  Object representing a complete set of PDUs, that is, one versioned
+  and (theoretically) consistant set of prefixes and router
+  certificates extracted from rcynic's output, all with the announce
+  field set.
+  """
+
+  @classmethod
+  def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None,
+                   cache = None, workers = 1):
+    """
+    Parse ROAS and router certificates fetched (and validated!) by
+    rcynic to create a new AXFRSet.  See parse_rcynic_wire() for the
+    details; the cronjob uses PackedAXFRSet.parse_rcynic() instead, to
+    avoid building a PDU object for every entry in the table.
+    """
+
+    self = cls(version = version)
+    self.serial = rpki.rtr.channels.Timestamp.now()
+    self.extend_from_wire(parse_rcynic_wire(rcynic_dir, version, scan_roas, scan_routercerts, cache, workers))
+    return self
+
+  def save_axfr(self):
+    """
+    Write AXFRSet to file with magic filename.
+    """
+
+    f = open(self.filename(), "wb")
+    for p in self:
+      f.write(p.to_pdu())
+    f.close()
+
   def save_ixfr(self, other):
     """
     Comparing this AXFRSet with an older one and write the resulting
@@ -449,6 +682,261 @@ class IXFRSet(PDUSet):
       logging.debug(p)
 
 
+class PackedPDUSet(object):
+  """
+  Compact representation of a sorted set of PDUs, for when we need to
+  hold or compare entire tables without paying for a Python object per
+  PDU.  We keep the concatenated wire format of the PDUs, exactly as
+  found in our AXFR and IXFR files, plus an array of record offsets;
+  individual PDUs are only decoded when someone asks for them.
+  """
+
+  length_struct = struct.Struct("!L")
+
+  def __init__(self, version, blob = ""):
+    assert version in rpki.rtr.pdus.PDU.version_map
+    self.version = version
+    self.blob = blob
+    self.offsets = array.array("L")
+    offset = 0
+    while offset < len(blob):
+      self.offsets.append(offset)
+      if offset + 8 > len(blob):
+        raise rpki.rtr.pdus.CorruptData("Truncated PDU header at offset %d" % offset)
+      length = self.length_struct.unpack_from(blob, offset + 4)[0]
+      if length < 8:
+        raise rpki.rtr.pdus.CorruptData("PDU length of %d at offset %d can't be right" % (length, offset))
+      offset += length
+    if offset != len(blob):
+      raise rpki.rtr.pdus.CorruptData("Truncated PDU at offset %d" % self.offsets[-1])
+    self.offsets.append(offset)
+
+  @classmethod
+  def _load_file(cls, filename, version):
+    """
+    Low-level method to read PackedPDUSet from a file.
+    """
+
+    with open(filename, "rb") as f:
+      return cls(version = version, blob = f.read())
+
+  @staticmethod
+  def seq_ge(a, b):
+    return PDUSet.seq_ge(a, b)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    """
+    Return wire format of the i'th PDU.
+    """
+
+    return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+  def __eq__(self, other):
+    return isinstance(other, PackedPDUSet) and self.version == other.version and self.blob == other.blob
+
+  def __ne__(self, other):
+    return not self == other
+
+  def iterpdus(self):
+    """
+    Iterate over decoded PDUs.
+    """
+
+    r = rpki.rtr.channels.ReadBuffer()
+    r.put(self.blob)
+    return r.pdus(rpki.rtr.pdus.PDU)
+
+  def announce_offset(self, i):
+    """
+    Return offset within the blob of the i'th PDU's announce flag.
+    """
+
+    offset = self.offsets[i]
+    pdu_type = ord(self.blob[offset + 1])
+    return offset + rpki.rtr.pdus.PDU.version_map[self.version][pdu_type].announce_offset
+
+  def key(self, i):
+    """
+    Return wire format of the i'th PDU with its announce flag set.
+    This is the sort key for the entries in an IXFR.
+    """
+
+    flag = self.announce_offset(i)
+    if self.blob[flag] == "\x01":
+      return self[i]
+    return self.blob[self.offsets[i]:flag] + "\x01" + self.blob[flag + 1:self.offsets[i + 1]]
+
+  def write_pdu(self, f, i, announce):
+    """
+    Write the i'th PDU to a file, with its announce flag set as specified.
+    """
+
+    flag = self.announce_offset(i)
+    if ord(self.blob[flag]) == announce:
+      f.write(self.blob[self.offsets[i]:self.offsets[i + 1]])
+    else:
+      f.write(self.blob[self.offsets[i]:flag])
+      f.write(chr(announce))
+      f.write(self.blob[flag + 1:self.offsets[i + 1]])
+
+
+class PackedAXFRSet(PackedPDUSet, AXFRSetBase):
+  """
+  Packed equivalent of an AXFRSet.  The cronjob uses this to hold the
+  new table and to compare it against the old ones.
+  """
+
+  @classmethod
+  def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None,
+                   cache = None, workers = 1):
+    """
+    Packed equivalent of AXFRSet.parse_rcynic(): build the new table
+    straight from the merged, deduplicated wire format.
+    """
+
+    self = cls(version = version,
+               blob = "".join(parse_rcynic_wire(rcynic_dir, version, scan_roas, scan_routercerts,
+                                                cache, workers)))
+    self.serial = rpki.rtr.channels.Timestamp.now()
+    return self
+
+  @classmethod
+  def from_axfr(cls, axfr):
+    """
+    Pack an AXFRSet.
+    """
+
+    self = cls(version = axfr.version, blob = "".join(p.to_pdu() for p in axfr))
+    self.serial = axfr.serial
+    return self
+
+  def save_axfr(self):
+    """
+    Write PackedAXFRSet to file with magic filename.
+    """
+
+    with open(self.filename(), "wb") as f:
+      f.write(self.blob)
+
+  def save_ixfr(self, other):
+    """
+    Compare this PackedAXFRSet with an older one and write the
+    resulting IXFRSet to file with magic filename.  Every PDU in an
+    AXFR has its announce flag set, so comparing wire format gives the
+    same ordering as comparing PDU objects.
+    """
+
+    f = open("%d.ix.%d.v%d" % (self.serial, other.serial, self.version), "wb")
+    old = other
+    new = self
+    len_old = len(old)
+    len_new = len(new)
+    i_old = i_new = 0
+    while i_old < len_old and i_new < len_new:
+      pdu_old = old[i_old]
+      pdu_new = new[i_new]
+      if pdu_old < pdu_new:
+        old.write_pdu(f, i_old, 0)
+        i_old += 1
+      elif pdu_old > pdu_new:
+        new.write_pdu(f, i_new, 1)
+        i_new += 1
+      else:
+        i_old += 1
+        i_new += 1
+    for i in xrange(i_old, len_old):
+      old.write_pdu(f, i, 0)
+    for i in xrange(i_new, len_new):
+      new.write_pdu(f, i, 1)
+    f.close()
+
+  def show(self):
+    """
+    Print this PackedAXFRSet.
+    """
+
+    logging.debug("# AXFR %d (%s) v%d", self.serial, self.serial, self.version)
+    for p in self.iterpdus():
+      logging.debug(p)
+
+
+class PackedIXFRSet(PackedPDUSet):
+  """
+  Packed equivalent of an IXFRSet.  The cronjob uses these as a
+  journal of deltas between consecutive serials, composing them to
+  produce IXFRs from older serials without reloading old AXFRs.
+  """
+
+  @classmethod
+  def load(cls, filename):
+    """
+    Load a PackedIXFRSet from a file, parse filename to obtain version and serials.
+    """
+
+    fn1, fn2, fn3, fn4 = os.path.basename(filename).split(".")
+    assert fn1.isdigit() and fn2 == "ix" and fn3.isdigit() and fn4.startswith("v") and fn4[1:].isdigit()
+    version = int(fn4[1:])
+    self = cls._load_file(filename, version)
+    self.from_serial = rpki.rtr.channels.Timestamp(fn3)
+    self.to_serial = rpki.rtr.channels.Timestamp(fn1)
+    return self
+
+  def filename(self):
+    """
+    Generate filename for this PackedIXFRSet.
+    """
+
+    return "%d.ix.%d.v%d" % (self.to_serial, self.from_serial, self.version)
+
+  def save_ixfr(self):
+    """
+    Write PackedIXFRSet to file with magic filename.
+    """
+
+    with open(self.filename(), "wb") as f:
+      f.write(self.blob)
+
+  def compose(self, later):
+    """
+    Compose this IXFRSet with a later one which starts at the serial
+    where this one ends, returning an IXFRSet that goes straight from
+    our starting serial to the later one's ending serial.
+
+    Both inputs are sorted by key, so this is another linear merge.  A
+    PDU that appears in both deltas was either withdrawn and then
+    re-announced or announced and then withdrawn; either way the net
+    effect is nothing, so we drop it.  Everything else passes through
+    unchanged.
+    """
+
+    assert self.version == later.version and self.to_serial == later.from_serial
+    parts = []
+    len_a = len(self)
+    len_b = len(later)
+    i_a = i_b = 0
+    while i_a < len_a and i_b < len_b:
+      key_a = self.key(i_a)
+      key_b = later.key(i_b)
+      if key_a < key_b:
+        parts.append(self[i_a])
+        i_a += 1
+      elif key_a > key_b:
+        parts.append(later[i_b])
+        i_b += 1
+      else:
+        i_a += 1
+        i_b += 1
+    parts.extend(self[i] for i in xrange(i_a, len_a))
+    parts.extend(later[i] for i in xrange(i_b, len_b))
+    result = self.__class__(version = self.version, blob = "".join(parts))
+    result.from_serial = self.from_serial
+    result.to_serial = later.to_serial
+    return result
+
+
 def kick_all(serial):
   """
   Kick any existing server processes to wake them up.
@@ -497,6 +985,8 @@ def cronjob_main(args):
       logging.critical(str(e))
       sys.exit(1)
 
+  cache = rpki.rtr.generator.ParseCache(args.parse_cache) if args.parse_cache else None
+
   for version in sorted(rpki.rtr.server.PDU.version_map.iterkeys(), reverse = True):
 
     logging.debug("# Generating updates for protocol version %d", version)
@@ -504,21 +994,42 @@ def cronjob_main(args):
     old_ixfrs = glob.glob("*.ix.*.v%d" % version)
 
     current = rpki.rtr.server.read_current(version)[0]
-    cutoff = Timestamp.now(-(24 * 60 * 60))
+    cutoff = Timestamp.now(-args.history)
     for f in glob.iglob("*.ax.v%d" % version):
       t = Timestamp(int(f.split(".")[0]))
       if  t < cutoff and t != current:
         logging.debug("# Deleting old file %s, timestamp %s", f, t)
         os.unlink(f)
 
-    pdus = rpki.rtr.generator.AXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
-    if pdus == rpki.rtr.generator.AXFRSet.load_current(version):
+    pdus = rpki.rtr.generator.PackedAXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas,
+                                                         args.scan_routercerts, cache, args.workers)
+    current_axfr = rpki.rtr.generator.PackedAXFRSet.load_current(version)
+    if pdus == current_axfr:
       logging.debug("# No change, new serial not needed")
       continue
     pdus.save_axfr()
+
+    # Compute the delta from the current serial, then chain it onto
+    # the deltas we generated last time rather than reloading every
+    # retained AXFR.  Fall back to diffing against old AXFRs for any
+    # serial the journal doesn't cover.
+
+    chained = set()
+    if current_axfr is not None:
+      pdus.save_ixfr(current_axfr)
+      chained.add(current_axfr.serial)
+      delta = rpki.rtr.generator.PackedIXFRSet.load("%d.ix.%d.v%d" % (pdus.serial, current_axfr.serial, version))
+      for ixfr in old_ixfrs:
+        to_serial, from_serial = (Timestamp(int(i)) for i in ixfr.split(".")[0:3:2])
+        if to_serial == current_axfr.serial and from_serial >= cutoff and from_serial not in chained:
+          logging.debug("# Chaining %s onto %s", ixfr, delta.filename())
+          rpki.rtr.generator.PackedIXFRSet.load(ixfr).compose(delta).save_ixfr()
+          chained.add(from_serial)
+
     for axfr in glob.iglob("*.ax.v%d" % version):
-      if axfr != pdus.filename():
-        pdus.save_ixfr(rpki.rtr.generator.AXFRSet.load(axfr))
+      if axfr != pdus.filename() and Timestamp(int(axfr.split(".")[0])) not in chained:
+        pdus.save_ixfr(rpki.rtr.generator.PackedAXFRSet.load(axfr))
+
     pdus.mark_current(args.force_zero_nonce)
 
     logging.debug("# New serial is %d (%s)", pdus.serial, pdus.serial)
@@ -533,6 +1044,9 @@ def cronjob_main(args):
       except OSError:
         pass
 
+  if cache is not None:
+    cache.save()
+
 
 def show_main(args):
   """
@@ -566,6 +1080,10 @@ def argparse_setup(subparsers):
   subparser.add_argument("--scan-roas", help = "specify an external scan_roas program")
   subparser.add_argument("--scan-routercerts", help = "specify an external scan_routercerts program")
   subparser.add_argument("--force_zero_nonce", action = "store_true", help = "force nonce value of zero")
+  subparser.add_argument("--parse-cache", help = "filename for cache of data parsed from rcynic output")
+  subparser.add_argument("--history", type = int, default = 24 * 60 * 60,
+                         help = "how many seconds of incremental updates to keep")
+  subparser.add_argument("--workers", type = int, default = 1, help = "number of processes to use when parsing rcynic output")
   subparser.add_argument("rcynic_dir", help = "directory containing validated rcynic output tree")
   subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
 
@@ -53,6 +53,7 @@ def main():
   os.environ["TZ"] = "UTC"
   time.tzset()
 
+  import rpki.rtr.pdus
   from rpki.rtr.server    import argparse_setup as argparse_setup_server
   from rpki.rtr.client    import argparse_setup as argparse_setup_client
   from rpki.rtr.generator import argparse_setup as argparse_setup_generator
@@ -91,4 +92,6 @@ def main():
   logging.root.addHandler(handler)
   logging.root.setLevel(int(getattr(logging, args.log_level.upper())))
 
+  rpki.rtr.pdus.check_round_trip = args.debug
+
   return args.func(args)
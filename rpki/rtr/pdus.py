@@ -25,6 +25,10 @@ import base64
 import logging
 import rpki.POW
 
+# Check that every PDU we decode re-encodes to the bytes we received.
+# Debugging only, this roughly doubles the cost of decoding.
+check_round_trip = False
+
 # Exceptions
 
 class PDUException(Exception):
@@ -139,7 +143,7 @@ class PDU(object):
     if not reader.ready():
       return None
     assert reader.available() >= cls.header_struct.size
-    version, pdu_type, length = cls.header_struct.unpack(reader.buffer[:cls.header_struct.size])
+    version, pdu_type, length = cls.header_struct.unpack_from(reader.buffer, reader.offset)
     reader.check_version(version)
     if pdu_type not in cls.version_map[version]:
       raise UnsupportedPDUType(
@@ -188,7 +192,8 @@ class PDUWithSerial(PDU):
     assert version == self.version and pdu_type == self.pdu_type
     if length != 12:
       raise CorruptData("PDU length of %d can't be right" % length, pdu = self)
-    assert b == self.to_pdu()
+    if check_round_trip:
+      assert b == self.to_pdu()
     return self
 
 
@@ -225,7 +230,8 @@ class PDUWithNonce(PDU):
     assert version == self.version and pdu_type == self.pdu_type
     if length != 8:
       raise CorruptData("PDU length of %d can't be right" % length, pdu = self)
-    assert b == self.to_pdu()
+    if check_round_trip:
+      assert b == self.to_pdu()
     return self
 
 
@@ -258,7 +264,8 @@ class PDUEmpty(PDU):
       raise CorruptData("Must-be-zero field isn't zero" % length, pdu = self)
     if length != 8:
       raise CorruptData("PDU length of %d can't be right" % length, pdu = self)
-    assert b == self.to_pdu()
+    if check_round_trip:
+      assert b == self.to_pdu()
     return self
 
 @wire_pdu
@@ -390,7 +397,8 @@ class EndOfDataPDUv1(EndOfDataPDUv0):
     assert version == self.version and pdu_type == self.pdu_type
     if length != 24:
       raise CorruptData("PDU length of %d can't be right" % length, pdu = self)
-    assert b == self.to_pdu()
+    if check_round_trip:
+      assert b == self.to_pdu()
     return self
 
 
@@ -416,6 +424,7 @@ class PrefixPDU(PDU):
 
   header_struct = struct.Struct("!BB2xLBBBx")
   asnum_struct = struct.Struct("!L")
+  announce_offset = 8                   # Offset of flags byte in header_struct
 
   def __str__(self):
     plm = "%s/%s-%s" % (self.prefix, self.prefixlen, self.max_prefixlen)
@@ -470,16 +479,18 @@ class PrefixPDU(PDU):
   def got_pdu(self, reader):
     if not reader.ready():
       return None
-    b1 = reader.get(self.header_struct.size)
-    b2 = reader.get(self.address_byte_count)
-    b3 = reader.get(self.asnum_struct.size)
-    version, pdu_type, length, self.announce, self.prefixlen, self.max_prefixlen = self.header_struct.unpack(b1)
+    b = reader.get(reader.need)
+    version, pdu_type, length, self.announce, self.prefixlen, self.max_prefixlen = self.header_struct.unpack_from(b)
     assert version == self.version and pdu_type == self.pdu_type
-    if length != len(b1) + len(b2) + len(b3):
-      raise CorruptData("Got PDU length %d, expected %d" % (length, len(b1) + len(b2) + len(b3)), pdu = self)
-    self.prefix = rpki.POW.IPAddress.fromBytes(b2)
-    self.asn = self.asnum_struct.unpack(b3)[0]
-    assert b1 + b2 + b3 == self.to_pdu()
+    asnum_offset = self.header_struct.size + self.address_byte_count
+    if length != asnum_offset + self.asnum_struct.size:
+      raise CorruptData("Got PDU length %d, expected %d" % (length, asnum_offset + self.asnum_struct.size), pdu = self)
+    self.prefix = rpki.POW.IPAddress.fromBytes(b[self.header_struct.size:asnum_offset])
+    self.asn = self.asnum_struct.unpack_from(b, asnum_offset)[0]
+    if check_round_trip:
+      assert b == self.to_pdu()
+    else:
+      self._pdu = b
     return self
 
 
@@ -510,6 +521,7 @@ class RouterKeyPDU(PDU):
   pdu_type = 9
 
   header_struct = struct.Struct("!BBBxL20sL")
+  announce_offset = 2                   # Offset of flags byte in header_struct
 
   def __str__(self):
     return "%s %8s  %-32s %s" % ("+" if self.announce else "-", self.asn,
@@ -550,14 +562,16 @@ class RouterKeyPDU(PDU):
   def got_pdu(self, reader):
     if not reader.ready():
       return None
-    header = reader.get(self.header_struct.size)
-    version, pdu_type, self.announce, length, self.ski, self.asn = self.header_struct.unpack(header)
+    b = reader.get(reader.need)
+    version, pdu_type, self.announce, length, self.ski, self.asn = self.header_struct.unpack_from(b)
     assert version == self.version and pdu_type == self.pdu_type
-    remaining = length - self.header_struct.size
-    if remaining <= 0:
+    if length <= self.header_struct.size:
       raise CorruptData("Got PDU length %d, minimum is %d" % (length, self.header_struct.size + 1), pdu = self)
-    self.key = reader.get(remaining)
-    assert header + self.key == self.to_pdu()
+    self.key = b[self.header_struct.size:]
+    if check_round_trip:
+      assert b == self.to_pdu()
+    else:
+      self._pdu = b
     return self
 
 
@@ -641,8 +655,9 @@ class ErrorReportPDU(PDU):
     if length != self.header_struct.size + self.string_struct.size * 2 + self.pdulen + self.errlen:
       raise CorruptData("Got PDU length %d, expected %d" % (
         length, self.header_struct.size + self.string_struct.size * 2 + self.pdulen + self.errlen))
-    assert (header
-            + self.to_counted_string(self.errpdu)
-            + self.to_counted_string(self.errmsg.encode("utf8"))
-            == self.to_pdu())
+    if check_round_trip:
+      assert (header
+              + self.to_counted_string(self.errpdu)
+              + self.to_counted_string(self.errmsg.encode("utf8"))
+              == self.to_pdu())
     return self
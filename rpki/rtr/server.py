@@ -22,6 +22,7 @@ Server implementation for the RPKI-RTR protocol (RFC 6810 et sequalia).
 
 import os
 import sys
+import mmap
 import errno
 import socket
 import signal
@@ -56,7 +57,7 @@ class PDU(rpki.rtr.pdus.PDU):
     fn2 = os.path.splitext(filename)[1]
     assert fn2.startswith(".v") and fn2[2:].isdigit() and int(fn2[2:]) == server.version
 
-    f = open(filename, "rb")
+    f = server.open_file(filename)
     server.push_pdu(CacheResponsePDU(version = server.version,
                                      nonce   = server.current_nonce))
     server.push_file(f)
@@ -158,7 +159,7 @@ class ErrorReportPDU(rpki.rtr.pdus.ErrorReportPDU):
     server.logger.error(self)
     if self.errno in self.fatal:
       server.logger.error("[Shutting down due to reported fatal protocol error]")
-      sys.exit(1)
+      server.shutdown()
 
 
 def read_current(version):
@@ -205,6 +206,85 @@ class FileProducer(object):
     return self.handle.read(self.buffersize)
 
 
+def map_file(f):
+  """
+  Return a read-only mmap of an open file.  Raises ValueError or
+  EnvironmentError if the file can't be mapped, eg, because it's empty.
+  """
+
+  return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+class BufferProducer(object):
+  """
+  Producer object for asynchat which hands out chunks of a string or
+  mmap we already hold.  Unlike pushing the data directly, this
+  doesn't make asynchat copy the whole thing up front, and since the
+  chunks are buffer objects, data from an mmap goes straight from the
+  page cache to the socket without passing through a Python string.
+  """
+
+  def __init__(self, data, buffersize):
+    self.data = data
+    self.buffersize = buffersize
+    self.offset = 0
+
+  def more(self):
+    b = buffer(self.data, self.offset, self.buffersize)
+    self.offset += len(b)
+    return b
+
+
+class Snapshots(object):
+  """
+  In-memory copies of the current serial number, nonce, and AXFR and
+  IXFR files, shared by all the channels of a single-process server so
+  that we only read each of them once no matter how many clients ask.
+  """
+
+  def __init__(self):
+    self.currents = {}
+    self.files = {}
+
+  def read_current(self, version):
+    """
+    Return current serial number and nonce, rereading the file if it
+    has changed since we last looked.
+    """
+
+    if version is None:
+      return None, None
+    try:
+      mtime = os.stat("current.v%d" % version).st_mtime
+    except OSError:
+      mtime = None
+    if version not in self.currents or self.currents[version][0] != mtime:
+      self.currents[version] = (mtime, read_current(version))
+      self.files.clear()
+    return self.currents[version][1]
+
+  def get(self, filename):
+    """
+    Return content of an AXFR or IXFR file.  Caller should catch IOError.
+    """
+
+    if filename not in self.files:
+      with open(filename, "rb") as f:
+        try:
+          self.files[filename] = map_file(f)
+        except (ValueError, EnvironmentError):
+          self.files[filename] = f.read()
+    return self.files[filename]
+
+  def refresh(self):
+    """
+    Forget everything, presumably because the cronjob kicked us.
+    """
+
+    self.currents.clear()
+    self.files.clear()
+
+
 class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
   """
   Kludge to deal with ssh's habit of sometimes (compile time option)
@@ -214,6 +294,8 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
   server's output to a different file descriptor.
   """
 
+  ac_out_buffer_size = 65536
+
   def __init__(self):
     """
     Set up stdout.
@@ -231,11 +313,16 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
 
   def push_file(self, f):
     """
-    Write content of a file to stream.
+    Write content of a file to stream.  We map the file into memory
+    if we can, falling back to reading it in chunks if we can't.
     """
 
     try:
-      self.push_with_producer(FileProducer(f, self.ac_out_buffer_size))
+      producer = BufferProducer(map_file(f), self.ac_out_buffer_size)
+    except (ValueError, EnvironmentError):
+      producer = FileProducer(f, self.ac_out_buffer_size)
+    try:
+      self.push_with_producer(producer)
     except OSError, e:
       if e.errno != errno.EAGAIN:
         raise
@@ -298,6 +385,21 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
 
     return self.writer.push_file(f)
 
+  def open_file(self, filename):
+    """
+    Open a file for send_file().  Caller should catch IOError.
+    """
+
+    return open(filename, "rb")
+
+  def shutdown(self):
+    """
+    Shut down after a fatal protocol error.  For a server running on
+    stdin and stdout, that just means exiting.
+    """
+
+    sys.exit(1)
+
   def deliver_pdu(self, pdu):
     """
     Handle received PDU.
@@ -343,6 +445,148 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
       self.logger.debug("Cronjob kicked me but I see no serial change, ignoring")
 
 
+class SharedServerChannel(ServerChannel):
+  """
+  Server protocol engine for one client of a single-process server.
+  Rather than running on stdin and stdout and exiting when done, this
+  runs on a socket accepted by a SharedListener, and takes serial
+  numbers and AXFR/IXFR data from the listener's shared Snapshots.
+  """
+
+  ac_out_buffer_size = 65536
+
+  def __init__(self, sock, listener, logger):
+    rpki.rtr.channels.PDUChannel.__init__(self, root_pdu_class = PDU, sock = sock)
+    self.listener = listener
+    self.logger = logger
+    self.refresh = listener.refresh
+    self.retry = listener.retry
+    self.expire = listener.expire
+    self.get_serial()
+    self.start_new_pdu()
+
+  def writable(self):
+    return rpki.rtr.channels.PDUChannel.writable(self)
+
+  def push(self, data):
+    return rpki.rtr.channels.PDUChannel.push(self, data)
+
+  def push_with_producer(self, producer):
+    return rpki.rtr.channels.PDUChannel.push_with_producer(self, producer)
+
+  def push_pdu(self, pdu):
+    return rpki.rtr.channels.PDUChannel.push_pdu(self, pdu)
+
+  def open_file(self, filename):
+    """
+    Fetch file content from the shared snapshots.  Caller should
+    catch IOError.
+    """
+
+    return self.listener.snapshots.get(filename)
+
+  def push_file(self, data):
+    """
+    Write shared file content to stream.
+    """
+
+    self.push_with_producer(BufferProducer(data, self.ac_out_buffer_size))
+
+  def get_serial(self):
+    """
+    Read, cache, and return current serial number from the shared snapshots.
+    """
+
+    self.current_serial, self.current_nonce = self.listener.snapshots.read_current(self.version)
+    return self.current_serial
+
+  def shutdown(self):
+    """
+    Close this channel after a fatal protocol error.
+    """
+
+    self.close_when_done()
+
+  def handle_close(self):
+    """
+    Client went away, forget about it.
+    """
+
+    self.logger.debug("[Client closed channel]")
+    self.close()
+    self.listener.channels.discard(self)
+
+  def handle_error(self):
+    """
+    Log unhandled exceptions and drop this client, rather than taking
+    every other client down with us.
+    """
+
+    self.logger.exception("[Unhandled exception, closing channel]")
+    self.close()
+    self.listener.channels.discard(self)
+
+
+class SharedListener(asyncore.dispatcher, object):
+  """
+  TCP listener for a single-process server.  Accepts connections,
+  wraps each in a SharedServerChannel, and fans notifications from
+  the kickme channel out to all of them.
+  """
+
+  def __init__(self, port, refresh, retry, expire):
+    asyncore.dispatcher.__init__(self)                  # Old-style class
+    self.logger = logging.LoggerAdapter(logging.root, dict(connection = ""))
+    self.refresh = refresh
+    self.retry = retry
+    self.expire = expire
+    self.snapshots = Snapshots()
+    self.channels = set()
+    try:
+      self.create_socket(socket.AF_INET6, socket.SOCK_STREAM)
+      self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    except:                             # pylint: disable=W0702
+      if self.socket is not None:
+        self.close()
+      self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(("", port))
+    self.listen(128)
+    self.logger.debug("[Listening on port %s]", port)
+
+  def handle_accept(self):
+    """
+    Set up a new client.
+    """
+
+    try:
+      s, ai = self.accept()
+    except (TypeError, socket.error):
+      return
+    host, port = ai[0:2]
+    tag = "/tcp/%s.%s" % (host, port) if ":" in host else "/tcp/%s:%s" % (host, port)
+    logger = logging.LoggerAdapter(logging.root, dict(connection = tag))
+    logger.debug("[Accepted connection]")
+    self.channels.add(SharedServerChannel(sock = s, listener = self, logger = logger))
+
+  def notify(self, data = None):
+    """
+    Cronjob kicked us: discard cached data, then let each client
+    decide whether it needs to send a notify PDU.
+    """
+
+    self.snapshots.refresh()
+    for channel in list(self.channels):
+      channel.notify(data)
+
+  def handle_error(self):
+    """
+    Handle errors caught by asyncore main loop.
+    """
+
+    self.logger.exception("[Unhandled exception in listener]")
+
+
 class KickmeChannel(asyncore.dispatcher, object):
   """
   asyncore dispatcher for the PF_UNIX socket that cronjob mode uses to
@@ -510,6 +754,9 @@ def listener_main(args):
 
   # Perhaps we should daemonize?  Deal with that later.
 
+  if args.single_process:
+    return shared_listener_main(args)
+
   # server_main() handles args.rpki_rtr_dir.
 
   listener = None
@@ -555,6 +802,32 @@ def listener_main(args):
         break
 
 
+def shared_listener_main(args):
+  """
+  Single-process version of listener_main().  Rather than forking a
+  server process per connection, serve all clients from one asyncore
+  loop, sharing one in-memory copy of the current data and one kickme
+  socket among all of them.
+  """
+
+  if args.rpki_rtr_dir:
+    try:
+      os.chdir(args.rpki_rtr_dir)
+    except OSError, e:
+      sys.exit(e)
+
+  kickme = None
+  try:
+    listener = SharedListener(port = args.port, refresh = args.refresh, retry = args.retry, expire = args.expire)
+    kickme = KickmeChannel(server = listener)
+    asyncore.loop(timeout = None, use_poll = True)
+  except KeyboardInterrupt:
+    sys.exit(0)
+  finally:
+    if kickme is not None:
+      kickme.cleanup()
+
+
 def argparse_setup(subparsers):
   """
   Set up argparse stuff for commands in this module.
@@ -589,5 +862,7 @@ def argparse_setup(subparsers):
   subparser.add_argument("--refresh", type = refresh, help = "override default refresh timer")
   subparser.add_argument("--retry",   type = retry,   help = "override default retry timer")
   subparser.add_argument("--expire",  type = expire,  help = "override default expire timer")
+  subparser.add_argument("--single-process", action = "store_true",
+                         help = "serve all clients from one process rather than forking per connection")
   subparser.add_argument("port",      type = int,     help = "TCP port on which to listen")
   subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
@@ -32,6 +32,7 @@
 SQL interface code.
 """
 
+import sys
 import logging
 import weakref
 
@@ -41,9 +42,20 @@ import rpki.x509
 import rpki.resource_set
 import rpki.sundial
 import rpki.log
+import rpki.metrics
 
 logger = logging.getLogger(__name__)
 
+query_count   = rpki.metrics.counter("rpki_sql_queries_total",
+                                     "SQL statements executed, by statement type.",
+                                     ("statement",))
+query_seconds = rpki.metrics.histogram("rpki_sql_query_seconds",
+                                       "SQL statement latency, by statement type.",
+                                       ("statement",))
+query_errors  = rpki.metrics.counter("rpki_sql_errors_total",
+                                     "SQL statements which raised a MySQL error, by statement type.",
+                                     ("statement",))
+
 class session(object):
   """
   SQL session layer.
@@ -56,6 +68,19 @@ class session(object):
 
   ping_threshold = rpki.sundial.timedelta(seconds = 60)
 
+  ## @var batch_sweep
+  # Whether sweep() should write everything in a single transaction,
+  # grouping deletions into multi-row statements, rather than issuing
+  # one autocommitted statement per object.
+
+  batch_sweep = True
+
+  ## @var batch_size
+  # Maximum number of objects in one batch of updates or deletions in
+  # batch mode.
+
+  batch_size = 500
+
   def __init__(self, cfg):
 
     self.username = cfg.get("sql-username")
@@ -69,6 +94,7 @@ class session(object):
 
     self.cache = weakref.WeakValueDictionary()
     self.dirty = set()
+    self.indexes = {}
 
     self.connect()
 
@@ -90,13 +116,20 @@ class session(object):
     self.db = None
 
   def _wrap_execute(self, func, query, args):
+    labels = (query.split(None, 1)[0].upper(),)
     try:
       now = rpki.sundial.now()
       if now > self.timestamp + self.ping_threshold:
         self.db.ping(True)
       self.timestamp = now
-      return func(query, args)
+      started = rpki.metrics.now()
+      try:
+        return func(query, args)
+      finally:
+        query_count.inc(labels)
+        query_seconds.since(started, labels)
     except _mysql_exceptions.MySQLError:
+      query_errors.inc(labels)
       if self.dirty:
         logger.warning("MySQL exception with dirty objects in SQL cache!")
       raise
@@ -122,6 +155,84 @@ class session(object):
     self.assert_pristine()
     self.cache.clear()
 
+  def index_lookup(self, cls, column, value):
+    """
+    Look up objects of class cls with the given column value in the
+    preloaded indexes.  Returns None if no index covers that value.
+    """
+    idx = self.indexes.get((cls, column))
+    if idx is None:
+      return None
+    return idx.lookup(value)
+
+  def index_update(self, obj):
+    """
+    Bring the preloaded indexes up to date after writing obj to SQL.
+    """
+    for (cls, column), idx in self.indexes.iteritems():
+      if cls is obj.__class__:
+        idx.update(obj)
+
+  def index_remove(self, obj):
+    """
+    Bring the preloaded indexes up to date after deleting obj from
+    SQL.  Deleting a row can cascade to rows which reference it, and
+    on to rows which reference those, so we also stop trusting any
+    index for those.
+    """
+    self._index_unfile(obj.__class__, obj)
+    self._index_cascade(obj.sql_template.index, getattr(obj, obj.sql_template.index), set())
+
+  def _index_unfile(self, cls, obj):
+    """
+    Remove obj from every index of cls, or if obj is None, drop every
+    index of cls entirely.
+    """
+    for (c, col), idx in self.indexes.iteritems():
+      if c is cls:
+        if obj is None:
+          for value in idx.covered.keys():
+            idx.drop(value)
+        else:
+          idx.remove(obj)
+
+  def _index_cascade(self, column, value, seen):
+    """
+    Follow a cascaded delete of the rows whose column matches value
+    through the indexes.  Where an index tells us which rows went, we
+    follow the cascade from each of them; where it doesn't (or value
+    is None, meaning we don't know which rows went), we have to stop
+    trusting everything we know about that class and its dependents.
+    """
+    if (column, value) in seen:
+      return
+    seen.add((column, value))
+    for (cls, col), idx in self.indexes.items():
+      if col != column:
+        continue
+      members = None if value is None else idx.lookup(value)
+      if value is not None:
+        idx.drop(value)
+      if members is None:
+        self._index_unfile(cls, None)
+        self._index_cascade(cls.sql_template.index, None, seen)
+      else:
+        for m in members:
+          self._index_unfile(cls, m)
+          self._index_cascade(cls.sql_template.index, getattr(m, cls.sql_template.index), seen)
+
+  def index_forget(self, obj):
+    """
+    Stop trusting the preloaded indexes for anything obj was or would
+    be indexed under, because we no longer know what SQL holds for it.
+    """
+    key = getattr(obj, obj.sql_template.index)
+    for (cls, col), idx in self.indexes.iteritems():
+      if cls is obj.__class__:
+        if key in idx.filed:
+          idx.drop(idx.filed[key])
+        idx.drop(getattr(obj, col))
+
   def assert_pristine(self):
     """
     Assert that there are no dirty objects in the cache.
@@ -132,6 +243,8 @@ class session(object):
     """
     Write any dirty objects out to SQL.
     """
+    if self.batch_sweep and self.dirty:
+      return self._batch_sweep()
     for s in self.dirty.copy():
       #if s.sql_cache_debug:
       logger.debug("Sweeping (%s) %r", "deleting" if s.sql_deleted else "storing", s)
@@ -141,6 +254,103 @@ class session(object):
         s.sql_store()
     self.assert_pristine()
 
+  def _batch_sweep(self):
+    """
+    Batch mode sweep(): one transaction, with updates and deletions
+    grouped by SQL template.  Each batch_size deletions take one
+    statement; updates and inserts still take one statement per object
+    (inserts because we need the auto-increment index MySQL assigns to
+    each of them), but share the one commit.
+
+    Objects we've updated or deleted aren't marked clean until the
+    transaction commits.  If it fails, we roll back, undo the
+    bookkeeping for any objects we inserted, and fall back to writing
+    objects one at a time (see _sweep_isolating_failures()), then
+    re-raise the original exception.
+    """
+
+    updates = {}
+    deletes = {}
+    inserted = []
+
+    logger.debug("Sweeping %d dirty objects", len(self.dirty))
+
+    self.db.autocommit(False)
+    try:
+      for s in self.dirty.copy():
+        if s.sql_deleted:
+          if s.sql_in_db:
+            deletes.setdefault(s.sql_template, []).append(s)
+          else:
+            s.sql_mark_clean()
+        elif s.sql_in_db:
+          updates.setdefault(s.sql_template, []).append(s)
+        else:
+          s.sql_store()
+          inserted.append(s)
+      for t, objs in updates.iteritems():
+        for i in xrange(0, len(objs), self.batch_size):
+          t.store_batch(self, objs[i:i + self.batch_size])
+      for t, objs in deletes.iteritems():
+        for i in xrange(0, len(objs), self.batch_size):
+          t.delete_batch(self, objs[i:i + self.batch_size])
+      self.db.commit()
+    except:                             # pylint: disable=W0702
+      exc_info = sys.exc_info()
+      self.db.rollback()
+      self.db.autocommit(True)
+      for s in inserted:
+        key = (s.__class__, getattr(s, s.sql_template.index))
+        if self.cache.get(key) is s:
+          del self.cache[key]
+        self.index_remove(s)
+        s.sql_in_db = False
+        s.sql_mark_dirty()
+      self._sweep_isolating_failures()
+      raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+      self.db.autocommit(True)
+
+    for objs in updates.itervalues():
+      for s in objs:
+        self.index_update(s)
+        s.sql_mark_clean()
+    for objs in deletes.itervalues():
+      for s in objs:
+        key = (s.__class__, getattr(s, s.sql_template.index))
+        if self.cache.get(key) is s:
+          del self.cache[key]
+        self.index_remove(s)
+        s.sql_in_db = False
+        s.sql_mark_clean()
+
+    self.assert_pristine()
+
+  def _sweep_isolating_failures(self):
+    """
+    Fallback after a failed batch sweep: write dirty objects one at a
+    time, as the unbatched sweep() does, so that one object SQL won't
+    accept doesn't cost us all the others.  Any object which fails is
+    dropped from the dirty set, the cache, and the preloaded indexes,
+    rather than left dirty to make every later sweep() fail too; the
+    next fetch of it reloads whatever SQL actually holds.
+    """
+    for s in self.dirty.copy():
+      try:
+        if s.sql_deleted:
+          s.sql_delete()
+        else:
+          s.sql_store()
+      except (KeyboardInterrupt, SystemExit):
+        raise
+      except Exception:
+        logger.exception("Could not write %r to SQL, discarding unsaved changes", s)
+        key = (s.__class__, getattr(s, s.sql_template.index))
+        if self.cache.get(key) is s:
+          del self.cache[key]
+        self.index_forget(s)
+        s.sql_mark_clean()
+
 class template(object):
   """
   SQL template generator.
@@ -166,6 +376,32 @@ class template(object):
                                                             index_column,
                                                             index_column)
     self.delete  = "DELETE FROM %s WHERE %s = %%s" % (table_name, index_column)
+    self.delete_head = "DELETE FROM %s WHERE %s IN " % (table_name, index_column)
+
+  def store_batch(self, sql, objs):
+    """
+    Write a batch of objects which are already in SQL, running our
+    UPDATE statement once per object.  This is only a saving because
+    the caller wraps all the batches in one transaction; UPDATE has
+    to stay an UPDATE, as an upsert would recreate rows which were
+    deleted (eg, by a cascade) behind our backs.
+    """
+    if objs[0].sql_debug:
+      logger.debug("store_batch(%r, %d objects)", self.table, len(objs))
+    sql.executemany(self.update, [obj.sql_encode() for obj in objs])
+    for obj in objs:
+      obj.sql_update_hook()
+
+  def delete_batch(self, sql, objs):
+    """
+    Delete a batch of objects from SQL with one DELETE statement.
+    """
+    for obj in objs:
+      obj.sql_delete_hook()
+    args = [getattr(obj, self.index) for obj in objs]
+    if objs[0].sql_debug:
+      logger.debug("delete_batch(%r, %r)", self.table, args)
+    sql.execute(self.delete_head + "(%s)" % ", ".join(["%s"] * len(args)), args)
 
 class sql_persistent(object):
   """
@@ -264,6 +500,39 @@ class sql_persistent(object):
         results.append(cls.sql_init(gctx, row, key))
     return results
 
+  @classmethod
+  def sql_fetch_indexed(cls, gctx, column, value, where = None, args = (), test = None):
+    """
+    Fetch objects of this type whose column has the given value.  If
+    a preload covers that value we get them from its index, filtered
+    by test if given, otherwise from SQL, filtered by the equivalent
+    additional WHERE expression where.
+    """
+    results = gctx.sql.index_lookup(cls, column, value)
+    if results is None:
+      query = "%s = %%s" % column
+      if where is not None:
+        query += " AND " + where
+      return cls.sql_fetch_where(gctx, query, (value,) + tuple(args))
+    if test is not None:
+      results = [obj for obj in results if test(obj)]
+    return results
+
+  @classmethod
+  def sql_fetch_indexed1(cls, gctx, column, value, where = None, args = (), test = None):
+    """
+    Like sql_fetch_indexed(), but for at most one object.
+    """
+    results = cls.sql_fetch_indexed(gctx, column, value, where, args, test)
+    if len(results) == 0:
+      return None
+    elif len(results) == 1:
+      return results[0]
+    else:
+      raise rpki.exceptions.DBConsistancyError(
+        "Database contained multiple matches for %s where %s = %r: %r" %
+        (cls.__name__, column, value, results))
+
   @classmethod
   def sql_init(cls, gctx, row, key):
     """
@@ -326,6 +595,7 @@ class sql_persistent(object):
       self.sql_update_hook()
     key = (self.__class__, getattr(self, self.sql_template.index))
     assert key in self.gctx.sql.cache and self.gctx.sql.cache[key] == self
+    self.gctx.sql.index_update(self)
     self.sql_mark_clean()
     self.sql_in_db = True
 
@@ -342,6 +612,7 @@ class sql_persistent(object):
       key = (self.__class__, id)
       if self.gctx.sql.cache.get(key) == self:
         del self.gctx.sql.cache[key]
+      self.gctx.sql.index_remove(self)
       self.sql_in_db = False
     self.sql_mark_clean()
 
@@ -397,6 +668,96 @@ class sql_persistent(object):
     pass
 
 
+class index(object):
+  """
+  In-memory index of SQL objects of one class by the value of one
+  column.  It only answers for values it has been told it has
+  complete results for (by a preload), and holds strong references to
+  the objects it has, which keeps them in the SQL cache.
+  """
+
+  def __init__(self, column):
+    self.column = column
+    self.members = {}                   # value -> {primary key: object}
+    self.filed = {}                     # primary key -> value
+    self.covered = {}                   # value -> reference count
+
+  def cover(self, values, objs):
+    for value in values:
+      self.covered[value] = self.covered.get(value, 0) + 1
+      self.members.setdefault(value, {})
+    for obj in objs:
+      self.update(obj)
+
+  def uncover(self, values):
+    for value in values:
+      count = self.covered.get(value, 0) - 1
+      if count > 0:
+        self.covered[value] = count
+      else:
+        self.drop(value)
+
+  def drop(self, value):
+    """
+    Forget everything we know about value.
+    """
+    self.covered.pop(value, None)
+    for key in self.members.pop(value, ()):
+      del self.filed[key]
+
+  def lookup(self, value):
+    if value in self.covered:
+      return self.members[value].values()
+    return None
+
+  def update(self, obj):
+    self.remove(obj)
+    value = getattr(obj, self.column)
+    if value in self.covered:
+      key = getattr(obj, obj.sql_template.index)
+      self.members[value][key] = obj
+      self.filed[key] = value
+
+  def remove(self, obj):
+    key = getattr(obj, obj.sql_template.index)
+    if key in self.filed:
+      del self.members[self.filed.pop(key)][key]
+
+class preload(object):
+  """
+  Bulk load of related SQL objects for the duration of some piece of
+  work.  Each load() is one query, indexed so that later lookups by
+  the same column (via sql_persistent.sql_fetch_indexed()) don't need
+  to go back to SQL, and kept in memory until release().  The indexes
+  are kept up to date as objects are written or deleted.
+  """
+
+  def __init__(self, gctx):
+    self.gctx = gctx
+    self.loaded = []
+
+  def load(self, cls, column, values):
+    """
+    Load all objects of class cls whose column is one of values, and
+    index them by column.  Returns the objects.
+    """
+    values = set(values)
+    if not values:
+      return []
+    objs = cls.sql_fetch_where(self.gctx, "%s.%s IN (%s)" % (
+      cls.sql_template.table, column, ", ".join(["%s"] * len(values))), tuple(values))
+    idx = self.gctx.sql.indexes.get((cls, column))
+    if idx is None:
+      idx = self.gctx.sql.indexes[(cls, column)] = index(column)
+    idx.cover(values, objs)
+    self.loaded.append((idx, values))
+    return objs
+
+  def release(self):
+    for idx, values in self.loaded:
+      idx.uncover(values)
+    self.loaded = []
+
 def cache_reference(func):
   """
   Decorator for use with property methods which just do an SQL lookup based on an ID.
@@ -0,0 +1,293 @@
+# $Id$
+#
+# Copyright (C) 2015  Dragon Research Labs ("DRL")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND DRL DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS.  IN NO EVENT SHALL DRL BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE
+# OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Pool of worker processes for CPU-bound work (mostly CMS signing and
+verification), so that it doesn't stall the event loop.
+
+Jobs are a module-level function and its arguments, which have to be
+picklable; rpki.x509 objects pickle as their DER encoding, so they can
+be passed directly.  Each worker process has one job at a time, and
+its result comes back through the event loop, so callbacks run in the
+main process just like any other rpki.async callback.  Any rpki.metrics
+updates the job made come back with the result.
+
+Jobs for different workers can finish in any order.  Callers which
+care, such as the CMS code, whose replay checks need each peer's
+messages signed and verified in the order they were sent, pass an
+ordering key: jobs sharing a key run one at a time, in the order they
+were submitted.
+
+With worker_count set to zero (the default), jobs run inline in the
+calling process, which is exactly what the code did before this
+module existed.
+"""
+
+import os
+import signal
+import asyncore
+import logging
+import collections
+import multiprocessing
+import rpki.log
+import rpki.async
+import rpki.metrics
+import rpki.exceptions
+
+logger = logging.getLogger(__name__)
+
+## @var worker_count
+# Number of worker processes to run CPU-bound jobs.  Zero means run
+# jobs inline in the calling process.
+
+worker_count = 0
+
+job_seconds = rpki.metrics.histogram("rpki_worker_job_seconds",
+                                     "Time from submitting a CPU-bound job to getting its result, including time queued.",
+                                     ("function",))
+
+def _worker_main(conn, parent_conn):
+  """
+  Main loop of a worker process: read a job, run it, send back either
+  (True, result) or (False, exception), plus the job's metrics updates.
+  Exits when the main process closes its end of the pipe.
+  """
+
+  # We were forked from a running daemon, so we hold copies of all of
+  # its sockets, including the main process's end of our own pipe.
+  # Close them, or the other ends of connections the main process
+  # closes would never see EOF.
+
+  parent_conn.close()
+  for fd in asyncore.socket_map.keys():
+    try:
+      os.close(fd)
+    except OSError:
+      pass
+  asyncore.socket_map.clear()
+
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+  rpki.metrics.forward = []
+
+  while True:
+    try:
+      func, args = conn.recv()
+    except (EOFError, IOError):
+      break
+    del rpki.metrics.forward[:]
+    try:
+      result = (True, func(*args), rpki.metrics.forward)
+    except Exception, e:
+      result = (False, e, rpki.metrics.forward)
+    try:
+      conn.send(result)
+    except Exception:
+      e = result[1] if not result[0] else None
+      conn.send((False, rpki.exceptions.CryptoWorkerFailed(
+        "Could not return result of %s from worker: %s" % (func.__name__, e or "unpicklable result")), ()))
+
+class worker(asyncore.dispatcher):
+  """
+  Main process's handle on one worker process.  The dispatcher watches
+  our end of the pipe, so we find out when a result is ready without
+  blocking the event loop.
+  """
+
+  def __init__(self, pool):
+    asyncore.dispatcher.__init__(self)
+    self.pool = pool
+    self.job = None
+    self.conn, child_conn = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(target = _worker_main, args = (child_conn, self.conn))
+    self.process.daemon = True
+    self.process.start()
+    child_conn.close()
+    self._fileno = self.conn.fileno()
+    self.connected = True
+    self.add_channel()
+    logger.debug("Started %r", self)
+
+  def __repr__(self):
+    return rpki.log.log_repr(self, self.process.pid)
+
+  def readable(self):
+    return self.job is not None
+
+  def writable(self):
+    return False
+
+  def start(self, job):
+    """
+    Send a job to this worker.  The worker is idle, so it's sitting in
+    recv() and this won't block for long, whatever the size of the job.
+    """
+    assert self.job is None
+    func, args, cb, eb, started, order = job
+    try:
+      self.conn.send((func, args))
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except (EOFError, IOError, OSError), e:
+      logger.warning("%r died while idle: %s", self, e)
+      self.close()
+      self.pool.finished(job)
+      eb(rpki.exceptions.CryptoWorkerFailed("Could not send %s to worker process" % func.__name__))
+    except Exception, e:
+      self.pool.idle.append(self)
+      self.pool.finished(job)
+      eb(e)
+    else:
+      self.job = job
+
+  def handle_read(self):
+    job = self.job
+    func, args, cb, eb, started, order = job
+    try:
+      ok, result, updates = self.conn.recv()
+    except (EOFError, IOError), e:
+      logger.warning("%r died running %s: %s", self, func.__name__, e)
+      self.close()
+      ok, result = False, rpki.exceptions.CryptoWorkerFailed("Worker process died running %s" % func.__name__)
+    else:
+      self.job = None
+      self.pool.idle.append(self)
+      rpki.metrics.replay(updates)
+    job_seconds.since(started, (func.__name__,))
+    self.pool.finished(job)
+    self.pool.dispatch()
+    try:
+      if ok:
+        cb(result)
+      else:
+        eb(result)
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except Exception:
+      logger.exception("Unhandled exception in callback for %s", func.__name__)
+
+  def handle_close(self):
+    # Some backends report hangup without readability; if we're running
+    # a job, let handle_read() collect or fail it, so it's never lost.
+    if self.job is not None:
+      self.handle_read()
+    else:
+      self.close()
+
+  def close(self):
+    self.del_channel()
+    self.conn.close()
+    if self.process.is_alive():
+      self.process.terminate()
+    self.process.join()
+    self.pool.lost(self)
+
+class pool(object):
+  """
+  A set of worker processes, plus a queue of jobs waiting for one.
+  Workers are started when the first job arrives rather than at
+  import time, so that they inherit the configuration.
+
+  Jobs with an ordering key wait in self.ordered until the job ahead
+  of them with the same key has finished, so at most one job per key
+  is ever queued or running, and their callbacks run in the order the
+  jobs were submitted.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.workers = []
+    self.idle = []
+    self.queue = collections.deque()
+    self.ordered = {}
+
+  def call(self, func, args, cb, eb, order = None):
+    job = (func, args, cb, eb, rpki.metrics.now(), order)
+    if order is not None:
+      if order in self.ordered:
+        self.ordered[order].append(job)
+        return
+      self.ordered[order] = collections.deque((job,))
+    self.queue.append(job)
+    self.dispatch()
+
+  def finished(self, job):
+    """
+    Release the next job waiting behind one that has just finished.
+    """
+    order = job[5]
+    if order is None:
+      return
+    waiting = self.ordered[order]
+    waiting.popleft()
+    if waiting:
+      self.queue.append(waiting[0])
+    else:
+      del self.ordered[order]
+
+  def dispatch(self):
+    while self.queue:
+      if not self.idle and len(self.workers) < self.size:
+        w = worker(self)
+        self.workers.append(w)
+        self.idle.append(w)
+      if not self.idle:
+        break
+      self.idle.pop().start(self.queue.popleft())
+
+  def lost(self, w):
+    """
+    Forget about a worker that has exited.  A replacement will be
+    started when there's a job for it.
+
+    We compare by identity, as asyncore dispatchers are very slow to
+    compare for equality.
+    """
+    self.workers = [x for x in self.workers if x is not w]
+    self.idle = [x for x in self.idle if x is not w]
+
+_pool = None
+
+def call(func, args, cb, eb, order = None):
+  """
+  Run func(*args) in a worker process, then call cb() with its result,
+  or eb() with the exception it raised.  If worker_count is zero, run
+  it inline instead, before returning.
+
+  Jobs with the same (hashable, not None) order key run one at a time,
+  in the order they were submitted.
+  """
+
+  global _pool
+
+  if worker_count <= 0:
+    started = rpki.metrics.now()
+    try:
+      result = func(*args)
+    except (rpki.async.ExitNow, SystemExit):
+      raise
+    except Exception, e:
+      job_seconds.since(started, (func.__name__,))
+      eb(e)
+    else:
+      job_seconds.since(started, (func.__name__,))
+      cb(result)
+    return
+
+  if _pool is None:
+    _pool = pool(worker_count)
+  _pool.call(func, args, cb, eb, order)
@@ -48,10 +48,19 @@ import rpki.oids
 import rpki.sundial
 import rpki.log
 import rpki.async
+import rpki.workers
+import rpki.metrics
 import rpki.relaxng
 
 logger = logging.getLogger(__name__)
 
+cms_sign_seconds   = rpki.metrics.histogram("rpki_cms_sign_seconds",
+                                            "Time spent generating CMS signatures, by object type.",
+                                            ("type",))
+cms_verify_seconds = rpki.metrics.histogram("rpki_cms_verify_seconds",
+                                            "Time spent verifying CMS signatures, by object type and outcome.",
+                                            ("type", "outcome"))
+
 def base64_with_linebreaks(der):
   """
   Encode DER (really, anything) as Base64 text, with linebreaks to
@@ -175,6 +184,14 @@ class X501DN(object):
     return cn, sn
 
 
+def sha256(data):
+  """
+  Return the SHA-256 digest of data.
+  """
+  d = rpki.POW.Digest(rpki.POW.SHA256_DIGEST)
+  d.update(data)
+  return d.digest()
+
 class DER_object(object):
   """
   Virtual class to hold a generic DER object.
@@ -1344,6 +1361,33 @@ class CMS_object(DER_object):
 
   print_on_der_error = True
 
+  ## @var trust_stores
+  # Cache of trust stores built by verify(), keyed by the DER of the
+  # trusted certificates, so that we only check and load each set of
+  # trusted certificates once.  Certificates loaded with Auto_update
+  # reload their files when we ask for their DER, and a changed
+  # certificate changes the key.  Shared by all subclasses.
+
+  trust_stores = {}
+
+  ## @var trust_store_cache_size
+  # Number of entries in trust_stores at which we flush it.
+
+  trust_store_cache_size = 100
+
+  ## @var verified_certs
+  # Cache of the expiration times of sets of CMS certificates that
+  # verify() has already checked against a particular set of trusted
+  # certificates, keyed by both.  Peers sign many messages with the
+  # same EE certificate.  Shared by all subclasses.
+
+  verified_certs = {}
+
+  ## @var verified_certs_cache_size
+  # Number of entries in verified_certs at which we flush it.
+
+  verified_certs_cache_size = 1000
+
   def get_DER(self):
     """
     Get the DER value of this CMS_object.
@@ -1390,57 +1434,39 @@ class CMS_object(DER_object):
       raise rpki.exceptions.WrongEContentType("Got CMS eContentType %s, expected %s" % (
         cms.eContentType(), self.econtent_oid))
 
-    certs = [X509(POW = x) for x in cms.certs()]
-    crls  = [CRL(POW = c) for c in cms.crls()]
+    crls = [CRL(POW = c) for c in cms.crls()]
 
     if self.debug_cms_certs:
-      for x in certs:
-        logger.debug("Received CMS cert issuer %s subject %s SKI %s",
-                     x.getIssuer(), x.getSubject(), x.hSKI())
       for c in crls:
         logger.debug("Received CMS CRL issuer %r", c.getIssuer())
 
-    store = rpki.POW.X509Store()
-
     now = rpki.sundial.now()
 
-    trusted_ee = None
-
-    for x in X509.normalize_chain(ta):
-      if self.debug_cms_certs:
-        logger.debug("CMS trusted cert issuer %s subject %s SKI %s",
-                     x.getIssuer(), x.getSubject(), x.hSKI())
-      if x.getNotAfter() < now:
-        raise rpki.exceptions.TrustedCMSCertHasExpired("Trusted CMS certificate has expired",
-                                                       "%s (%s)" % (x.getSubject(), x.hSKI()))
-      if not x.is_CA():
-        if trusted_ee is None:
-          trusted_ee = x
-        else:
-          raise rpki.exceptions.MultipleCMSEECert("Multiple CMS EE certificates", *("%s (%s)" % (
-            x.getSubject(), x.hSKI()) for x in ta if not x.is_CA()))
-      store.addTrust(x.get_POW())
+    ta = X509.normalize_chain(ta)
+    ta_key = tuple(x.get_DER() for x in ta)
+    trust = self.trust_stores.get(ta_key)
+    if trust is None or trust[2] < now or self.debug_cms_certs:
+      trust = self._build_trust_store(ta, now)
+      if len(self.trust_stores) >= self.trust_store_cache_size:
+        self.trust_stores.clear()
+      self.trust_stores[ta_key] = trust
+    store, trusted_ee = trust[:2]
+
+    # The checks depend on allow_extra_certs, which varies by subclass.
+    certs_key = (ta_key, self.allow_extra_certs, tuple(x.derWrite() for x in cms.certs()))
+    certs_not_after = self.verified_certs.get(certs_key)
+    if certs_not_after is None or certs_not_after < now or self.debug_cms_certs:
+      certs_not_after = self._check_certs([X509(POW = x) for x in cms.certs()], trusted_ee, now)
+      if len(self.verified_certs) >= self.verified_certs_cache_size:
+        self.verified_certs.clear()
+      self.verified_certs[certs_key] = certs_not_after
 
     if trusted_ee:
-      if self.debug_cms_certs:
-        logger.debug("Trusted CMS EE cert issuer %s subject %s SKI %s",
-                     trusted_ee.getIssuer(), trusted_ee.getSubject(), trusted_ee.hSKI())
-      if len(certs) > 1 or (len(certs) == 1 and
-                            (certs[0].getSubject() != trusted_ee.getSubject() or
-                             certs[0].getPublicKey() != trusted_ee.getPublicKey())):
-        raise rpki.exceptions.UnexpectedCMSCerts("Unexpected CMS certificates", *("%s (%s)" % (
-          x.getSubject(), x.hSKI()) for x in certs))
       if crls:
         raise rpki.exceptions.UnexpectedCMSCRLs("Unexpected CRLs", *("%s (%s)" % (
           c.getIssuer(), c.hAKI()) for c in crls))
 
     else:
-      untrusted_ee = [x for x in certs if not x.is_CA()]
-      if len(untrusted_ee) < 1:
-        raise rpki.exceptions.MissingCMSEEcert
-      if len(untrusted_ee) > 1 or (not self.allow_extra_certs and len(certs) > len(untrusted_ee)):
-        raise rpki.exceptions.UnexpectedCMSCerts("Unexpected CMS certificates", *("%s (%s)" % (
-          x.getSubject(), x.hSKI()) for x in certs))
       if len(crls) < 1:
         if self.require_crls:
           raise rpki.exceptions.MissingCMSCRL
@@ -1450,20 +1476,17 @@ class CMS_object(DER_object):
         raise rpki.exceptions.UnexpectedCMSCRLs("Unexpected CRLs", *("%s (%s)" % (
           c.getIssuer(), c.hAKI()) for c in crls))
 
-    for x in certs:
-      if x.getNotAfter() < now:
-        raise rpki.exceptions.CMSCertHasExpired("CMS certificate has expired", "%s (%s)" % (
-          x.getSubject(), x.hSKI()))
-
     for c in crls:
       if c.getNextUpdate() < now:
         logger.warning("Stale BPKI CMS CRL (%s %s %s)", c.getNextUpdate(), c.getIssuer(), c.hAKI())
 
+    started = rpki.metrics.now()
     try:
       content = cms.verify(store)
     except (rpki.async.ExitNow, SystemExit):
       raise
     except Exception:
+      cms_verify_seconds.since(started, (self.__class__.__name__, "failed"))
       if self.dump_on_verify_failure:
         if self.dump_using_dumpasn1:
           dbg = self.dumpasn1()
@@ -1474,8 +1497,83 @@ class CMS_object(DER_object):
           logger.warning(line)
       raise rpki.exceptions.CMSVerificationFailed("CMS verification failed")
 
+    cms_verify_seconds.since(started, (self.__class__.__name__, "ok"))
     return content
 
+  def _build_trust_store(self, ta, now):
+    """
+    Check a normalized chain of trusted certificates and build an
+    rpki.POW.X509Store from it.  Returns the store, the trusted EE
+    certificate if there is one, and the earliest expiration time of
+    any certificate in the chain, after which we have to check the
+    chain again.
+    """
+
+    store = rpki.POW.X509Store()
+
+    trusted_ee = None
+
+    not_after = rpki.sundial.datetime.max
+
+    for x in ta:
+      if self.debug_cms_certs:
+        logger.debug("CMS trusted cert issuer %s subject %s SKI %s",
+                     x.getIssuer(), x.getSubject(), x.hSKI())
+      if x.getNotAfter() < now:
+        raise rpki.exceptions.TrustedCMSCertHasExpired("Trusted CMS certificate has expired",
+                                                       "%s (%s)" % (x.getSubject(), x.hSKI()))
+      if not x.is_CA():
+        if trusted_ee is None:
+          trusted_ee = x
+        else:
+          raise rpki.exceptions.MultipleCMSEECert("Multiple CMS EE certificates", *("%s (%s)" % (
+            x.getSubject(), x.hSKI()) for x in ta if not x.is_CA()))
+      not_after = min(not_after, x.getNotAfter())
+      store.addTrust(x.get_POW())
+
+    if trusted_ee and self.debug_cms_certs:
+      logger.debug("Trusted CMS EE cert issuer %s subject %s SKI %s",
+                   trusted_ee.getIssuer(), trusted_ee.getSubject(), trusted_ee.hSKI())
+
+    return store, trusted_ee, not_after
+
+  def _check_certs(self, certs, trusted_ee, now):
+    """
+    Check the certificates embedded in a CMS message against what we
+    expect given the trusted certificates.  Returns the earliest
+    expiration time of any embedded certificate.
+    """
+
+    if self.debug_cms_certs:
+      for x in certs:
+        logger.debug("Received CMS cert issuer %s subject %s SKI %s",
+                     x.getIssuer(), x.getSubject(), x.hSKI())
+
+    if trusted_ee:
+      if len(certs) > 1 or (len(certs) == 1 and
+                            (certs[0].getSubject() != trusted_ee.getSubject() or
+                             certs[0].getPublicKey() != trusted_ee.getPublicKey())):
+        raise rpki.exceptions.UnexpectedCMSCerts("Unexpected CMS certificates", *("%s (%s)" % (
+          x.getSubject(), x.hSKI()) for x in certs))
+
+    else:
+      untrusted_ee = [x for x in certs if not x.is_CA()]
+      if len(untrusted_ee) < 1:
+        raise rpki.exceptions.MissingCMSEEcert
+      if len(untrusted_ee) > 1 or (not self.allow_extra_certs and len(certs) > len(untrusted_ee)):
+        raise rpki.exceptions.UnexpectedCMSCerts("Unexpected CMS certificates", *("%s (%s)" % (
+          x.getSubject(), x.hSKI()) for x in certs))
+
+    not_after = rpki.sundial.datetime.max
+
+    for x in certs:
+      if x.getNotAfter() < now:
+        raise rpki.exceptions.CMSCertHasExpired("CMS certificate has expired", "%s (%s)" % (
+          x.getSubject(), x.hSKI()))
+      not_after = min(not_after, x.getNotAfter())
+
+    return not_after
+
   def extract(self):
     """
     Extract and store inner content from CMS wrapper without verifying
@@ -1529,11 +1627,13 @@ class CMS_object(DER_object):
         logger.debug("Additional cert %d issuer %s subject %s SKI %s",
                      i, c.getIssuer(), c.getSubject(), c.hSKI())
 
+    started = rpki.metrics.now()
     self._sign(cert.get_POW(),
                keypair.get_POW(),
                [x.get_POW() for x in certs],
                [c.get_POW() for c in crls],
                rpki.POW.CMS_NOCERTS if no_certs else 0)
+    cms_sign_seconds.since(started, (self.__class__.__name__,))
 
   @property
   def creation_timestamp(self):
@@ -1660,16 +1760,18 @@ class SignedManifest(DER_CMS_object):
     return self.get_POW().getNextUpdate()
 
   @classmethod
-  def build(cls, serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs, version = 0):
+  def build(cls, serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs, version = 0, names_and_hashes = ()):
     """
-    Build a signed manifest.
+    Build a signed manifest.  Objects in names_and_objs are hashed
+    here; names_and_hashes lets the caller supply SHA-256 hashes it
+    already has.
     """
 
     filelist = []
     for name, obj in names_and_objs:
-      d = rpki.POW.Digest(rpki.POW.SHA256_DIGEST)
-      d.update(obj.get_DER())
-      filelist.append((name.rpartition("/")[2], d.digest()))
+      filelist.append((name.rpartition("/")[2], sha256(obj.get_DER())))
+    for name, digest in names_and_hashes:
+      filelist.append((name.rpartition("/")[2], digest))
     filelist.sort(key = lambda x: x[0])
 
     obj = cls.POW_class()
@@ -1849,6 +1951,27 @@ class XML_CMS_object(Wrapped_CMS_object):
       self.dump_outbound_cms.dump(self)
     return self.get_DER()
 
+  def wrap_async(self, msg, keypair, certs, crls, cb, eb, order = None):
+    """
+    Like .wrap(), but do the signature in an rpki.workers process and
+    call cb() with the DER encoding.  Messages to one peer should share
+    an order key, so that they're signed in the order we send them.
+    """
+    if self.saxify is None:
+      self.set_content(msg)
+    else:
+      self.set_content(msg.toXML())
+    if self.check_outbound_schema:
+      self.schema_check()
+
+    def done(der):
+      self.DER = der
+      if self.dump_outbound_cms:
+        self.dump_outbound_cms.dump(self)
+      cb(der)
+
+    rpki.workers.call(_sign_xml_cms, (self.__class__, self.encode(), keypair, certs, crls), done, eb, order)
+
   def unwrap(self, ta):
     """
     Unwrap a CMS-wrapped XML PDU and return Python objects.
@@ -1856,6 +1979,35 @@ class XML_CMS_object(Wrapped_CMS_object):
     if self.dump_inbound_cms:
       self.dump_inbound_cms.dump(self)
     self.verify(ta)
+    return self._unwrap_content()
+
+  def unwrap_async(self, ta, cb, eb, order = None):
+    """
+    Like .unwrap(), but do the CMS verification in an rpki.workers
+    process and call cb() with the Python objects.  Messages from one
+    peer should share an order key, so that replay checks in cb() see
+    them in the order they arrived.
+    """
+    if self.dump_inbound_cms:
+      self.dump_inbound_cms.dump(self)
+
+    def done(content):
+      try:
+        self.decode(content)
+        r_msg = self._unwrap_content()
+      except (rpki.async.ExitNow, SystemExit):
+        raise
+      except Exception, e:
+        eb(e)
+      else:
+        cb(r_msg)
+
+    rpki.workers.call(_verify_cms, (self.__class__, self.get_DER(), ta), done, eb, order)
+
+  def _unwrap_content(self):
+    """
+    Schema check verified inner content and convert it to Python objects.
+    """
     if self.check_inbound_schema:
       self.schema_check()
     if self.saxify is None:
@@ -1894,6 +2046,22 @@ class XML_CMS_object(Wrapped_CMS_object):
 
   saxify = None
 
+def _sign_xml_cms(cls, xml, keypair, certs, crls):
+  """
+  Worker process half of XML_CMS_object.wrap_async().
+  """
+  self = cls()
+  self.decode(xml)
+  self.sign(keypair, certs, crls)
+  return self.get_DER()
+
+def _verify_cms(cls, der, ta):
+  """
+  Worker process half of XML_CMS_object.unwrap_async().  Returns the
+  inner content, which has to be decoded in the calling process.
+  """
+  return CMS_object.verify(cls(DER = der), ta)
+
 class SignedReferral(XML_CMS_object):
   encoding = "us-ascii"
   schema = rpki.relaxng.myrpki
@@ -50,8 +50,24 @@ class sax_handler(xml.sax.handler.ContentHandler):
   XML has already passed RelaxNG validation, so we only have to check
   for errors that the schema can't catch, and we don't have to play as
   many XML namespace games.
+
+  Despite the name, saxify() normally walks the lxml element tree
+  directly, making the same calls that SAX events would, without
+  going through lxml.sax and xml.sax's attribute objects.  Set use_sax
+  to go via SAX instead.
   """
 
+  ## @var use_sax
+  # Set this to True to decode element trees via lxml.sax, as we used
+  # to, rather than by walking them directly.
+
+  use_sax = False
+
+  ## @var xml_lang
+  # lxml's name for the xml:lang attribute.
+
+  xml_lang = "{http://www.w3.org/XML/1998/namespace}lang"
+
   def __init__(self):
     """
     Initialize SAX handler.
@@ -80,15 +96,8 @@ class sax_handler(xml.sax.handler.ContentHandler):
 
   def startElement(self, name, attrs):
     """
-    Handle startElement() events.
-
-    We maintain a stack of nested elements under construction so that
-    we can feed events directly to the current element rather than
-    having to pass them through all the nesting elements.
-
-    If the stack is empty, this event is for the outermost element, so
-    we call a virtual method to create the corresponding object and
-    that's the object we'll be returning as our final result.
+    Handle startElement() events: convert SAX attributes to a dict of
+    ASCII strings, then push the element.
     """
 
     a = dict()
@@ -100,6 +109,21 @@ class sax_handler(xml.sax.handler.ContentHandler):
           assert k[0] is None
           k = k[1]
       a[k.encode("ascii")] = v.encode("ascii")
+    self.push(name, a)
+
+  def push(self, name, a):
+    """
+    Start an element, given its attributes as a dict.
+
+    We maintain a stack of nested elements under construction so that
+    we can feed events directly to the current element rather than
+    having to pass them through all the nesting elements.
+
+    If the stack is empty, this event is for the outermost element, so
+    we call a virtual method to create the corresponding object and
+    that's the object we'll be returning as our final result.
+    """
+
     if len(self.stack) == 0:
       assert not hasattr(self, "result")
       self.result = self.create_top_level(name, a)
@@ -111,17 +135,54 @@ class sax_handler(xml.sax.handler.ContentHandler):
     Handle endElement() events.  Mostly this means handling any
     accumulated element text.
     """
-    text = self.text.encode("ascii").strip()
+    text = self.text
+    if not isinstance(text, str):
+      text = text.encode("ascii")
+    text = text.strip()
     self.text = ""
     self.stack[-1].endElement(self.stack, name, text)
 
+  def walk(self, elt):
+    """
+    Generate push(), characters() and endElement() calls for an
+    element and everything under it, in SAX order, straight from the
+    lxml element tree.  Attributes which lxml has already given us as
+    plain ASCII strings are used as they are.
+    """
+    if not isinstance(elt.tag, basestring):
+      return                            # Comment or processing instruction
+    a = dict()
+    for k, v in elt.attrib.iteritems():
+      if k[0] == "{":
+        assert k == self.xml_lang, "Unexpected namespaced attribute %s" % k
+        k = "xml:lang"
+      elif not isinstance(k, str):
+        k = k.encode("ascii")
+      if not isinstance(v, str):
+        v = v.encode("ascii")
+      a[k] = v
+    name = elt.tag.rpartition("}")[2]
+    if not isinstance(name, str):
+      name = name.encode("ascii")
+    self.push(name, a)
+    if elt.text:
+      self.characters(elt.text)
+    for child in elt:
+      self.walk(child)
+      if child.tail:
+        self.characters(child.tail)
+    self.endElement(name)
+
   @classmethod
   def saxify(cls, elt):
     """
-    Create a one-off SAX parser, parse an ETree, return the result.
+    Create a one-off handler, feed it an ETree, return the result.
     """
     self = cls()
-    lxml.sax.saxify(elt, self)
+    if cls.use_sax:
+      lxml.sax.saxify(elt, self)
+    else:
+      self.walk(elt)
     return self.result
 
   def create_top_level(self, name, attrs):
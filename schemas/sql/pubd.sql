@@ -34,6 +34,7 @@
 -- to store one BPKI CRL, but putting this here lets us use a lot of
 -- existing machinery and the alternatives are whacky in other ways.
 
+DROP TABLE IF EXISTS published_object;
 DROP TABLE IF EXISTS client;
 DROP TABLE IF EXISTS config;
 
@@ -54,6 +55,20 @@ CREATE TABLE client (
         UNIQUE                  (client_handle)
 ) ENGINE=InnoDB;
 
+-- Index of what's in the publication tree, so that we can skip
+-- rewriting unchanged objects and tell clients what they've published.
+
+CREATE TABLE published_object (
+        published_object_id     SERIAL NOT NULL,
+        uri                     TEXT NOT NULL,
+        hash                    CHAR(64) NOT NULL,
+        size                    BIGINT UNSIGNED NOT NULL,
+        client_id               BIGINT UNSIGNED NOT NULL,
+        PRIMARY KEY             (published_object_id),
+        CONSTRAINT              published_object_client_id
+        FOREIGN KEY             (client_id) REFERENCES client (client_id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
 -- Local Variables:
 -- indent-tabs-mode: nil
 -- End: